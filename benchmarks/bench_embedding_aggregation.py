@@ -0,0 +1,77 @@
+"""Compare the per-text aggregation loop with the vectorized chunk aggregation.
+
+Usage:
+    python benchmarks/bench_embedding_aggregation.py [num_texts] [dim]
+"""
+import sys
+import time
+
+import numpy as np
+
+from saplangchainproxy.embeddings.openai import _average_chunk_embeddings
+
+
+def _loop_aggregate(num_texts, tokens, indices, batched_embeddings):
+    results = [[] for _ in range(num_texts)]
+    num_tokens_in_batch = [[] for _ in range(num_texts)]
+    for i in range(len(indices)):
+        results[indices[i]].append(batched_embeddings[i])
+        num_tokens_in_batch[indices[i]].append(len(tokens[i]))
+    embeddings = []
+    for i in range(num_texts):
+        if len(results[i]) == 0:
+            embeddings.append(None)
+            continue
+        average = np.average(results[i], axis=0, weights=num_tokens_in_batch[i])
+        embeddings.append((average / np.linalg.norm(average)).tolist())
+    return embeddings
+
+
+def _vectorized_aggregate(num_texts, tokens, indices, batched_embeddings):
+    embeddings, empty_rows = _average_chunk_embeddings(
+        num_texts,
+        indices,
+        [len(token) for token in tokens],
+        np.asarray(batched_embeddings, dtype=np.float64),
+    )
+    return [
+        None if empty else embedding
+        for embedding, empty in zip(embeddings.tolist(), empty_rows)
+    ]
+
+
+def main(num_texts=20_000, dim=1536):
+    rng = np.random.default_rng(0)
+    # most texts fit one chunk, some need several and a few are empty
+    chunks_per_text = rng.choice([0, 1, 2, 3], size=num_texts, p=[0.01, 0.8, 0.15, 0.04])
+    indices = np.repeat(np.arange(num_texts), chunks_per_text).tolist()
+    tokens = [[0] * int(n) for n in rng.integers(1, 8191, size=len(indices))]
+    batched_embeddings = rng.standard_normal((len(indices), dim)).tolist()
+
+    timings = {}
+    outputs = {}
+    for name, aggregate in [("loop", _loop_aggregate), ("vectorized", _vectorized_aggregate)]:
+        start = time.perf_counter()
+        outputs[name] = aggregate(num_texts, tokens, indices, batched_embeddings)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:>10}: {timings[name]:.3f}s")
+
+    # embed_documents_array fills the chunk matrix directly, leaving the aggregation
+    chunk_embeddings = np.asarray(batched_embeddings, dtype=np.float32)
+    start = time.perf_counter()
+    _average_chunk_embeddings(
+        num_texts, indices, [len(token) for token in tokens], chunk_embeddings
+    )
+    print(f"{'array':>10}: {time.perf_counter() - start:.3f}s")
+
+    error = max(
+        float(np.max(np.abs(np.subtract(a, b))))
+        for a, b in zip(outputs["loop"], outputs["vectorized"])
+        if a is not None
+    )
+    print(f"{len(indices)} chunks of {num_texts} texts, speedup "
+          f"{timings['loop'] / timings['vectorized']:.1f}x, max abs diff {error:.2e}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
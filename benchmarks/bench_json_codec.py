@@ -0,0 +1,92 @@
+"""Compare the json and orjson codecs on an embeddings response, and how long
+decoding it blocks the event loop when done on the loop or with codec.aloads.
+
+Usage:
+    python benchmarks/bench_json_codec.py [num_texts] [dim] [repeat]
+"""
+import asyncio
+import sys
+import time
+
+import numpy as np
+
+from saplangchainproxy import codec
+from saplangchainproxy.codec import _loads_in_pieces
+
+
+def _response(num_texts, dim):
+    rng = np.random.default_rng(0)
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": row}
+            for i, row in enumerate(rng.standard_normal((num_texts, dim)).tolist())
+        ],
+        "model": "text-embedding-ada-002-v2",
+        "usage": {"prompt_tokens": num_texts * 8, "total_tokens": num_texts * 8},
+    }
+
+
+def _best_of(repeat, func, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+async def _max_stall(decode, body):
+    """Longest gap between the ticks of a task while the body is decoded."""
+    stalls = []
+    done = False
+
+    async def tick():
+        last = time.perf_counter()
+        while not done:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stalls.append(now - last)
+            last = now
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0.01)
+    await decode(body)
+    done = True
+    await ticker
+    return max(stalls)
+
+
+async def _on_loop(body):
+    return codec.loads(body)
+
+
+def main(num_texts=1000, dim=1536, repeat=5):
+    response = _response(num_texts, dim)
+    payload = {"input": [list(range(500))] * num_texts, "deployment_id": "text-embedding-ada-002-v2"}
+    codecs = [c for c in (codec.JSON_CODEC, codec.ORJSON_CODEC) if c is not None]
+    if codec.ORJSON_CODEC is None:
+        print("orjson is not installed, only the json codec is measured")
+    body = codec.JSON_CODEC.dumps(response)
+    print(f"response of {num_texts} x {dim} floats, {len(body) / 2**20:.1f} MiB")
+
+    timings = {}
+    for c in codecs:
+        timings[c.name] = _best_of(repeat, c.loads, body)
+        pieces = _best_of(repeat, _loads_in_pieces, body, c.loads)
+        dumps = _best_of(repeat, c.dumps, payload)
+        print(f"{c.name:>7}: loads {timings[c.name]:.3f}s, in pieces {pieces:.3f}s, "
+              f"dumps request {dumps:.3f}s")
+    if len(codecs) > 1:
+        print(f"decoding speedup {timings['json'] / timings['orjson']:.1f}x")
+
+    for c in codecs:
+        codec.set_codec(c)
+        on_loop = asyncio.run(_max_stall(_on_loop, body))
+        off_loop = asyncio.run(_max_stall(codec.aloads, body))
+        print(f"{c.name:>7}: event loop blocked {on_loop * 1000:.0f}ms decoding on the loop, "
+              f"{off_loop * 1000:.0f}ms with aloads")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
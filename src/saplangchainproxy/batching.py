@@ -0,0 +1,148 @@
+"""Micro-batching of concurrent calls into one request to the proxy."""
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+
+class _Batch:
+    def __init__(self):
+        self.items: List[Any] = []
+        self.futures: List[Any] = []
+        self.size = 0
+        self.full = threading.Event()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+def _resolve(futures: List[Any], results: Optional[List[Any]], error: Optional[BaseException]) -> None:
+    for i, future in enumerate(futures):
+        # the callers of an async batch may have been cancelled
+        if future.done():
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(results[i])
+
+
+class MicroBatcher:
+    """Gathers the items of concurrent calls from several threads into batches.
+
+    The first caller of a batch waits up to max_wait seconds for others to join,
+    or until the batch is full, then processes the batch on its thread and hands
+    each caller its result. process gets the items and returns their results in
+    the same order, if it raises every caller of the batch gets the error.
+
+    Only items with the same key share a batch. An item counts size towards the
+    max_size of its batch, an item which does not fit sends the batch right away
+    and starts the next one.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[List[Any]], List[Any]],
+        max_size: int = 64,
+        max_wait: float = 0.005,
+    ):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+        self.process = process
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._batches: Dict[Hashable, _Batch] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, item: Any, key: Hashable = None, size: int = 1) -> Any:
+        """Add the item to the next batch of the key and wait for its result."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is not None and batch.size + size > self.max_size:
+                del self._batches[key]
+                batch.full.set()
+                batch = None
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = _Batch()
+            batch.items.append(item)
+            batch.futures.append(future)
+            batch.size += size
+            if batch.size >= self.max_size:
+                del self._batches[key]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self._lock:
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+            try:
+                results = self.process(batch.items)
+            except Exception as e:
+                _resolve(batch.futures, None, e)
+            else:
+                _resolve(batch.futures, results, None)
+        return future.result()
+
+
+class AsyncMicroBatcher:
+    """Gathers the items of concurrent tasks of an event loop into batches.
+
+    A batch is processed in its own task max_wait seconds after its first item
+    arrived or as soon as it is full. Keys and sizes work as for MicroBatcher.
+    Every event loop has its own batches.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_size: int = 64,
+        max_wait: float = 0.005,
+    ):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+        self.process = process
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._batches: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Hashable, _Batch]]" = weakref.WeakKeyDictionary()
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    async def submit(self, item: Any, key: Hashable = None, size: int = 1) -> Any:
+        """Add the item to the next batch of the key in the running loop and wait
+        for its result."""
+        loop = asyncio.get_running_loop()
+        batches = self._batches.setdefault(loop, {})
+        batch = batches.get(key)
+        if batch is not None and batch.size + size > self.max_size:
+            batch.timer.cancel()
+            self._flush(batches, key, batch)
+            batch = None
+        if batch is None:
+            batch = batches[key] = _Batch()
+            batch.timer = loop.call_later(self.max_wait, self._flush, batches, key, batch)
+        future = loop.create_future()
+        batch.items.append(item)
+        batch.futures.append(future)
+        batch.size += size
+        if batch.size >= self.max_size:
+            batch.timer.cancel()
+            self._flush(batches, key, batch)
+        return await future
+
+    def _flush(self, batches: Dict[Hashable, _Batch], key: Hashable, batch: _Batch) -> None:
+        if batches.get(key) is batch:
+            del batches[key]
+        # the task is referenced until it is done, else it could be collected
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: _Batch) -> None:
+        try:
+            results = await self.process(batch.items)
+        except Exception as e:
+            _resolve(batch.futures, None, e)
+        else:
+            _resolve(batch.futures, results, None)
@@ -0,0 +1,541 @@
+"""Local caches for the SAP AI proxy models."""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from langchain.embeddings.base import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_text(text: str) -> str:
+    """Normalize the text so equal texts with different encodings share the key."""
+    return unicodedata.normalize("NFC", text.replace("\r\n", "\n"))
+
+
+def canonical_hash(value: Any) -> str:
+    """Hash of the canonical JSON of the value, independent of the key order."""
+    canonical = json.dumps(
+        value, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _thread_connection(
+    local: threading.local, path: str, timeout: float
+) -> sqlite3.Connection:
+    # sqlite connections must not be shared across threads or forked processes
+    connection = getattr(local, "connection", None)
+    if connection is None or local.pid != os.getpid():
+        connection = sqlite3.connect(path, timeout=timeout)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        local.connection = connection
+        local.pid = os.getpid()
+    return connection
+
+
+class SQLiteEmbeddingCache:
+    """Persistent embedding cache stored in a SQLite database.
+
+    Entries are keyed by deployment, model and the hash of the normalized text.
+    The least recently used entries are evicted once the cache holds more than
+    max_entries embeddings. The database runs in WAL mode, so several worker
+    processes can share the same file.
+
+    Example:
+        .. code-block:: python
+
+            from saplangchainproxy.cache import SQLiteEmbeddingCache
+            from saplangchainproxy.embeddings import SAPOpenAIEmbeddings
+
+            embeddings = SAPOpenAIEmbeddings(
+                embedding_cache=SQLiteEmbeddingCache("embeddings.sqlite")
+            )
+    """
+
+    def __init__(
+        self,
+        path: str = "sap_embeddings_cache.sqlite",
+        max_entries: Optional[int] = 1_000_000,
+        timeout: float = 30.0,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used "
+                "ON embeddings (last_used)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS stats ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), "
+                "hits INTEGER NOT NULL, misses INTEGER NOT NULL)"
+            )
+            connection.execute("INSERT OR IGNORE INTO stats VALUES (0, 0, 0)")
+
+    def _connection(self) -> sqlite3.Connection:
+        return _thread_connection(self._local, self.path, self.timeout)
+
+    @staticmethod
+    def key(deployment: str, model: str, text: str) -> str:
+        """Get the cache key of the text for the deployment and model."""
+        digest = hashlib.sha256(_normalize_text(text).encode("utf-8")).hexdigest()
+        return f"{deployment}:{model}:{digest}"
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        """Get the cached embeddings of the keys, missing keys are left out."""
+        unique_keys = list(dict.fromkeys(keys))
+        found: Dict[str, List[float]] = {}
+        connection = self._connection()
+        with connection:
+            # stay below the sqlite limit of variables per statement
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i : i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype="<f8").tolist()
+                if rows:
+                    connection.execute(
+                        f"UPDATE embeddings SET last_used = ? "
+                        f"WHERE key IN ({placeholders})",
+                        [time.time(), *chunk],
+                    )
+            hits = sum(1 for key in keys if key in found)
+            connection.execute(
+                "UPDATE stats SET hits = hits + ?, misses = misses + ? WHERE id = 0",
+                (hits, len(keys) - hits),
+            )
+        return found
+
+    def set_many(self, embeddings: Dict[str, List[float]]) -> None:
+        """Store the embeddings and evict the least recently used entries."""
+        if not embeddings:
+            return
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [
+                    (key, np.asarray(vector, dtype="<f8").tobytes(), now)
+                    for key, vector in embeddings.items()
+                ],
+            )
+            if self.max_entries is not None:
+                (entries,) = connection.execute(
+                    "SELECT COUNT(*) FROM embeddings"
+                ).fetchone()
+                if entries > self.max_entries:
+                    connection.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings "
+                        "ORDER BY last_used LIMIT ?)",
+                        (entries - self.max_entries,),
+                    )
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of hits, misses and entries of the cache."""
+        connection = self._connection()
+        hits, misses = connection.execute(
+            "SELECT hits, misses FROM stats WHERE id = 0"
+        ).fetchone()
+        (entries,) = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return {"hits": hits, "misses": misses, "entries": entries}
+
+    @property
+    def hits(self) -> int:
+        return self.stats()["hits"]
+
+    @property
+    def misses(self) -> int:
+        return self.stats()["misses"]
+
+    def clear(self) -> None:
+        """Remove all entries and reset the counters."""
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM embeddings")
+            connection.execute("UPDATE stats SET hits = 0, misses = 0 WHERE id = 0")
+
+
+class ResponseCache:
+    """Exact-match cache of the completion responses of the proxy.
+
+    Responses are keyed by the canonical hash of the endpoint and the request
+    payload, i.e. the deployment, the messages or prompt and the sampling
+    parameters. Whether the response is streamed is not part of the key, cached
+    responses are replayed as chunks for streaming requests.
+
+    The entries are kept in an in-memory LRU of max_entries responses and, if a
+    path is given, in a SQLite database which is shared with other processes.
+    Entries are fresh for ttl seconds. For stale_while_revalidate seconds after
+    that, the stale response is served while it is refreshed in the background.
+
+    Every hit returns the same response, so only cache deterministic requests,
+    e.g. with temperature 0.
+
+    Example:
+        .. code-block:: python
+
+            from saplangchainproxy.cache import ResponseCache
+            from saplangchainproxy.chat import SAPChatOpenAI
+
+            chat = SAPChatOpenAI(
+                temperature=0,
+                response_cache=ResponseCache(ttl=600, stale_while_revalidate=60),
+            )
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: Optional[float] = 3600.0,
+        stale_while_revalidate: float = 0.0,
+        path: Optional[str] = None,
+        max_disk_entries: Optional[int] = 100_000,
+        timeout: float = 30.0,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.timeout = timeout
+        # serialized responses and the time they were stored, oldest used first
+        self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._revalidating: Set[str] = set()
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._local = threading.local()
+        if path is not None:
+            with self._connection() as connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                    "stored_at REAL NOT NULL)"
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS responses_stored_at "
+                    "ON responses (stored_at)"
+                )
+
+    def _connection(self) -> sqlite3.Connection:
+        return _thread_connection(self._local, self.path, self.timeout)
+
+    @staticmethod
+    def key(url: str, client_id: str, payload: Dict[str, Any]) -> str:
+        """Get the cache key of the request payload the client sends to the url.
+
+        The client id is part of the key, responses are not shared between tenants.
+        """
+        return canonical_hash(
+            {
+                "url": url,
+                "client_id": client_id,
+                "payload": {k: v for k, v in payload.items() if k != "stream"},
+            }
+        )
+
+    def _remember(self, key: str, entry: Tuple[str, float]) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Tuple[Any, bool]]:
+        """Get the cached response and whether it is still fresh.
+
+        Returns None if the response is missing or expired, a stale response is
+        returned as not fresh and should be revalidated.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.path is not None:
+            row = self._connection().execute(
+                "SELECT response, stored_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                entry = (row[0], row[1])
+                self._remember(key, entry)
+        fresh = stale = False
+        if entry is not None:
+            age = time.time() - entry[1]
+            fresh = self.ttl is None or age <= self.ttl
+            stale = not fresh and age <= self.ttl + self.stale_while_revalidate
+        with self._lock:
+            if fresh:
+                self._hits += 1
+            elif stale:
+                self._stale_hits += 1
+            else:
+                self._misses += 1
+        if not (fresh or stale):
+            return None
+        # every hit gets its own copy of the response
+        return json.loads(entry[0]), fresh
+
+    def set(self, key: str, response: Any) -> None:
+        """Store the response under the key."""
+        entry = (json.dumps(response), time.time())
+        self._remember(key, entry)
+        if self.path is None:
+            return
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, *entry)
+            )
+            if self.max_disk_entries is not None:
+                (entries,) = connection.execute(
+                    "SELECT COUNT(*) FROM responses"
+                ).fetchone()
+                if entries > self.max_disk_entries:
+                    connection.execute(
+                        "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                        "ORDER BY stored_at LIMIT ?)",
+                        (entries - self.max_disk_entries,),
+                    )
+
+    async def aget(self, key: str) -> Optional[Tuple[Any, bool]]:
+        """Get the cached response without blocking the event loop on the disk."""
+        if self.path is None:
+            return self.get(key)
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    async def aset(self, key: str, response: Any) -> None:
+        """Store the response without blocking the event loop on the disk."""
+        if self.path is None:
+            return self.set(key, response)
+        await asyncio.get_running_loop().run_in_executor(None, self.set, key, response)
+
+    def revalidate(self, key: str, fetch: Callable[[], Optional[Any]]) -> None:
+        """Refresh the stale entry in a background thread, once at a time per key.
+
+        The response returned by fetch is stored, None keeps the stale entry.
+        """
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def _refresh() -> None:
+            try:
+                response = fetch()
+                if response is not None:
+                    self.set(key, response)
+            except Exception as e:
+                logger.warning("Revalidating the cached response failed: %s", e)
+            finally:
+                with self._lock:
+                    self._revalidating.discard(key)
+
+        threading.Thread(target=_refresh, daemon=True).start()
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of hits, stale hits, misses and in-memory entries."""
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "stale_hits": self._stale_hits,
+                "misses": self._misses,
+                "entries": len(self._entries),
+            }
+
+    def clear(self) -> None:
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._hits = self._stale_hits = self._misses = 0
+        if self.path is not None:
+            connection = self._connection()
+            with connection:
+                connection.execute("DELETE FROM responses")
+
+
+class SemanticCache:
+    """Semantic cache of chat responses.
+
+    The final user message is embedded and compared with the questions answered
+    before in the same scope, i.e. with the same parameters and preceding
+    messages. The response to the most similar question is returned if their
+    cosine similarity reaches the threshold.
+
+    The normalized question embeddings are kept in one preallocated float32
+    matrix, so a lookup is a single matrix-vector product. Once max_entries
+    questions are cached, the least recently used one is replaced.
+
+    Example:
+        .. code-block:: python
+
+            from saplangchainproxy.cache import SemanticCache
+            from saplangchainproxy.chat import SAPChatOpenAI
+            from saplangchainproxy.embeddings import SAPOpenAIEmbeddings
+
+            chat = SAPChatOpenAI(
+                temperature=0,
+                semantic_cache=SemanticCache(SAPOpenAIEmbeddings(), threshold=0.95),
+            )
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        threshold: float = 0.95,
+        max_entries: int = 10_000,
+    ):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # allocated on the first update, once the dimension is known
+        self._vectors: Optional[np.ndarray] = None
+        self._scopes = np.full(max_entries, -1, dtype=np.int64)
+        self._last_used = np.zeros(max_entries)
+        self._responses: List[Any] = [None] * max_entries
+        self._scope_ids: Dict[str, int] = {}
+        self._next_scope_id = 0
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def scope(params: Dict[str, Any], messages: List[Dict[str, Any]]) -> str:
+        """Get the scope of the request parameters and the preceding messages."""
+        return canonical_hash({"params": params, "messages": messages})
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[np.ndarray]:
+        """Get the unit vector of the embedding, None for a zero embedding."""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm or not np.isfinite(norm):
+            return None
+        return vector / norm
+
+    def _search(self, scope: str, vector: Optional[np.ndarray]) -> Optional[Any]:
+        with self._lock:
+            scope_id = self._scope_ids.get(scope)
+            response = None
+            # a zero embedding is similar to nothing
+            if scope_id is not None and self._vectors is not None and vector is not None:
+                similarities = self._vectors[: self._size] @ vector
+                similarities[self._scopes[: self._size] != scope_id] = -np.inf
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    response = self._responses[best]
+                    self._last_used[best] = time.monotonic()
+            if response is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+            return response
+
+    def lookup(self, scope: str, text: str) -> Tuple[Optional[Any], Optional[np.ndarray]]:
+        """Get the cached response to the question most similar to the text.
+
+        Returns the response, None on a miss, and the embedding of the text to
+        pass to update, None if the text has a zero embedding.
+        """
+        vector = self._normalize(self.embeddings.embed_query(text))
+        return self._search(scope, vector), vector
+
+    async def alookup(self, scope: str, text: str) -> Tuple[Optional[Any], Optional[np.ndarray]]:
+        """Get the cached response to the question most similar to the text."""
+        vector = self._normalize(await self.embeddings.aembed_query(text))
+        return self._search(scope, vector), vector
+
+    def update(self, scope: str, vector: Optional[np.ndarray], response: Any) -> None:
+        """Cache the response to the question with the embedding vector."""
+        if vector is None:
+            return
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros(
+                    (self.max_entries, len(vector)), dtype=np.float32
+                )
+            if self._size < self.max_entries:
+                row = self._size
+                self._size += 1
+            else:
+                row = int(np.argmin(self._last_used))
+            scope_id = self._scope_ids.get(scope)
+            if scope_id is None:
+                scope_id = self._scope_ids[scope] = self._next_scope_id
+                self._next_scope_id += 1
+            self._vectors[row] = vector
+            self._scopes[row] = scope_id
+            self._responses[row] = response
+            self._last_used[row] = time.monotonic()
+            # forget the scopes of evicted entries
+            if len(self._scope_ids) > 2 * self._size:
+                live = set(self._scopes[: self._size].tolist())
+                self._scope_ids = {
+                    s: i for s, i in self._scope_ids.items() if i in live
+                }
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of the lookups answered from the cache."""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return self._hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the number of hits, misses, entries and the hit rate."""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "entries": self._size,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self) -> None:
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._vectors = None
+            self._scopes[:] = -1
+            self._last_used[:] = 0
+            self._responses = [None] * self.max_entries
+            self._scope_ids = {}
+            self._next_scope_id = 0
+            self._size = self._hits = self._misses = 0
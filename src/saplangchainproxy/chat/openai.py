@@ -3,6 +3,7 @@ from __future__ import annotations
 
 import logging
 import sys
+import time
 from typing import (
     TYPE_CHECKING,
     Any,
@@ -11,6 +12,7 @@ from typing import (
     Dict,
     Iterator,
     List,
+    Literal,
     Mapping,
     Optional,
     Tuple,
@@ -23,7 +25,6 @@ from langchain.callbacks.manager import (
     CallbackManagerForLLMRun,
 )
 from langchain.chat_models.base import BaseChatModel
-from langchain.llms.base import create_base_retry_decorator
 from langchain.pydantic_v1 import Field, root_validator
 from langchain.schema import ChatGeneration, ChatResult
 from langchain.schema.messages import (
@@ -38,41 +39,28 @@ from langchain.schema.messages import (
 from langchain.schema.output import ChatGenerationChunk
 from langchain.utils import get_from_dict_or_env, get_pydantic_field_names
 
+from saplangchainproxy import deployments, tokenizer
+from saplangchainproxy.cache import ResponseCache, SemanticCache
+from saplangchainproxy.retry import create_retry_decorator
+from saplangchainproxy.routing import Router
+
 if TYPE_CHECKING:
     import tiktoken
 
 logger = logging.getLogger(__name__)
 
 
-def _import_tiktoken() -> Any:
-    try:
-        import tiktoken
-    except ImportError:
-        raise ValueError(
-            "Could not import tiktoken python package. "
-            "This is needed in order to calculate get_token_ids. "
-            "Please install it with `pip install tiktoken`."
-        )
-    return tiktoken
-
-
 def _create_retry_decorator(
     llm: SAPChatOpenAI,
     run_manager: Optional[
         Union[AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun]
     ] = None,
 ) -> Callable[[Any], Any]:
-    import openai
-
-    errors = [
-        openai.error.Timeout,
-        openai.error.APIError,
-        openai.error.APIConnectionError,
-        openai.error.RateLimitError,
-        openai.error.ServiceUnavailableError,
-    ]
-    return create_base_retry_decorator(
-        error_types=errors, max_retries=llm.max_retries, run_manager=run_manager
+    return create_retry_decorator(
+        max_retries=llm.max_retries,
+        run_manager=run_manager,
+        deadline=llm.retry_deadline,
+        total_timeout=llm.total_timeout,
     )
 
 
@@ -83,6 +71,12 @@ async def acompletion_with_retry(
 ) -> Any:
     """Use tenacity to retry the async completion call."""
     retry_decorator = _create_retry_decorator(llm, run_manager=run_manager)
+    if llm.total_timeout is not None:
+        kwargs["deadline"] = time.monotonic() + llm.total_timeout
+    if llm.context_routing:
+        kwargs["model"] = deployments.pick_deployment(
+            kwargs, llm.context_routing, llm.context_routing_preference
+        )
 
     @retry_decorator
     async def _completion_with_retry(**kwargs: Any) -> Any:
@@ -160,9 +154,52 @@ class SAPChatOpenAI(BaseChatModel):
     # to support explicit proxy for OpenAI
     openai_proxy: Optional[str] = None
     request_timeout: Optional[Union[float, Tuple[float, float]]] = None
-    """Timeout for requests to OpenAI completion API. Default is 600 seconds."""
+    """Timeout in seconds of the requests to the proxy, a number or a (connect, read)
+    tuple. Default is 10 seconds to connect and 600 seconds to read."""
+    stream_timeout: Optional[float] = None
+    """Maximum seconds to wait for the next chunk of a streamed response. Default is
+    the read timeout."""
+    total_timeout: Optional[float] = None
+    """Seconds a call may take in total, including waiting for the token and all
+    retries. Exceeding it raises sapwrapper.Timeout."""
     max_retries: int = 6
     """Maximum number of retries to make when generating."""
+    retry_deadline: Optional[float] = None
+    """Seconds after the first attempt after which no retry starts."""
+    pool_connections: int = 10
+    """Number of upstream connection pools to cache in the shared HTTP session."""
+    pool_maxsize: int = 10
+    """Maximum number of keep-alive connections to keep per upstream host."""
+    async_pool_maxsize: int = 100
+    """Maximum number of concurrent connections per upstream host for async calls."""
+    coalesce_requests: bool = False
+    """Whether identical requests in flight share one call to the proxy."""
+    requests_per_minute: Optional[int] = None
+    """Requests per minute budget of the deployment, shared within the process."""
+    tokens_per_minute: Optional[int] = None
+    """Tokens per minute budget of the deployment, shared within the process."""
+    endpoints: Optional[List[Dict[str, Any]]] = None
+    """Proxy endpoints to balance the requests over, dicts with api_url, client_id,
+    client_secret and token_url. Replaces the single endpoint when given."""
+    load_balancing: Literal["least_outstanding", "ewma"] = "least_outstanding"
+    """How to pick the endpoint of a request: least outstanding requests or the
+    lowest latency average weighted by the outstanding requests."""
+    hedge_percentile: Optional[float] = None
+    """Percentile of the recent latencies, e.g. 95, after which a non-streaming
+    request is sent once more. The first response wins. Disabled by default."""
+    hedge_budget: float = 0.1
+    """Maximum share of extra requests hedging may add."""
+    context_routing: Optional[List[str]] = None
+    """Deployment ids to choose from per request, e.g. ["gpt-4", "gpt-4-32k"]. Each
+    request goes to the cheapest of them whose context fits the prompt plus
+    max_tokens, see saplangchainproxy.deployments. Disabled by default."""
+    context_routing_preference: Literal["cost", "latency"] = "cost"
+    """Whether context routing prefers the cheaper or the faster deployment."""
+    response_cache: Optional[ResponseCache] = None
+    """Exact-match cache of the responses of the proxy, disabled by default."""
+    semantic_cache: Optional[SemanticCache] = None
+    """Cache answering paraphrased questions, disabled by default. It applies to
+    non-streaming requests for one completion of a final user message."""
     streaming: bool = False
     """Whether to stream the results or not."""
     n: int = 1
@@ -184,6 +221,7 @@ class SAPChatOpenAI(BaseChatModel):
         """Configuration for this pydantic object."""
 
         allow_population_by_field_name = True
+        arbitrary_types_allowed = True
 
     @root_validator(pre=True)
     def build_extra(cls, values: Dict[str, Any]) -> Dict[str, Any]:
@@ -217,7 +255,8 @@ class SAPChatOpenAI(BaseChatModel):
         values["openai_api_client_id"] = get_from_dict_or_env(
             values,
             "openai_api_client_id", 
-            "OPENAI_CLIENTID"
+            "OPENAI_CLIENTID",
+            default="" if values["endpoints"] else None,
         )
         values["openai_api_client_secret"] = get_from_dict_or_env(
             values,
@@ -250,14 +289,44 @@ class SAPChatOpenAI(BaseChatModel):
                 "Could not import sapopenaiwrapper python package. "
                 "Check path of you project directory."
             )     
-        try:
-            values["client"] = sapwrapper.ChatCompletion          
-        except AttributeError:
-            raise ValueError(
-                "`openai` has no `ChatCompletion` attribute, this is likely "
-                "due to an old version of the openai package. Try upgrading it "
-                "with `pip install --upgrade openai`."
+        options = dict(
+            pool_connections=values["pool_connections"],
+            pool_maxsize=values["pool_maxsize"],
+            async_pool_maxsize=values["async_pool_maxsize"],
+            coalesce_requests=values["coalesce_requests"],
+            requests_per_minute=values["requests_per_minute"],
+            tokens_per_minute=values["tokens_per_minute"],
+            response_cache=values["response_cache"],
+        )
+        if values["endpoints"]:
+            clients = [
+                sapwrapper.ChatCompletion(**endpoint, **options)
+                for endpoint in values["endpoints"]
+            ]
+        else:
+            clients = [
+                sapwrapper.ChatCompletion(
+                    api_url=values["openai_api_url"],
+                    client_id=values["openai_api_client_id"],
+                    client_secret=values["openai_api_client_secret"],
+                    token_url=values["openai_api_tokenurl"],
+                    **options,
+                )
+            ]
+        if values["endpoints"] or values["hedge_percentile"] is not None:
+            values["client"] = Router(
+                clients,
+                strategy=values["load_balancing"],
+                hedge_percentile=values["hedge_percentile"],
+                hedge_budget=values["hedge_budget"],
+                # a single endpoint wrapped for hedging has nothing to fail over to
+                circuit_breaker=bool(values["endpoints"]),
             )
+        else:
+            values["client"] = clients[0]
+        for deployment in values["context_routing"] or []:
+            # fails for deployments without known capabilities
+            deployments.context_size(deployment)
         if values["n"] < 1:
             raise ValueError("n must be at least 1.")
         if values["n"] > 1 and values["streaming"]:
@@ -270,6 +339,7 @@ class SAPChatOpenAI(BaseChatModel):
         return {
             "model": self.model_name,
             "request_timeout": self.request_timeout,
+            "stream_timeout": self.stream_timeout,
             "max_tokens": self.max_tokens,
             "stream": self.streaming,
             "n": self.n,
@@ -282,6 +352,12 @@ class SAPChatOpenAI(BaseChatModel):
     ) -> Any:
         """Use tenacity to retry the completion call."""
         retry_decorator = _create_retry_decorator(self, run_manager=run_manager)
+        if self.total_timeout is not None:
+            kwargs["deadline"] = time.monotonic() + self.total_timeout
+        if self.context_routing:
+            kwargs["model"] = deployments.pick_deployment(
+                kwargs, self.context_routing, self.context_routing_preference
+            )
 
         @retry_decorator
         def _completion_with_retry(**kwargs: Any) -> Any:
@@ -354,11 +430,46 @@ class SAPChatOpenAI(BaseChatModel):
 
         message_dicts, params = self._create_message_dicts(messages, stop)
         params = {**params, **kwargs}
+        query = self._semantic_query(message_dicts, params)
+        if query is not None:
+            try:
+                cached, vector = self.semantic_cache.lookup(*query)
+            except Exception as e:
+                logger.warning("Semantic cache lookup failed, skipping the cache: %s", e)
+                query = None
+            else:
+                if cached is not None:
+                    return self._create_chat_result(cached)
         response = self.completion_with_retry(
             messages=message_dicts, run_manager=run_manager, **params
         )
+        if query is not None and "choices" in response:
+            self._semantic_update(query[0], vector, response)
         return self._create_chat_result(response)
 
+    def _semantic_update(
+        self, scope: str, vector: Any, response: Dict[str, Any]
+    ) -> None:
+        try:
+            # hits don't use tokens, so only the choices are cached
+            self.semantic_cache.update(scope, vector, {"choices": response["choices"]})
+        except Exception as e:
+            logger.warning("Semantic cache update failed: %s", e)
+
+    def _semantic_query(
+        self, message_dicts: List[Dict[str, Any]], params: Dict[str, Any]
+    ) -> Optional[Tuple[str, str]]:
+        """Get the scope and the question to look up in the semantic cache."""
+        if (
+            self.semantic_cache is None
+            or params.get("n", 1) != 1
+            or not message_dicts
+            or message_dicts[-1]["role"] != "user"
+        ):
+            return None
+        scope = self.semantic_cache.scope(params, message_dicts[:-1])
+        return scope, message_dicts[-1]["content"]
+
     def _create_message_dicts(
         self, messages: List[BaseMessage], stop: Optional[List[str]]
     ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
@@ -434,9 +545,21 @@ class SAPChatOpenAI(BaseChatModel):
 
         message_dicts, params = self._create_message_dicts(messages, stop)
         params = {**params, **kwargs}
+        query = self._semantic_query(message_dicts, params)
+        if query is not None:
+            try:
+                cached, vector = await self.semantic_cache.alookup(*query)
+            except Exception as e:
+                logger.warning("Semantic cache lookup failed, skipping the cache: %s", e)
+                query = None
+            else:
+                if cached is not None:
+                    return self._create_chat_result(cached)
         response = await acompletion_with_retry(
             self, messages=message_dicts, run_manager=run_manager, **params
         )
+        if query is not None and "choices" in response:
+            self._semantic_update(query[0], vector, response)
         return self._create_chat_result(response)
 
     @property
@@ -448,10 +571,6 @@ class SAPChatOpenAI(BaseChatModel):
     def _client_params(self) -> Dict[str, Any]:
         """Get the parameters used for the openai client."""
         openai_creds: Dict[str, Any] = {
-            "openai_api_client_id": self.openai_api_client_id,
-            "openai_api_client_secret": self.openai_api_client_secret,
-            "openai_api_tokenurl": self.openai_api_tokenurl,
-            "openai_api_url": self.openai_api_url,
             "model": self.model_name,
         }
         if self.openai_proxy:
@@ -477,11 +596,10 @@ class SAPChatOpenAI(BaseChatModel):
         return "sapopenai-chat"
 
     def _get_encoding_model(self) -> Tuple[str, tiktoken.Encoding]:
-        tiktoken_ = _import_tiktoken()
         if self.tiktoken_model_name is not None:
             model = self.tiktoken_model_name
         else:
-            model = self.model_name
+            model = tokenizer.tiktoken_model_name(self.model_name)
             if model == "gpt-3.5-turbo":
                 # gpt-3.5-turbo may change over time.
                 # Returning num tokens assuming gpt-3.5-turbo-0301.
@@ -490,14 +608,7 @@ class SAPChatOpenAI(BaseChatModel):
                 # gpt-4 may change over time.
                 # Returning num tokens assuming gpt-4-0314.
                 model = "gpt-4-0314"
-        # Returns the number of tokens used by a list of messages.
-        try:
-            encoding = tiktoken_.encoding_for_model(model)
-        except KeyError:
-            logger.warning("Warning: model not found. Using cl100k_base encoding.")
-            model = "cl100k_base"
-            encoding = tiktoken_.get_encoding(model)
-        return model, encoding
+        return tokenizer.get_encoding_model(model)
 
     def get_token_ids(self, text: str) -> List[int]:
         """Get the tokens present in the text with tiktoken package."""
@@ -534,12 +645,12 @@ class SAPChatOpenAI(BaseChatModel):
         messages_dict = [convert_message_to_dict(m) for m in messages]
         for message in messages_dict:
             num_tokens += tokens_per_message
-            for key, value in message.items():
-                # Cast str(value) in case the message value is not a string
-                # This occurs with function messages
-                num_tokens += len(encoding.encode(str(value)))
-                if key == "name":
-                    num_tokens += tokens_per_name
+            if "name" in message:
+                num_tokens += tokens_per_name
+        # Cast str(value) in case the message value is not a string
+        # This occurs with function messages
+        values = [str(value) for message in messages_dict for value in message.values()]
+        num_tokens += sum(len(token) for token in tokenizer.encode_batch(encoding, values))
         # every reply is primed with <im_start>assistant
         num_tokens += 3
         return num_tokens
\ No newline at end of file
@@ -0,0 +1,168 @@
+"""JSON codec of the requests to and the responses from the SAP AI proxy."""
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+# Responses from this size on are decoded in pieces in a worker thread under asyncio,
+# below it the thread handoff costs more than decoding on the event loop
+ASYNC_DECODE_MIN_BYTES = 256 * 1024
+
+
+class Codec(NamedTuple):
+    """Serializes the request payloads to bytes and parses the response bodies.
+
+    loads gets bytes or str and raises a ValueError for invalid JSON.
+    """
+
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[Union[bytes, str]], Any]
+
+
+def _json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+JSON_CODEC = Codec("json", _json_dumps, json.loads)
+
+
+def _orjson_codec() -> Optional[Codec]:
+    try:
+        import orjson
+    except ImportError:
+        return None
+    # numpy arrays and int keys, e.g. of logit_bias, as the json module does
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    return Codec("orjson", lambda obj: orjson.dumps(obj, option=option), orjson.loads)
+
+
+# None if orjson is not installed
+ORJSON_CODEC = _orjson_codec()
+
+_codec: Codec = ORJSON_CODEC or JSON_CODEC
+
+
+def get_codec() -> Codec:
+    """Get the codec used by the clients of the process."""
+    return _codec
+
+
+def set_codec(codec: Codec) -> None:
+    """Use the codec for all clients of the process, e.g. JSON_CODEC to not use
+    orjson or a codec of another library."""
+    global _codec
+    _codec = codec
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialize the payload to JSON bytes."""
+    return _codec.dumps(obj)
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Parse the JSON bytes or text."""
+    return _codec.loads(data)
+
+
+_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_DEEP = (b'"', b"[", b"]", b"{", b"}")
+# commas and colons are only of interest close to the top
+_SHALLOW = _DEEP + (b",", b":")
+
+
+class _Tokens:
+    """Finds the strings and structural characters of a JSON document.
+
+    The next position of every character is remembered and only searched again
+    once it was passed, so a long stretch of numbers is skipped at memchr speed.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self._next = {char: -2 for char in _SHALLOW}
+
+    def next(self, pos: int, chars: Tuple[bytes, ...]) -> Tuple[int, int]:
+        """Get the start and end of the first token of the chars from pos on."""
+        start = -1
+        for char in chars:
+            at = self._next[char]
+            if -1 < at < pos or at == -2:
+                at = self._next[char] = self.data.find(char, pos)
+            if at != -1 and (start == -1 or at < start):
+                start = at
+        if start == -1:
+            raise ValueError("Unterminated JSON object")
+        if self.data[start : start + 1] == b'"':
+            match = _STRING.match(self.data, start)
+            if match is None:
+                raise ValueError("Unterminated JSON string")
+            return start, match.end()
+        return start, start + 1
+
+
+def _loads_in_pieces(data: bytes, loads: Callable[[bytes], Any]) -> Any:
+    """Parse a JSON object member by member and the items of its arrays one by one.
+
+    The decoders hold the GIL for a whole call, so decoding a large response at
+    once in a worker thread would still block the event loop. Between the pieces
+    the worker hands the GIL back. Anything but an object is parsed at once.
+    """
+    pos = _WHITESPACE.match(data).end()
+    if data[pos : pos + 1] != b"{":
+        return loads(data)
+    pos += 1
+    tokens = _Tokens(data)
+    result: Dict[str, Any] = {}
+    depth = 1
+    key: Optional[str] = None
+    valueStart = itemStart = pos
+    items: Optional[List[Any]] = None
+    while depth:
+        start, pos = tokens.next(pos, _SHALLOW if depth <= 2 else _DEEP)
+        token = data[start:pos]
+        if depth == 1:
+            if token in (b",", b"}"):
+                # the member ends, unless it was an array parsed item by item
+                if key is not None:
+                    result[key] = loads(data[valueStart : start])
+                    key = None
+                if token == b"}":
+                    depth = 0
+            elif token == b":":
+                valueStart = pos
+            elif token == b"[" and not data[valueStart : start].strip():
+                items, itemStart = [], pos
+                depth += 1
+            elif token in (b"[", b"{"):
+                depth += 1
+            elif key is None:
+                key = loads(token)
+        elif depth == 2 and items is not None and token in (b",", b"]"):
+            if token == b"," or items or data[itemStart : start].strip():
+                items.append(loads(data[itemStart : start]))
+            itemStart = pos
+            if token == b"]":
+                result[key], key, items = items, None, None
+                depth -= 1
+        elif token in (b"[", b"{"):
+            depth += 1
+        elif token in (b"]", b"}"):
+            depth -= 1
+    if data[pos:].strip():
+        raise ValueError("Extra data after the JSON object")
+    return result
+
+
+async def aloads(data: bytes) -> Any:
+    """Parse the JSON bytes, large ones in pieces in a worker thread so the event
+    loop keeps serving the other tasks meanwhile."""
+    codec = _codec
+    if len(data) < ASYNC_DECODE_MIN_BYTES:
+        return codec.loads(data)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, _loads_in_pieces, data, codec.loads
+    )
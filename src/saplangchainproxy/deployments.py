@@ -0,0 +1,127 @@
+"""Capabilities of the SAP AI proxy deployments and the OpenAI models."""
+from __future__ import annotations
+
+from typing import Any, Dict, List, Literal, NamedTuple, Sequence
+
+from saplangchainproxy import tokenizer
+
+
+class Deployment(NamedTuple):
+    """What a deployment or model can do and what it costs.
+
+    context_size is the maximum tokens of the prompt and the completion together,
+    latency the typical latency relative to gpt-35-turbo and cost the list price
+    in USD per 1k prompt tokens, only used to compare deployments.
+    """
+
+    context_size: int
+    latency: float
+    cost: float
+
+
+# Latency and cost are rough estimates for picking a deployment, edit or add
+# entries to match your own deployments.
+DEPLOYMENTS: Dict[str, Deployment] = {
+    # SAP deployment ids
+    "gpt-35-turbo": Deployment(4096, 1.0, 0.0015),
+    "gpt-35-turbo-16k": Deployment(16385, 1.0, 0.003),
+    "gpt-4": Deployment(8192, 3.0, 0.03),
+    "gpt-4-32k": Deployment(32768, 3.5, 0.06),
+    "text-davinci-003": Deployment(4097, 1.5, 0.02),
+    "code-davinci-002": Deployment(8001, 1.5, 0.02),
+    "alephalpha": Deployment(2048, 1.0, 0.03),
+    "bloom-7b1": Deployment(2048, 1.5, 0.01),
+    "gptj-full": Deployment(2048, 1.5, 0.01),
+    "gcp-text-bison-001": Deployment(8192, 1.0, 0.001),
+    "text-embedding-ada-002-v2": Deployment(8191, 0.5, 0.0001),
+    # OpenAI model names
+    "gpt-4-0314": Deployment(8192, 3.0, 0.03),
+    "gpt-4-0613": Deployment(8192, 3.0, 0.03),
+    "gpt-4-32k-0314": Deployment(32768, 3.5, 0.06),
+    "gpt-4-32k-0613": Deployment(32768, 3.5, 0.06),
+    "gpt-3.5-turbo": Deployment(4096, 1.0, 0.0015),
+    "gpt-3.5-turbo-0301": Deployment(4096, 1.0, 0.0015),
+    "gpt-3.5-turbo-0613": Deployment(4096, 1.0, 0.0015),
+    "gpt-3.5-turbo-16k": Deployment(16385, 1.0, 0.003),
+    "gpt-3.5-turbo-16k-0613": Deployment(16385, 1.0, 0.003),
+    "text-ada-001": Deployment(2049, 0.5, 0.0004),
+    "ada": Deployment(2049, 0.5, 0.0004),
+    "text-babbage-001": Deployment(2040, 0.5, 0.0005),
+    "babbage": Deployment(2049, 0.5, 0.0005),
+    "text-curie-001": Deployment(2049, 1.0, 0.002),
+    "curie": Deployment(2049, 1.0, 0.002),
+    "davinci": Deployment(2049, 1.5, 0.02),
+    "text-davinci-002": Deployment(4097, 1.5, 0.02),
+    "code-davinci-001": Deployment(8001, 1.5, 0.02),
+    "code-cushman-002": Deployment(2048, 1.0, 0.002),
+    "code-cushman-001": Deployment(2048, 1.0, 0.002),
+    "text-embedding-ada-002": Deployment(8191, 0.5, 0.0001),
+}
+
+
+def context_size(model: str) -> int:
+    """Get the context size of the deployment id or model name."""
+    # handling finetuned models
+    if "ft-" in model:
+        model = model.split(":")[0]
+    deployment = DEPLOYMENTS.get(model)
+    if deployment is None:
+        raise ValueError(
+            f"Unknown model: {model}. Please provide a valid OpenAI model name or "
+            "SAP deployment id. Known models are: " + ", ".join(DEPLOYMENTS.keys())
+        )
+    return deployment.context_size
+
+
+def _prompt_tokens(kwargs: Dict[str, Any], encoding: Any) -> int:
+    """Tokens of the messages, or of the largest prompt, of the request."""
+    if "messages" in kwargs:
+        # every message is wrapped in 3 tokens, every reply primed with 3
+        values = [
+            [str(value) for value in message.values() if value is not None]
+            for message in kwargs["messages"]
+        ]
+        tokens = tokenizer.encode_batch(
+            encoding, [value for message in values for value in message], disallowed_special=()
+        )
+        return 3 + 3 * len(values) + sum(len(t) for t in tokens)
+    prompt = kwargs.get("prompt", "")
+    # a single prompt, as text or token array
+    if isinstance(prompt, str) or (prompt and isinstance(prompt[0], int)):
+        prompt = [prompt]
+    texts = [p for p in prompt if isinstance(p, str)]
+    tokens = tokenizer.encode_batch(encoding, texts, disallowed_special=())
+    return max(
+        [len(t) for t in tokens] + [len(p) for p in prompt if not isinstance(p, str)],
+        default=0,
+    )
+
+
+def pick_deployment(
+    kwargs: Dict[str, Any],
+    deployments: Sequence[str],
+    prefer: Literal["cost", "latency"] = "cost",
+) -> str:
+    """Pick the deployment whose context fits the request.
+
+    The prompt, or each prompt of a multi-prompt request, plus max_tokens must
+    fit the context size. Of the deployments that fit, the cheapest is picked,
+    the faster one on a tie, or the other way round if latency is preferred.
+    If none fits the one with the largest context gets the request, which the
+    proxy then rejects unless the local count was too high.
+    """
+    max_tokens = kwargs.get("max_tokens") or 0
+    counts: Dict[str, int] = {}
+    fitting: List[str] = []
+    for deployment in deployments:
+        encoding = tokenizer.get_encoding(deployment)
+        # deployments of one family share the count
+        if encoding.name not in counts:
+            counts[encoding.name] = _prompt_tokens(kwargs, encoding)
+        if counts[encoding.name] + max(max_tokens, 0) <= context_size(deployment):
+            fitting.append(deployment)
+    if not fitting:
+        return max(deployments, key=context_size)
+    if prefer == "latency":
+        return min(fitting, key=lambda d: (DEPLOYMENTS[d].latency, DEPLOYMENTS[d].cost))
+    return min(fitting, key=lambda d: (DEPLOYMENTS[d].cost, DEPLOYMENTS[d].latency))
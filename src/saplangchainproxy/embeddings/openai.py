@@ -1,7 +1,11 @@
 """Wrapper around OpenAI embedding models."""
 from __future__ import annotations
 
+import asyncio
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import (
     Any,
     Callable,
@@ -17,45 +21,42 @@ from typing import (
 
 import numpy as np
 from pydantic import BaseModel, Extra, root_validator
-from tenacity import (
-    before_sleep_log,
-    retry,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_exponential,
-)
 
 from langchain.embeddings.base import Embeddings
 from langchain.utils import get_from_dict_or_env
 
+from saplangchainproxy import tokenizer
+from saplangchainproxy.batching import AsyncMicroBatcher, MicroBatcher
+from saplangchainproxy.cache import SQLiteEmbeddingCache
+from saplangchainproxy.retry import create_retry_decorator
+from saplangchainproxy.routing import Router
+from saplangchainproxy.sapwrapper import InvalidRequestError
+
 logger = logging.getLogger(__name__)
 
+# Normalized embeddings of the empty text by proxy and deployment, texts without
+# tokens all share it, so it is fetched once for the lifetime of the process
+_empty_embeddings: Dict[Tuple[str, str], List[float]] = {}
+# One fetch per key at a time, a slow deployment does not hold up the others
+_empty_embedding_locks: Dict[Tuple[str, str], threading.Lock] = {}
+_empty_embeddings_lock = threading.Lock()
+# Guards the lazy creation of the query batchers of the models
+_batchers_lock = threading.Lock()
+
 
 def _create_retry_decorator(embeddings: SAPOpenAIEmbeddings) -> Callable[[Any], Any]:
-    import openai
-
-    min_seconds = 4
-    max_seconds = 10
-    # Wait 2^x * 1 second between each retry starting with
-    # 4 seconds, then up to 10 seconds, then 10 seconds afterwards
-    return retry(
-        reraise=True,
-        stop=stop_after_attempt(embeddings.max_retries),
-        wait=wait_exponential(multiplier=1, min=min_seconds, max=max_seconds),
-        retry=(
-            retry_if_exception_type(openai.error.Timeout)
-            | retry_if_exception_type(openai.error.APIError)
-            | retry_if_exception_type(openai.error.APIConnectionError)
-            | retry_if_exception_type(openai.error.RateLimitError)
-            | retry_if_exception_type(openai.error.ServiceUnavailableError)
-        ),
-        before_sleep=before_sleep_log(logger, logging.WARNING),
+    return create_retry_decorator(
+        max_retries=embeddings.max_retries,
+        deadline=embeddings.retry_deadline,
+        total_timeout=embeddings.total_timeout,
     )
 
 
 def embed_with_retry(embeddings: SAPOpenAIEmbeddings, **kwargs: Any) -> Any:
     """Use tenacity to retry the embedding call."""
     retry_decorator = _create_retry_decorator(embeddings)
+    if embeddings.total_timeout is not None:
+        kwargs["deadline"] = time.monotonic() + embeddings.total_timeout
 
     @retry_decorator
     def _embed_with_retry(**kwargs: Any) -> Any:
@@ -64,6 +65,110 @@ def embed_with_retry(embeddings: SAPOpenAIEmbeddings, **kwargs: Any) -> Any:
     return _embed_with_retry(**kwargs)
 
 
+async def aembed_with_retry(embeddings: SAPOpenAIEmbeddings, **kwargs: Any) -> Any:
+    """Use tenacity to retry the async embedding call."""
+    retry_decorator = _create_retry_decorator(embeddings)
+    if embeddings.total_timeout is not None:
+        kwargs["deadline"] = time.monotonic() + embeddings.total_timeout
+
+    @retry_decorator
+    async def _aembed_with_retry(**kwargs: Any) -> Any:
+        return await embeddings.client.acreate(**kwargs)
+
+    return await _aembed_with_retry(**kwargs)
+
+
+def _pack_batches(
+    tokens: Sequence[Sequence[int]],
+    max_inputs: int,
+    max_tokens: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> List[Tuple[int, int]]:
+    """Pack the token chunks in order into batches, given as (start, end) ranges.
+
+    A batch holds at most max_inputs chunks, max_tokens tokens and max_bytes bytes
+    of JSON encoded token arrays. A chunk exceeding a budget on its own gets a
+    batch of its own.
+    """
+    if max_tokens is None and max_bytes is None:
+        return [
+            (i, min(i + max_inputs, len(tokens)))
+            for i in range(0, len(tokens), max_inputs)
+        ]
+    ranges = []
+    # the brackets of the input list, which has one separator less than chunks
+    start, batch_tokens, batch_bytes = 0, 0, 1
+    for i, chunk in enumerate(tokens):
+        chunk_tokens = len(chunk)
+        # compact JSON of the chunk: the digits, a comma between the ints and the
+        # brackets, plus its separator in the input list
+        chunk_bytes = (
+            sum(len(str(t)) for t in chunk) + len(chunk) + 2
+            if max_bytes is not None
+            else 0
+        )
+        if i > start and (
+            i - start >= max_inputs
+            or (max_tokens is not None and batch_tokens + chunk_tokens > max_tokens)
+            or (max_bytes is not None and batch_bytes + chunk_bytes > max_bytes)
+        ):
+            ranges.append((start, i))
+            start, batch_tokens, batch_bytes = i, 0, 1
+        batch_tokens += chunk_tokens
+        batch_bytes += chunk_bytes
+    if start < len(tokens):
+        ranges.append((start, len(tokens)))
+    return ranges
+
+
+def _too_large(error: InvalidRequestError) -> bool:
+    """Whether the proxy rejected the request for its size."""
+    message = str(error).lower()
+    return (
+        error.status_code == 413 or "too large" in message or "too many" in message
+    )
+
+
+def _average_chunk_embeddings(
+    num_texts: int,
+    indices: Sequence[int],
+    num_tokens: Sequence[int],
+    chunk_embeddings: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Average the chunk embeddings of each text weighted by their number of tokens
+    and normalize the averages.
+
+    chunk_embeddings is scaled in place. The chunks of a text are consecutive, so
+    the weighted sums are accumulated by the position of the chunks within their
+    text, which takes as many vectorized steps as the longest text has chunks.
+    Dividing by the sum of the weights is left out as the rows are normalized
+    afterwards.
+
+    Returns:
+        The (num_texts, dim) embeddings and the mask of the texts without chunks,
+        their rows are left zero.
+    """
+    embeddings = np.zeros(
+        (num_texts, chunk_embeddings.shape[1]), dtype=chunk_embeddings.dtype
+    )
+    _indices = np.asarray(indices, dtype=np.intp)
+    empty_rows = np.bincount(_indices, minlength=num_texts) == 0
+    if len(_indices) == 0:
+        return embeddings, empty_rows
+    chunk_embeddings *= np.asarray(num_tokens, dtype=chunk_embeddings.dtype)[:, None]
+    starts = np.flatnonzero(np.r_[True, _indices[1:] != _indices[:-1]])
+    positions = np.arange(len(_indices)) - np.repeat(
+        starts, np.diff(np.r_[starts, len(_indices)])
+    )
+    for position in range(positions.max() + 1):
+        # every text has at most one chunk at the position
+        chunks = positions == position
+        embeddings[_indices[chunks]] += chunk_embeddings[chunks]
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.divide(embeddings, norms, out=embeddings, where=~empty_rows[:, None])
+    return embeddings, empty_rows
+
+
 class SAPOpenAIEmbeddings(BaseModel, Embeddings):
     """Wrapper around OpenAI embedding models.
 
@@ -118,42 +223,90 @@ class SAPOpenAIEmbeddings(BaseModel, Embeddings):
     embedding_ctx_length: int = 8191
     openai_api_key: Optional[str] = None
     openai_organization: Optional[str] = None
+    """ SAP specific authentication data."""
+    openai_api_client_id: Optional[str] = None
+    openai_api_client_secret: Optional[str] = None
+    openai_api_tokenurl: Optional[str] = None
+    openai_api_url: Optional[str] = None
     allowed_special: Union[Literal["all"], Set[str]] = set()
     disallowed_special: Union[Literal["all"], Set[str], Sequence[str]] = "all"
     chunk_size: int = 1000
     """Maximum number of texts to embed in each batch"""
+    max_batch_tokens: Optional[int] = None
+    """Maximum number of tokens of the inputs of one request."""
+    max_batch_bytes: Optional[int] = None
+    """Maximum size in bytes of the JSON encoded inputs of one request."""
+    max_concurrency: int = 1
+    """Maximum number of batches to send to the proxy in parallel."""
     max_retries: int = 6
     """Maximum number of retries to make when generating."""
+    retry_deadline: Optional[float] = None
+    """Seconds after the first attempt after which no retry starts."""
     request_timeout: Optional[Union[float, Tuple[float, float]]] = None
-    """Timeout in seconds for the OpenAPI request."""
+    """Timeout in seconds of the requests to the proxy, a number or a (connect, read)
+    tuple. Default is 10 seconds to connect and 600 seconds to read."""
+    total_timeout: Optional[float] = None
+    """Seconds a call may take in total, including waiting for the token and all
+    retries. Exceeding it raises sapwrapper.Timeout."""
+    pool_connections: int = 10
+    """Number of upstream connection pools to cache in the shared HTTP session."""
+    pool_maxsize: int = 10
+    """Maximum number of keep-alive connections to keep per upstream host."""
+    async_pool_maxsize: int = 100
+    """Maximum number of concurrent connections per upstream host for async calls."""
+    coalesce_requests: bool = False
+    """Whether identical requests in flight share one call to the proxy."""
+    requests_per_minute: Optional[int] = None
+    """Requests per minute budget of the deployment, shared within the process."""
+    tokens_per_minute: Optional[int] = None
+    """Tokens per minute budget of the deployment, shared within the process."""
+    endpoints: Optional[List[Dict[str, Any]]] = None
+    """Proxy endpoints to balance the requests over, dicts with api_url, client_id,
+    client_secret and token_url. Replaces the single endpoint when given."""
+    load_balancing: Literal["least_outstanding", "ewma"] = "least_outstanding"
+    """How to pick the endpoint of a request: least outstanding requests or the
+    lowest latency average weighted by the outstanding requests."""
     headers: Any = None
+    embedding_cache: Optional[SQLiteEmbeddingCache] = None
+    """Optional persistent cache, only texts missing in it are sent to the proxy."""
+    batch_queries: bool = False
+    """Whether concurrent embed_query calls are gathered into one request. A failing
+    request fails all queries of its batch."""
+    query_batch_size: int = 64
+    """Maximum number of queries in one batched request."""
+    query_batch_wait: float = 0.005
+    """Seconds the first query of a batch waits for others to join."""
+    query_batcher: Any = None  #: :meta private:
+    aquery_batcher: Any = None  #: :meta private:
 
     class Config:
         """Configuration for this pydantic object."""
 
         extra = Extra.forbid
+        arbitrary_types_allowed = True
 
     @root_validator()
     def validate_environment(cls, values: Dict) -> Dict:
         """Validate that the SAP openAI credentials and url are set"""
-        openai_api_client_id = get_from_dict_or_env(
+        values["openai_api_client_id"] = get_from_dict_or_env(
             values,
             "openai_api_client_id", 
-            "OPENAI_CLIENTID"
+            "OPENAI_CLIENTID",
+            default="" if values["endpoints"] else None,
         )
-        openai_api_client_secret = get_from_dict_or_env(
+        values["openai_api_client_secret"] = get_from_dict_or_env(
             values,
             "openai_api_client_secret",
             "OPENAI_CLIENTSECRET",
             default="",
         )
-        openai_api_url = get_from_dict_or_env(
+        values["openai_api_url"] = get_from_dict_or_env(
             values,
             "openai_api_url",
             "OPENAI_APIURL",
             default="",
         )
-        openai_api_tokenurl = get_from_dict_or_env(
+        values["openai_api_tokenurl"] = get_from_dict_or_env(
             values,
             "openai_api_tokenurl",
             "OPENAI_TOKENURL",
@@ -161,15 +314,30 @@ class SAPOpenAIEmbeddings(BaseModel, Embeddings):
         )
         try:
             import  saplangchainproxy.sapwrapper as sapwrapper
-            if openai_api_client_id:
-                sapwrapper.openai_api_client_id = openai_api_client_id
-            if openai_api_client_secret:
-                sapwrapper.openai_api_client_secret = openai_api_client_secret
-            if openai_api_url:
-                sapwrapper.openai_api_url = openai_api_url
-            if openai_api_tokenurl:
-                sapwrapper.openai_api_tokenurl = openai_api_tokenurl                
-            values["client"] = sapwrapper.Embedding            
+            options = dict(
+                pool_connections=values["pool_connections"],
+                pool_maxsize=values["pool_maxsize"],
+                async_pool_maxsize=values["async_pool_maxsize"],
+                coalesce_requests=values["coalesce_requests"],
+                requests_per_minute=values["requests_per_minute"],
+                tokens_per_minute=values["tokens_per_minute"],
+            )
+            if values["endpoints"]:
+                values["client"] = Router(
+                    [
+                        sapwrapper.Embedding(**endpoint, **options)
+                        for endpoint in values["endpoints"]
+                    ],
+                    strategy=values["load_balancing"],
+                )
+            else:
+                values["client"] = sapwrapper.Embedding(
+                    api_url=values["openai_api_url"],
+                    client_id=values["openai_api_client_id"],
+                    client_secret=values["openai_api_client_secret"],
+                    token_url=values["openai_api_tokenurl"],
+                    **options,
+                )
         except ImportError:
             raise ValueError(
                 "Could not import sapopenaiwrapper python package. "
@@ -179,70 +347,264 @@ class SAPOpenAIEmbeddings(BaseModel, Embeddings):
 
     # please refer to
     # https://github.com/openai/openai-cookbook/blob/main/examples/Embedding_long_inputs.ipynb
-    def _get_len_safe_embeddings(
-        self, texts: List[str], *, engine: str, chunk_size: Optional[int] = None
-    ) -> List[List[float]]:
-        embeddings: List[List[float]] = [[] for _ in range(len(texts))]
-        try:
-            import tiktoken
-        except ImportError:
-            raise ImportError(
-                "Could not import tiktoken python package. "
-                "This is needed in order to for OpenAIEmbeddings. "
-                "Please install it with `pip install tiktoken`."
-            )
-
+    def _tokenize(self, texts: List[str]) -> Tuple[List[List[int]], List[int]]:
+        """Split the texts into chunks of at most embedding_ctx_length tokens.
+
+        Returns the token chunks and for each chunk the index of its text."""
+        if self.model.endswith("001"):
+            # See: https://github.com/openai/openai-python/issues/418#issuecomment-1525939500
+            # replace newlines, which can negatively affect performance.
+            texts = [text.replace("\n", " ") for text in texts]
+        encoded = tokenizer.encode_batch(
+            tokenizer.get_encoding(self.model),
+            texts,
+            allowed_special=self.allowed_special,
+            disallowed_special=self.disallowed_special,
+        )
         tokens = []
         indices = []
-        encoding = tiktoken.model.encoding_for_model(self.model)
-        for i, text in enumerate(texts):
-            if self.model.endswith("001"):
-                # See: https://github.com/openai/openai-python/issues/418#issuecomment-1525939500
-                # replace newlines, which can negatively affect performance.
-                text = text.replace("\n", " ")
-            token = encoding.encode(
-                text,
-                allowed_special=self.allowed_special,
-                disallowed_special=self.disallowed_special,
-            )
+        for i, token in enumerate(encoded):
             for j in range(0, len(token), self.embedding_ctx_length):
                 tokens += [token[j : j + self.embedding_ctx_length]]
                 indices += [i]
+        return tokens, indices
+
+    def _aggregate_embeddings(
+        self,
+        num_texts: int,
+        tokens: List[List[int]],
+        indices: List[int],
+        batched_embeddings: List[List[float]],
+    ) -> List[Optional[List[float]]]:
+        """Average the chunk embeddings of each text weighted by their number of
+        tokens and normalize them. Texts without tokens are returned as None."""
+        if not batched_embeddings:
+            return [None for _ in range(num_texts)]
+        embeddings, empty_rows = _average_chunk_embeddings(
+            num_texts,
+            indices,
+            [len(token) for token in tokens],
+            np.asarray(batched_embeddings, dtype=np.float64),
+        )
+        return [
+            None if empty else embedding
+            for embedding, empty in zip(embeddings.tolist(), empty_rows)
+        ]
+
+    def _pack(
+        self, tokens: List[List[int]], chunk_size: Optional[int] = None
+    ) -> List[Tuple[int, int]]:
+        return _pack_batches(
+            tokens,
+            chunk_size or self.chunk_size,
+            self.max_batch_tokens,
+            self.max_batch_bytes,
+        )
 
-        batched_embeddings = []
-        _chunk_size = chunk_size or self.chunk_size
-        for i in range(0, len(tokens), _chunk_size):
+    def _embed_batch(self, batch: List[List[int]]) -> List[List[float]]:
+        """Embed the batch, a batch rejected as too large is split in halves."""
+        try:
             response = embed_with_retry(
                 self,
-                input=tokens[i : i + _chunk_size],
+                input=batch,
                 engine=self.deployment,
                 request_timeout=self.request_timeout,
                 headers=self.headers,
             )
-            batched_embeddings += [r["embedding"] for r in response["data"]]
-
-        results: List[List[List[float]]] = [[] for _ in range(len(texts))]
-        num_tokens_in_batch: List[List[int]] = [[] for _ in range(len(texts))]
-        for i in range(len(indices)):
-            results[indices[i]].append(batched_embeddings[i])
-            num_tokens_in_batch[indices[i]].append(len(tokens[i]))
-
-        for i in range(len(texts)):
-            _result = results[i]
-            if len(_result) == 0:
-                average = embed_with_retry(
-                    self,
-                    input="",
-                    engine=self.deployment,
-                    request_timeout=self.request_timeout,
-                    headers=self.headers,
-                )["data"][0]["embedding"]
-            else:
-                average = np.average(_result, axis=0, weights=num_tokens_in_batch[i])
-            embeddings[i] = (average / np.linalg.norm(average)).tolist()
+        except InvalidRequestError as e:
+            if len(batch) < 2 or not _too_large(e):
+                raise
+            logger.warning(f"Splitting a batch of {len(batch)} inputs: {e}")
+            half = len(batch) // 2
+            return self._embed_batch(batch[:half]) + self._embed_batch(batch[half:])
+        return [r["embedding"] for r in response["data"]]
+
+    async def _aembed_batch(self, batch: List[List[int]]) -> List[List[float]]:
+        try:
+            response = await aembed_with_retry(
+                self,
+                input=batch,
+                engine=self.deployment,
+                request_timeout=self.request_timeout,
+                headers=self.headers,
+            )
+        except InvalidRequestError as e:
+            if len(batch) < 2 or not _too_large(e):
+                raise
+            logger.warning(f"Splitting a batch of {len(batch)} inputs: {e}")
+            half = len(batch) // 2
+            halves = await asyncio.gather(
+                self._aembed_batch(batch[:half]), self._aembed_batch(batch[half:])
+            )
+            return halves[0] + halves[1]
+        return [r["embedding"] for r in response["data"]]
 
+    # please refer to
+    # https://github.com/openai/openai-cookbook/blob/main/examples/Embedding_long_inputs.ipynb
+    def _get_len_safe_embeddings(
+        self, texts: List[str], *, engine: str, chunk_size: Optional[int] = None
+    ) -> List[List[float]]:
+        tokens, indices = self._tokenize(texts)
+        batches = [tokens[start:end] for start, end in self._pack(tokens, chunk_size)]
+        if self.max_concurrency > 1 and len(batches) > 1:
+            # Send the batches in parallel, map keeps the order of the batches
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_concurrency, len(batches))
+            ) as executor:
+                batch_results = list(executor.map(self._embed_batch, batches))
+        else:
+            batch_results = [self._embed_batch(batch) for batch in batches]
+        batched_embeddings = [e for result in batch_results for e in result]
+
+        embeddings = self._aggregate_embeddings(
+            len(texts), tokens, indices, batched_embeddings
+        )
+        if any(embedding is None for embedding in embeddings):
+            empty = self._empty_embedding()
+            embeddings = [
+                list(empty) if embedding is None else embedding
+                for embedding in embeddings
+            ]
+        return embeddings  # type: ignore[return-value]
+
+    async def _aget_len_safe_embeddings(
+        self, texts: List[str], *, engine: str, chunk_size: Optional[int] = None
+    ) -> List[List[float]]:
+        tokens, indices = self._tokenize(texts)
+        batches = [tokens[start:end] for start, end in self._pack(tokens, chunk_size)]
+        semaphore = asyncio.Semaphore(max(self.max_concurrency, 1))
+
+        async def _aembed(batch: List[List[int]]) -> List[List[float]]:
+            async with semaphore:
+                return await self._aembed_batch(batch)
+
+        # gather returns the results in the order of the batches
+        batch_results = await asyncio.gather(*[_aembed(batch) for batch in batches])
+        batched_embeddings = [e for result in batch_results for e in result]
+
+        embeddings = self._aggregate_embeddings(
+            len(texts), tokens, indices, batched_embeddings
+        )
+        if any(embedding is None for embedding in embeddings):
+            # shares the single fetch of the empty embedding with the sync path
+            empty = await asyncio.get_running_loop().run_in_executor(
+                None, self._empty_embedding
+            )
+            embeddings = [
+                list(empty) if embedding is None else embedding
+                for embedding in embeddings
+            ]
+        return embeddings  # type: ignore[return-value]
+
+    def _get_len_safe_embeddings_array(
+        self,
+        texts: List[str],
+        *,
+        dtype: Any = np.float32,
+        chunk_size: Optional[int] = None,
+    ) -> np.ndarray:
+        """Length-safe embeddings written into one (len(texts), dim) array."""
+        tokens, indices = self._tokenize(texts)
+        ranges = self._pack(tokens, chunk_size)
+        batches = [tokens[start:end] for start, end in ranges]
+        if not batches:
+            if not texts:
+                return np.zeros((0, 0), dtype=dtype)
+            empty = np.asarray(self._empty_embedding(), dtype=dtype)
+            return np.tile(empty, (len(texts), 1))
+
+        # The first response tells the dimension of the embeddings, the chunk
+        # embeddings of all batches are then copied into one preallocated matrix
+        first = self._embed_batch(batches[0])
+        chunk_embeddings = np.empty((len(tokens), len(first[0])), dtype=dtype)
+        chunk_embeddings[: len(first)] = first
+
+        def _fill(batch_index: int) -> None:
+            offset = ranges[batch_index][0]
+            result = self._embed_batch(batches[batch_index])
+            chunk_embeddings[offset : offset + len(result)] = result
+
+        if self.max_concurrency > 1 and len(batches) > 2:
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_concurrency, len(batches) - 1)
+            ) as executor:
+                list(executor.map(_fill, range(1, len(batches))))
+        else:
+            for batch_index in range(1, len(batches)):
+                _fill(batch_index)
+
+        embeddings, empty_rows = _average_chunk_embeddings(
+            len(texts),
+            indices,
+            [len(token) for token in tokens],
+            chunk_embeddings,
+        )
+        if empty_rows.any():
+            embeddings[empty_rows] = np.asarray(self._empty_embedding(), dtype=dtype)
         return embeddings
 
+    def _empty_embedding(self) -> List[float]:
+        """Normalized embedding of the empty text, used for texts without tokens.
+
+        It is fetched once per proxy and deployment and kept for the lifetime of
+        the process.
+        """
+        key = (self.client.api_url, self.deployment)
+        embedding = _empty_embeddings.get(key)
+        if embedding is None:
+            with _empty_embeddings_lock:
+                lock = _empty_embedding_locks.setdefault(key, threading.Lock())
+            with lock:
+                embedding = _empty_embeddings.get(key)
+                if embedding is None:
+                    average = embed_with_retry(
+                        self,
+                        input="",
+                        engine=self.deployment,
+                        request_timeout=self.request_timeout,
+                        headers=self.headers,
+                    )["data"][0]["embedding"]
+                    embedding = (average / np.linalg.norm(average)).tolist()
+                    _empty_embeddings[key] = embedding
+        return embedding
+
+    def _embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed the queries of a batch in one request, duplicates are sent once."""
+        distinct = list(dict.fromkeys(texts))
+        response = embed_with_retry(
+            self,
+            input=distinct,
+            engine=self.deployment,
+            request_timeout=self.request_timeout,
+            headers=self.headers,
+        )
+        embeddings = dict(zip(distinct, (r["embedding"] for r in response["data"])))
+        return [embeddings[text] for text in texts]
+
+    async def _aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        distinct = list(dict.fromkeys(texts))
+        response = await aembed_with_retry(
+            self,
+            input=distinct,
+            engine=self.deployment,
+            request_timeout=self.request_timeout,
+            headers=self.headers,
+        )
+        embeddings = dict(zip(distinct, (r["embedding"] for r in response["data"])))
+        return [embeddings[text] for text in texts]
+
+    def _query_batchers(self) -> Tuple[MicroBatcher, AsyncMicroBatcher]:
+        if self.query_batcher is None:
+            with _batchers_lock:
+                if self.query_batcher is None:
+                    self.aquery_batcher = AsyncMicroBatcher(
+                        self._aembed_queries, self.query_batch_size, self.query_batch_wait
+                    )
+                    self.query_batcher = MicroBatcher(
+                        self._embed_queries, self.query_batch_size, self.query_batch_wait
+                    )
+        return self.query_batcher, self.aquery_batcher
+
     def _embedding_func(self, text: str, *, engine: str) -> List[float]:
         """Call out to OpenAI's embedding endpoint."""
         # handle large input text
@@ -253,6 +615,8 @@ class SAPOpenAIEmbeddings(BaseModel, Embeddings):
                 # See: https://github.com/openai/openai-python/issues/418#issuecomment-1525939500
                 # replace newlines, which can negatively affect performance.
                 text = text.replace("\n", " ")
+            if self.batch_queries and engine == self.deployment:
+                return self._query_batchers()[0].submit(text)
             return embed_with_retry(
                 self,
                 input=[text],
@@ -261,6 +625,64 @@ class SAPOpenAIEmbeddings(BaseModel, Embeddings):
                 headers=self.headers,
             )["data"][0]["embedding"]
 
+    async def _aembedding_func(self, text: str, *, engine: str) -> List[float]:
+        """Call out to OpenAI's embedding endpoint async."""
+        # handle large input text
+        if len(text) > self.embedding_ctx_length:
+            return (await self._aget_len_safe_embeddings([text], engine=engine))[0]
+        else:
+            if self.model.endswith("001"):
+                # See: https://github.com/openai/openai-python/issues/418#issuecomment-1525939500
+                # replace newlines, which can negatively affect performance.
+                text = text.replace("\n", " ")
+            if self.batch_queries and engine == self.deployment:
+                return await self._query_batchers()[1].submit(text)
+            return (
+                await aembed_with_retry(
+                    self,
+                    input=[text],
+                    engine=engine,
+                    request_timeout=self.request_timeout,
+                    headers=self.headers,
+                )
+            )["data"][0]["embedding"]
+
+    def _lookup_cache(
+        self, texts: List[str]
+    ) -> Tuple[List[str], List[Optional[List[float]]], List[str]]:
+        """Get the cache keys, the cached embeddings (None if missing) and the
+        distinct texts missing in the cache."""
+        assert self.embedding_cache is not None
+        keys = [
+            self.embedding_cache.key(self.deployment, self.model, text)
+            for text in texts
+        ]
+        found = self.embedding_cache.get_many(keys)
+        embeddings = [found.get(key) for key in keys]
+        missing = {
+            key: text for key, text in zip(keys, texts) if key not in found
+        }
+        return keys, embeddings, list(missing.values())
+
+    def _fill_from_cache(
+        self,
+        keys: List[str],
+        embeddings: List[Optional[List[float]]],
+        missing_texts: List[str],
+        missing_embeddings: List[List[float]],
+    ) -> List[List[float]]:
+        """Store the embeddings of the missing texts and merge them into the result."""
+        assert self.embedding_cache is not None
+        new_embeddings = {
+            self.embedding_cache.key(self.deployment, self.model, text): embedding
+            for text, embedding in zip(missing_texts, missing_embeddings)
+        }
+        self.embedding_cache.set_many(new_embeddings)
+        return [
+            embedding if embedding is not None else new_embeddings[key]
+            for key, embedding in zip(keys, embeddings)
+        ]
+
     def embed_documents(
         self, texts: List[str], chunk_size: Optional[int] = 0
     ) -> List[List[float]]:
@@ -276,7 +698,64 @@ class SAPOpenAIEmbeddings(BaseModel, Embeddings):
         """
         # NOTE: to keep things simple, we assume the list may contain texts longer
         #       than the maximum context and use length-safe embedding function.
-        return self._get_len_safe_embeddings(texts, engine=self.deployment)
+        if self.embedding_cache is None:
+            return self._get_len_safe_embeddings(texts, engine=self.deployment)
+        keys, embeddings, missing_texts = self._lookup_cache(texts)
+        missing_embeddings = (
+            self._get_len_safe_embeddings(missing_texts, engine=self.deployment)
+            if missing_texts
+            else []
+        )
+        return self._fill_from_cache(
+            keys, embeddings, missing_texts, missing_embeddings
+        )
+
+    def embed_documents_array(
+        self,
+        texts: List[str],
+        chunk_size: Optional[int] = 0,
+        dtype: Any = np.float32,
+    ) -> np.ndarray:
+        """Call out to OpenAI's embedding endpoint and return the embeddings as matrix.
+
+        Unlike embed_documents no list is built per embedding, the embeddings are
+        copied into one contiguous array which can be handed over to e.g. FAISS.
+
+        Args:
+            texts: The list of texts to embed.
+            chunk_size: The chunk size of embeddings. If None, will use the chunk size
+                specified by the class.
+            dtype: The data type of the array.
+
+        Returns:
+            Array of shape (len(texts), dim) with the normalized embedding of each
+            text in its row.
+        """
+        if self.embedding_cache is None:
+            return self._get_len_safe_embeddings_array(
+                texts, dtype=dtype, chunk_size=chunk_size
+            )
+        keys, cached, missing_texts = self._lookup_cache(texts)
+        missing = {}
+        if missing_texts:
+            missing_array = self._get_len_safe_embeddings_array(
+                missing_texts, dtype=dtype, chunk_size=chunk_size
+            )
+            missing = {
+                self.embedding_cache.key(self.deployment, self.model, text): row
+                for text, row in zip(missing_texts, missing_array)
+            }
+            self.embedding_cache.set_many(missing)
+        if not texts:
+            return np.zeros((0, 0), dtype=dtype)
+        rows = [
+            embedding if embedding is not None else missing[key]
+            for key, embedding in zip(keys, cached)
+        ]
+        embeddings = np.empty((len(texts), len(rows[0])), dtype=dtype)
+        for i, row in enumerate(rows):
+            embeddings[i] = row
+        return embeddings
 
     def embed_query(self, text: str) -> List[float]:
         """Call out to OpenAI's embedding endpoint for embedding query text.
@@ -287,5 +766,79 @@ class SAPOpenAIEmbeddings(BaseModel, Embeddings):
         Returns:
             Embedding for the text.
         """
-        embedding = self._embedding_func(text, engine=self.deployment)
-        return embedding
\ No newline at end of file
+        if self.embedding_cache is None:
+            return self._embedding_func(text, engine=self.deployment)
+        keys, embeddings, missing_texts = self._lookup_cache([text])
+        missing_embeddings = (
+            [self._embedding_func(text, engine=self.deployment)]
+            if missing_texts
+            else []
+        )
+        return self._fill_from_cache(
+            keys, embeddings, missing_texts, missing_embeddings
+        )[0]
+
+    async def aembed_documents(
+        self, texts: List[str], chunk_size: Optional[int] = 0
+    ) -> List[List[float]]:
+        """Call out to OpenAI's embedding endpoint async for embedding search docs.
+
+        Args:
+            texts: The list of texts to embed.
+            chunk_size: The chunk size of embeddings. If None, will use the chunk size
+                specified by the class.
+
+        Returns:
+            List of embeddings, one for each text.
+        """
+        # NOTE: to keep things simple, we assume the list may contain texts longer
+        #       than the maximum context and use length-safe embedding function.
+        if self.embedding_cache is None:
+            return await self._aget_len_safe_embeddings(texts, engine=self.deployment)
+        loop = asyncio.get_running_loop()
+        keys, embeddings, missing_texts = await loop.run_in_executor(
+            None, self._lookup_cache, texts
+        )
+        missing_embeddings = (
+            await self._aget_len_safe_embeddings(missing_texts, engine=self.deployment)
+            if missing_texts
+            else []
+        )
+        return await loop.run_in_executor(
+            None,
+            self._fill_from_cache,
+            keys,
+            embeddings,
+            missing_texts,
+            missing_embeddings,
+        )
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """Call out to OpenAI's embedding endpoint async for embedding query text.
+
+        Args:
+            text: The text to embed.
+
+        Returns:
+            Embedding for the text.
+        """
+        if self.embedding_cache is None:
+            return await self._aembedding_func(text, engine=self.deployment)
+        loop = asyncio.get_running_loop()
+        keys, embeddings, missing_texts = await loop.run_in_executor(
+            None, self._lookup_cache, [text]
+        )
+        missing_embeddings = (
+            [await self._aembedding_func(text, engine=self.deployment)]
+            if missing_texts
+            else []
+        )
+        embeddings = await loop.run_in_executor(
+            None,
+            self._fill_from_cache,
+            keys,
+            embeddings,
+            missing_texts,
+            missing_embeddings,
+        )
+        return embeddings[0]
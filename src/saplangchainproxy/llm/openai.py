@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 import sys
+import threading
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from typing import (
     AbstractSet,
     Any,
@@ -24,15 +28,24 @@ from langchain.callbacks.manager import (
     AsyncCallbackManagerForLLMRun,
     CallbackManagerForLLMRun,
 )
-from langchain.llms.base import BaseLLM, create_base_retry_decorator
+from langchain.llms.base import BaseLLM
 from langchain.pydantic_v1 import Field, root_validator
 from langchain.schema import Generation, LLMResult
 from langchain.schema.output import GenerationChunk
 from langchain.utils import get_from_dict_or_env, get_pydantic_field_names
 from langchain.utils.utils import build_extra_kwargs
 
+from saplangchainproxy import deployments, tokenizer
+from saplangchainproxy.batching import AsyncMicroBatcher, MicroBatcher
+from saplangchainproxy.cache import ResponseCache, canonical_hash
+from saplangchainproxy.retry import create_retry_decorator
+from saplangchainproxy.routing import Router
+
 logger = logging.getLogger(__name__)
 
+# Guards the lazy creation of the request mergers of the models
+_mergers_lock = threading.Lock()
+
 
 def update_token_usage(
     keys: Set[str], response: Dict[str, Any], token_usage: Dict[str, Any]
@@ -46,6 +59,44 @@ def update_token_usage(
             token_usage[_key] += response["usage"][_key]
 
 
+def _apportion(total: int, weights: List[int]) -> List[int]:
+    """Split total in proportion to the weights, the parts add up to total."""
+    weight_sum = sum(weights)
+    if weight_sum == 0:
+        weights, weight_sum = [1] * len(weights), len(weights)
+    shares = [total * weight / weight_sum for weight in weights]
+    parts = [int(share) for share in shares]
+    # the largest remainders get the tokens lost by rounding down
+    by_remainder = sorted(range(len(shares)), key=lambda i: parts[i] - shares[i])
+    for i in by_remainder[: total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+
+def _split_token_usage(
+    usage: Dict[str, int], prompt_weights: List[int], completion_weights: List[int]
+) -> List[Dict[str, int]]:
+    """Split the token usage of a merged request among its callers.
+
+    The prompt and completion tokens are split in proportion to the tokens of the
+    prompts and completions of each caller.
+    """
+    usages: List[Dict[str, int]] = [{} for _ in prompt_weights]
+    for key, weights in (
+        ("prompt_tokens", prompt_weights),
+        ("completion_tokens", completion_weights),
+    ):
+        if key in usage:
+            for caller_usage, part in zip(usages, _apportion(usage[key], weights)):
+                caller_usage[key] = part
+    if "total_tokens" in usage:
+        for caller_usage in usages:
+            caller_usage["total_tokens"] = caller_usage.get(
+                "prompt_tokens", 0
+            ) + caller_usage.get("completion_tokens", 0)
+    return usages
+
+
 def _stream_response_to_generation_chunk(
     stream_response: Dict[str, Any],
 ) -> GenerationChunk:
@@ -86,18 +137,35 @@ def _create_retry_decorator(
         Union[AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun]
     ] = None,
 ) -> Callable[[Any], Any]:
-    import openai
-
-    errors = [
-        openai.error.Timeout,
-        openai.error.APIError,
-        openai.error.APIConnectionError,
-        openai.error.RateLimitError,
-        openai.error.ServiceUnavailableError,
-    ]
-    return create_base_retry_decorator(
-        error_types=errors, max_retries=llm.max_retries, run_manager=run_manager
+    if isinstance(llm, SAPAzureOpenAIChat):
+        import openai
+
+        # the legacy chat model calls openai directly
+        errors = [
+            openai.error.Timeout,
+            openai.error.APIError,
+            openai.error.APIConnectionError,
+            openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError,
+        ]
+        return create_retry_decorator(
+            max_retries=llm.max_retries, run_manager=run_manager, error_types=errors
+        )
+    return create_retry_decorator(
+        max_retries=llm.max_retries,
+        run_manager=run_manager,
+        deadline=llm.retry_deadline,
+        total_timeout=llm.total_timeout,
+    )
+
+
+def _route_context(llm: BaseSAPAzureOpenAI, kwargs: Dict[str, Any]) -> None:
+    """Send the request to the deployment whose context fits it."""
+    deployment = deployments.pick_deployment(
+        kwargs, llm.context_routing, llm.context_routing_preference
     )
+    # SAPAzureOpenAI names the deployment engine
+    kwargs["engine" if "engine" in kwargs else "model"] = deployment
 
 
 def completion_with_retry(
@@ -107,6 +175,10 @@ def completion_with_retry(
 ) -> Any:
     """Use tenacity to retry the completion call."""
     retry_decorator = _create_retry_decorator(llm, run_manager=run_manager)
+    if isinstance(llm, BaseSAPAzureOpenAI) and llm.total_timeout is not None:
+        kwargs["deadline"] = time.monotonic() + llm.total_timeout
+    if isinstance(llm, BaseSAPAzureOpenAI) and llm.context_routing:
+        _route_context(llm, kwargs)
 
     @retry_decorator
     def _completion_with_retry(**kwargs: Any) -> Any:
@@ -116,10 +188,16 @@ def completion_with_retry(
 
 
 async def acompletion_with_retry(
-    llm: Union[BaseSAPAzureOpenAI, SAPAzureOpenAIChat], **kwargs: Any
+    llm: Union[BaseSAPAzureOpenAI, SAPAzureOpenAIChat],
+    run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+    **kwargs: Any,
 ) -> Any:
     """Use tenacity to retry the async completion call."""
-    retry_decorator = _create_retry_decorator(llm)
+    retry_decorator = _create_retry_decorator(llm, run_manager=run_manager)
+    if isinstance(llm, BaseSAPAzureOpenAI) and llm.total_timeout is not None:
+        kwargs["deadline"] = time.monotonic() + llm.total_timeout
+    if isinstance(llm, BaseSAPAzureOpenAI) and llm.context_routing:
+        _route_context(llm, kwargs)
 
     @retry_decorator
     async def _completion_with_retry(**kwargs: Any) -> Any:
@@ -169,12 +247,62 @@ class BaseSAPAzureOpenAI(BaseLLM):
     openai_proxy: Optional[str] = None
     batch_size: int = 20
     """Batch size to use when passing multiple documents to generate."""
+    max_concurrency: int = 1
+    """Maximum number of batches of prompts to send to the proxy in parallel."""
+    merge_requests: bool = False
+    """Whether concurrent non-streaming calls with identical parameters are merged
+    into one request of up to batch_size prompts. A failing request fails all
+    calls merged into it."""
+    merge_wait: float = 0.005
+    """Seconds the first call of a merged request waits for others to join."""
+    completion_merger: Any = None  #: :meta private:
+    acompletion_merger: Any = None  #: :meta private:
     request_timeout: Optional[Union[float, Tuple[float, float]]] = None
-    """Timeout for requests to OpenAI completion API. Default is 600 seconds."""
+    """Timeout in seconds of the requests to the proxy, a number or a (connect, read)
+    tuple. Default is 10 seconds to connect and 600 seconds to read."""
+    stream_timeout: Optional[float] = None
+    """Maximum seconds to wait for the next chunk of a streamed response. Default is
+    the read timeout."""
+    total_timeout: Optional[float] = None
+    """Seconds a call may take in total, including waiting for the token and all
+    retries. Exceeding it raises sapwrapper.Timeout."""
     logit_bias: Optional[Dict[str, float]] = Field(default_factory=dict)
     """Adjust the probability of specific tokens being generated."""
     max_retries: int = 6
     """Maximum number of retries to make when generating."""
+    retry_deadline: Optional[float] = None
+    """Seconds after the first attempt after which no retry starts."""
+    pool_connections: int = 10
+    """Number of upstream connection pools to cache in the shared HTTP session."""
+    pool_maxsize: int = 10
+    """Maximum number of keep-alive connections to keep per upstream host."""
+    async_pool_maxsize: int = 100
+    """Maximum number of concurrent connections per upstream host for async calls."""
+    coalesce_requests: bool = False
+    """Whether identical requests in flight share one call to the proxy."""
+    requests_per_minute: Optional[int] = None
+    """Requests per minute budget of the deployment, shared within the process."""
+    tokens_per_minute: Optional[int] = None
+    """Tokens per minute budget of the deployment, shared within the process."""
+    endpoints: Optional[List[Dict[str, Any]]] = None
+    """Proxy endpoints to balance the requests over, dicts with api_url, client_id,
+    client_secret and token_url. Replaces the single endpoint when given."""
+    load_balancing: Literal["least_outstanding", "ewma"] = "least_outstanding"
+    """How to pick the endpoint of a request: least outstanding requests or the
+    lowest latency average weighted by the outstanding requests."""
+    hedge_percentile: Optional[float] = None
+    """Percentile of the recent latencies, e.g. 95, after which a non-streaming
+    request is sent once more. The first response wins. Disabled by default."""
+    hedge_budget: float = 0.1
+    """Maximum share of extra requests hedging may add."""
+    context_routing: Optional[List[str]] = None
+    """Deployment ids to choose from per request, e.g. ["gpt-4", "gpt-4-32k"]. Each
+    request goes to the cheapest of them whose context fits the prompt plus
+    max_tokens, see saplangchainproxy.deployments. Disabled by default."""
+    context_routing_preference: Literal["cost", "latency"] = "cost"
+    """Whether context routing prefers the cheaper or the faster deployment."""
+    response_cache: Optional[ResponseCache] = None
+    """Exact-match cache of the responses of the proxy, disabled by default."""
     streaming: bool = False
     """Whether to stream the results or not."""
     allowed_special: Union[Literal["all"], AbstractSet[str]] = set()
@@ -208,6 +336,7 @@ class BaseSAPAzureOpenAI(BaseLLM):
         """Configuration for this pydantic object."""
 
         allow_population_by_field_name = True
+        arbitrary_types_allowed = True
 
     @root_validator(pre=True)
     def build_extra(cls, values: Dict[str, Any]) -> Dict[str, Any]:
@@ -225,7 +354,8 @@ class BaseSAPAzureOpenAI(BaseLLM):
         values["openai_api_client_id"] = get_from_dict_or_env(
             values,
             "openai_api_client_id", 
-            "OPENAI_CLIENTID"
+            "OPENAI_CLIENTID",
+            default="" if values["endpoints"] else None,
         )
         values["openai_api_client_secret"] = get_from_dict_or_env(
             values,
@@ -252,13 +382,50 @@ class BaseSAPAzureOpenAI(BaseLLM):
             default="",
         )        
         try:
-            import saplangchainproxy.sapwrapper as sapwrapper           
-            values["client"] = sapwrapper.Completion            
+            import saplangchainproxy.sapwrapper as sapwrapper
+            options = dict(
+                pool_connections=values["pool_connections"],
+                pool_maxsize=values["pool_maxsize"],
+                async_pool_maxsize=values["async_pool_maxsize"],
+                coalesce_requests=values["coalesce_requests"],
+                requests_per_minute=values["requests_per_minute"],
+                tokens_per_minute=values["tokens_per_minute"],
+                response_cache=values["response_cache"],
+            )
+            if values["endpoints"]:
+                clients = [
+                    sapwrapper.Completion(**endpoint, **options)
+                    for endpoint in values["endpoints"]
+                ]
+            else:
+                clients = [
+                    sapwrapper.Completion(
+                        api_url=values["openai_api_url"],
+                        client_id=values["openai_api_client_id"],
+                        client_secret=values["openai_api_client_secret"],
+                        token_url=values["openai_api_tokenurl"],
+                        **options,
+                    )
+                ]
+            if values["endpoints"] or values["hedge_percentile"] is not None:
+                values["client"] = Router(
+                    clients,
+                    strategy=values["load_balancing"],
+                    hedge_percentile=values["hedge_percentile"],
+                    hedge_budget=values["hedge_budget"],
+                    # a single endpoint wrapped for hedging has nothing to fail over to
+                    circuit_breaker=bool(values["endpoints"]),
+                )
+            else:
+                values["client"] = clients[0]
         except ImportError:
             raise ValueError(
                 "Could not import sapopenaiwrapper python package. "
                 "Check path of your project directory."
             )
+        for deployment in values["context_routing"] or []:
+            # fails for deployments without known capabilities
+            deployments.context_size(deployment)
         if values["streaming"] and values["n"] > 1:
             raise ValueError("Cannot stream results when n > 1.")
         if values["streaming"] and values["best_of"] > 1:
@@ -276,6 +443,7 @@ class BaseSAPAzureOpenAI(BaseLLM):
             "presence_penalty": self.presence_penalty,
             "n": self.n,
             "request_timeout": self.request_timeout,
+            "stream_timeout": self.stream_timeout,
             "logit_bias": self.logit_bias,
         }
 
@@ -298,6 +466,8 @@ class BaseSAPAzureOpenAI(BaseLLM):
         for stream_resp in completion_with_retry(
             self, prompt=prompt, run_manager=run_manager, **params
         ):
+            if len(stream_resp["choices"]) == 0:
+                continue
             chunk = _stream_response_to_generation_chunk(stream_resp)
             yield chunk
             if run_manager:
@@ -322,6 +492,8 @@ class BaseSAPAzureOpenAI(BaseLLM):
         async for stream_resp in await acompletion_with_retry(
             self, prompt=prompt, run_manager=run_manager, **params
         ):
+            if len(stream_resp["choices"]) == 0:
+                continue
             chunk = _stream_response_to_generation_chunk(stream_resp)
             yield chunk
             if run_manager:
@@ -359,11 +531,31 @@ class BaseSAPAzureOpenAI(BaseLLM):
         params = self._invocation_params
         params = {**params, **kwargs}
         sub_prompts = self.get_sub_prompts(params, prompts, stop)
+        if self._merges(params, sub_prompts):
+            choices, token_usage = self._mergers()[0].submit(
+                (params, prompts), key=canonical_hash(params), size=len(prompts)
+            )
+            return self.create_llm_result(choices, prompts, token_usage)
         choices = []
         token_usage: Dict[str, int] = {}
         # Get the token usage from the response.
         # Includes prompt, completion, and total tokens used.
         _keys = {"completion_tokens", "prompt_tokens", "total_tokens"}
+        if not self.streaming and self.max_concurrency > 1 and len(sub_prompts) > 1:
+            # Send the batches in parallel, map keeps the order of the prompts
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_concurrency, len(sub_prompts))
+            ) as executor:
+                responses = executor.map(
+                    lambda _prompts: completion_with_retry(
+                        self, prompt=_prompts, run_manager=run_manager, **params
+                    ),
+                    sub_prompts,
+                )
+                for response in responses:
+                    choices.extend(response["choices"])
+                    update_token_usage(_keys, response, token_usage)
+            return self.create_llm_result(choices, prompts, token_usage)
         for _prompts in sub_prompts:
             if self.streaming:
                 if len(_prompts) > 1:
@@ -373,6 +565,8 @@ class BaseSAPAzureOpenAI(BaseLLM):
                 for stream_resp in completion_with_retry(
                     self, prompt=_prompts, **params
                 ):
+                    if len(stream_resp["choices"]) == 0:
+                        continue
                     if run_manager:
                         run_manager.on_llm_new_token(
                             stream_resp["choices"][0]["text"],
@@ -400,11 +594,33 @@ class BaseSAPAzureOpenAI(BaseLLM):
         params = self._invocation_params
         params = {**params, **kwargs}
         sub_prompts = self.get_sub_prompts(params, prompts, stop)
+        if self._merges(params, sub_prompts):
+            choices, token_usage = await self._mergers()[1].submit(
+                (params, prompts), key=canonical_hash(params), size=len(prompts)
+            )
+            return self.create_llm_result(choices, prompts, token_usage)
         choices = []
         token_usage: Dict[str, int] = {}
         # Get the token usage from the response.
         # Includes prompt, completion, and total tokens used.
         _keys = {"completion_tokens", "prompt_tokens", "total_tokens"}
+        if not self.streaming and self.max_concurrency > 1 and len(sub_prompts) > 1:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+
+            async def _acompletion(_prompts: List[str]) -> Any:
+                async with semaphore:
+                    return await acompletion_with_retry(
+                        self, prompt=_prompts, run_manager=run_manager, **params
+                    )
+
+            # gather returns the responses in the order of the prompts
+            responses = await asyncio.gather(
+                *[_acompletion(_prompts) for _prompts in sub_prompts]
+            )
+            for response in responses:
+                choices.extend(response["choices"])
+                update_token_usage(_keys, response, token_usage)
+            return self.create_llm_result(choices, prompts, token_usage)
         for _prompts in sub_prompts:
             if self.streaming:
                 if len(_prompts) > 1:
@@ -438,6 +654,69 @@ class BaseSAPAzureOpenAI(BaseLLM):
                 update_token_usage(_keys, response, token_usage)
         return self.create_llm_result(choices, prompts, token_usage)
 
+    def _merges(self, params: Dict[str, Any], sub_prompts: List[List[str]]) -> bool:
+        """Whether the call is merged with the concurrent calls of the model."""
+        return (
+            self.merge_requests
+            and not self.streaming
+            and not params.get("stream")
+            and len(sub_prompts) == 1
+        )
+
+    def _mergers(self) -> Tuple[MicroBatcher, AsyncMicroBatcher]:
+        if self.completion_merger is None:
+            with _mergers_lock:
+                if self.completion_merger is None:
+                    self.acompletion_merger = AsyncMicroBatcher(
+                        self._amerged_completion, self.batch_size, self.merge_wait
+                    )
+                    self.completion_merger = MicroBatcher(
+                        self._merged_completion, self.batch_size, self.merge_wait
+                    )
+        return self.completion_merger, self.acompletion_merger
+
+    def _split_merged(
+        self, calls: List[Tuple[Dict[str, Any], List[str]]], response: Dict[str, Any]
+    ) -> List[Tuple[List[Dict[str, Any]], Dict[str, int]]]:
+        """Split the choices and the token usage of a merged request by call."""
+        encoding = tokenizer.get_encoding(self.tiktoken_model_name or self.model_name)
+        # the calls share their params, n of the call may differ from the model's
+        n = calls[0][0]["n"]
+        call_choices = []
+        offset = 0
+        for _, prompts in calls:
+            call_choices.append(response["choices"][offset : offset + len(prompts) * n])
+            offset += len(prompts) * n
+        usages = _split_token_usage(
+            response.get("usage", {}),
+            [
+                sum(len(encoding.encode(p, disallowed_special=())) for p in prompts)
+                for _, prompts in calls
+            ],
+            [
+                sum(len(encoding.encode(c["text"], disallowed_special=())) for c in choices)
+                for choices in call_choices
+            ],
+        )
+        return list(zip(call_choices, usages))
+
+    def _merged_completion(
+        self, calls: List[Tuple[Dict[str, Any], List[str]]]
+    ) -> List[Tuple[List[Dict[str, Any]], Dict[str, int]]]:
+        """Send the prompts of concurrent calls with identical parameters at once."""
+        params = calls[0][0]
+        prompts = [prompt for _, _prompts in calls for prompt in _prompts]
+        response = completion_with_retry(self, prompt=prompts, **params)
+        return self._split_merged(calls, response)
+
+    async def _amerged_completion(
+        self, calls: List[Tuple[Dict[str, Any], List[str]]]
+    ) -> List[Tuple[List[Dict[str, Any]], Dict[str, int]]]:
+        params = calls[0][0]
+        prompts = [prompt for _, _prompts in calls for prompt in _prompts]
+        response = await acompletion_with_retry(self, prompt=prompts, **params)
+        return self._split_merged(calls, response)
+
     def get_sub_prompts(
         self,
         params: Dict[str, Any],
@@ -486,17 +765,11 @@ class BaseSAPAzureOpenAI(BaseLLM):
     @property
     def _invocation_params(self) -> Dict[str, Any]:
         """Get the parameters used to invoke the model."""
-        openai_creds: Dict[str, Any] = {
-            "openai_api_client_id": self.openai_api_client_id,
-            "openai_api_client_secret": self.openai_api_client_secret,
-            "openai_api_tokenurl": self.openai_api_tokenurl,
-            "openai_api_url": self.openai_api_url
-        }
         if self.openai_proxy:
             import openai
 
             openai.proxy = {"http": self.openai_proxy, "https": self.openai_proxy}  # type: ignore[assignment]  # noqa: E501
-        return {**openai_creds, **self._default_params}
+        return self._default_params
 
     @property
     def _identifying_params(self) -> Mapping[str, Any]:
@@ -513,23 +786,7 @@ class BaseSAPAzureOpenAI(BaseLLM):
         # tiktoken NOT supported for Python < 3.8
         if sys.version_info[1] < 8:
             return super().get_num_tokens(text)
-        try:
-            import tiktoken
-        except ImportError:
-            raise ImportError(
-                "Could not import tiktoken python package. "
-                "This is needed in order to calculate get_num_tokens. "
-                "Please install it with `pip install tiktoken`."
-            )
-
-        model_name = self.tiktoken_model_name or self.model_name
-        try:
-            enc = tiktoken.encoding_for_model(model_name)
-        except KeyError:
-            logger.warning("Warning: model not found. Using cl100k_base encoding.")
-            model = "cl100k_base"
-            enc = tiktoken.get_encoding(model)
-
+        enc = tokenizer.get_encoding(self.tiktoken_model_name or self.model_name)
         return enc.encode(
             text,
             allowed_special=self.allowed_special,
@@ -551,46 +808,7 @@ class BaseSAPAzureOpenAI(BaseLLM):
 
                 max_tokens = openai.modelname_to_contextsize("text-davinci-003")
         """
-        model_token_mapping = {
-            "gpt-4": 8192,
-            "gpt-4-0314": 8192,
-            "gpt-4-0613": 8192,
-            "gpt-4-32k": 32768,
-            "gpt-4-32k-0314": 32768,
-            "gpt-4-32k-0613": 32768,
-            "gpt-3.5-turbo": 4096,
-            "gpt-3.5-turbo-0301": 4096,
-            "gpt-3.5-turbo-0613": 4096,
-            "gpt-3.5-turbo-16k": 16385,
-            "gpt-3.5-turbo-16k-0613": 16385,
-            "text-ada-001": 2049,
-            "ada": 2049,
-            "text-babbage-001": 2040,
-            "babbage": 2049,
-            "text-curie-001": 2049,
-            "curie": 2049,
-            "davinci": 2049,
-            "text-davinci-003": 4097,
-            "text-davinci-002": 4097,
-            "code-davinci-002": 8001,
-            "code-davinci-001": 8001,
-            "code-cushman-002": 2048,
-            "code-cushman-001": 2048,
-        }
-
-        # handling finetuned models
-        if "ft-" in modelname:
-            modelname = modelname.split(":")[0]
-
-        context_size = model_token_mapping.get(modelname, None)
-
-        if context_size is None:
-            raise ValueError(
-                f"Unknown model: {modelname}. Please provide a valid OpenAI model name."
-                "Known models are: " + ", ".join(model_token_mapping.keys())
-            )
-
-        return context_size
+        return deployments.context_size(modelname)
 
     @property
     def max_context_size(self) -> int:
@@ -705,6 +923,14 @@ class SAPAzureOpenAI(BaseSAPAzureOpenAI):
         }
         return {**openai_params, **super()._invocation_params}
 
+    @property
+    def max_context_size(self) -> int:
+        """Get max context size for the deployment, or for the model if the
+        deployment id is unknown."""
+        if self.deployment_name in deployments.DEPLOYMENTS:
+            return deployments.context_size(self.deployment_name)
+        return super().max_context_size
+
     @property
     def _llm_type(self) -> str:
         """Return type of llm."""
@@ -924,16 +1150,7 @@ class SAPAzureOpenAIChat(BaseLLM):
         # tiktoken NOT supported for Python < 3.8
         if sys.version_info[1] < 8:
             return super().get_token_ids(text)
-        try:
-            import tiktoken
-        except ImportError:
-            raise ImportError(
-                "Could not import tiktoken python package. "
-                "This is needed in order to calculate get_num_tokens. "
-                "Please install it with `pip install tiktoken`."
-            )
-
-        enc = tiktoken.encoding_for_model(self.model_name)
+        enc = tokenizer.get_encoding(self.model_name)
         return enc.encode(
             text,
             allowed_special=self.allowed_special,
@@ -0,0 +1,169 @@
+"""Client-side rate limits of the SAP AI proxy deployments."""
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from saplangchainproxy import tokenizer
+
+
+class TokenBucket:
+    """Bucket holding up to per_minute units, refilled continuously.
+
+    Callers reserve their units right away and wait until the bucket has
+    refilled enough, so waiting callers are served in order without polling.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self._rate = per_minute / 60.0
+        self._level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        """Take the amount from the bucket and get the seconds to wait for it.
+
+        Not thread-safe, the caller holds the lock of the limiter.
+        """
+        now = time.monotonic()
+        self._level = min(
+            self.per_minute, self._level + (now - self._updated) * self._rate
+        )
+        self._updated = now
+        self._level -= amount
+        return max(0.0, -self._level / self._rate)
+
+    def cancel(self, amount: float) -> None:
+        """Put back the amount of a reservation that is not used."""
+        self._level += amount
+
+
+class RateLimiter:
+    """Requests and tokens per minute budget of one deployment.
+
+    Use get_rate_limiter to share the limiter of a deployment and budget within
+    the process.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ):
+        self._lock = threading.Lock()
+        self._requests: Optional[TokenBucket] = None
+        self._tokens: Optional[TokenBucket] = None
+        if requests_per_minute is not None:
+            self._requests = TokenBucket(requests_per_minute)
+        if tokens_per_minute is not None:
+            self._tokens = TokenBucket(tokens_per_minute)
+
+    def _reserve(self, tokens: int, timeout: Optional[float]) -> Optional[float]:
+        """Reserve the request and get the seconds to wait for it, or None
+        without a reservation when the wait would exceed timeout."""
+        with self._lock:
+            wait = 0.0
+            if self._requests is not None:
+                wait = self._requests.reserve(1)
+            if self._tokens is not None:
+                wait = max(wait, self._tokens.reserve(tokens))
+            if timeout is not None and wait > timeout:
+                if self._requests is not None:
+                    self._requests.cancel(1)
+                if self._tokens is not None:
+                    self._tokens.cancel(tokens)
+                return None
+            return wait
+
+    def acquire(self, tokens: int = 0, timeout: Optional[float] = None) -> bool:
+        """Wait until the request with the estimated number of tokens may be sent.
+
+        Returns False right away, without taking the budget, when that takes
+        longer than timeout seconds.
+        """
+        wait = self._reserve(tokens, timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    async def aacquire(self, tokens: int = 0, timeout: Optional[float] = None) -> bool:
+        """Wait without blocking the event loop until the request may be sent."""
+        wait = self._reserve(tokens, timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+_limiters: Dict[Tuple[str, str, Optional[float], Optional[float]], RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(
+    api_url: str,
+    deployment_id: str,
+    requests_per_minute: Optional[float],
+    tokens_per_minute: Optional[float],
+) -> RateLimiter:
+    """Get the rate limiter of the deployment and budget shared within the process.
+
+    Models of one deployment with the same budgets share a limiter, models with
+    different budgets each keep to their own.
+    """
+    key = (api_url, deployment_id, requests_per_minute, tokens_per_minute)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(
+                requests_per_minute, tokens_per_minute
+            )
+        return limiter
+
+
+def _count(encoding: Any, value: Any) -> int:
+    if isinstance(value, str):
+        return len(encoding.encode(value, disallowed_special=()))
+    if isinstance(value, list):
+        # token arrays are counted as they are
+        if value and isinstance(value[0], int):
+            return len(value)
+        return sum(_count(encoding, item) for item in value)
+    return 0
+
+
+def estimate_tokens(kwargs: Dict[str, Any], deployment_id: str) -> int:
+    """Estimate the tokens a request uses before it is sent.
+
+    Counts the prompt, messages or input with tiktoken and adds max_tokens for
+    each of the n completions of every prompt.
+    """
+    encoding = tokenizer.get_encoding(deployment_id)
+    tokens = 0
+    prompts = 1
+    if "messages" in kwargs:
+        messages: List[Dict[str, Any]] = kwargs["messages"]
+        # every message is wrapped in 3 tokens, every reply primed with 3
+        tokens += 3 + sum(
+            3
+            + sum(
+                _count(encoding, str(value))
+                for value in message.values()
+                if value is not None
+            )
+            for message in messages
+        )
+    if "prompt" in kwargs:
+        prompt = kwargs["prompt"]
+        tokens += _count(encoding, prompt)
+        if isinstance(prompt, list) and prompt and not isinstance(prompt[0], int):
+            prompts = len(prompt)
+    if "input" in kwargs:
+        tokens += _count(encoding, kwargs["input"])
+    max_tokens = kwargs.get("max_tokens")
+    if max_tokens is not None and max_tokens > 0:
+        tokens += max_tokens * (kwargs.get("n") or 1) * prompts
+    return tokens
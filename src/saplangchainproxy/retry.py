@@ -0,0 +1,184 @@
+"""Retries of the requests to the SAP AI proxy."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Optional, Sequence, Type, Union
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from tenacity import (
+    RetryCallState,
+    before_sleep_log,
+    retry,
+    retry_if_exception_type,
+)
+from tenacity.stop import stop_base
+from tenacity.wait import wait_base
+
+from saplangchainproxy.sapwrapper import (
+    APIConnectionError,
+    APIError,
+    RateLimitError,
+    ServiceUnavailableError,
+    Timeout,
+)
+
+logger = logging.getLogger(__name__)
+
+# Errors worth another attempt, the others fail the same way again
+RETRYABLE_ERRORS: Sequence[Type[BaseException]] = (
+    Timeout,
+    APIError,
+    APIConnectionError,
+    RateLimitError,
+    ServiceUnavailableError,
+)
+
+
+class RetryBudget:
+    """Retries allowed to all requests of the process.
+
+    Every request adds ratio retries to the budget and min_per_second retries
+    are added every second, up to max_balance. A retry takes one from the
+    budget, once it is used up errors are raised right away. A degraded proxy
+    therefore gets at most ratio times more requests instead of a retry storm.
+    """
+
+    def __init__(
+        self, ratio: float = 0.2, min_per_second: float = 1.0, max_balance: float = 10.0
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self._balance = max_balance
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, amount: float) -> None:
+        now = time.monotonic()
+        self._balance = min(
+            self.max_balance,
+            self._balance + amount + (now - self._updated) * self.min_per_second,
+        )
+        self._updated = now
+
+    def deposit(self) -> None:
+        """Add the share of retries of a new request."""
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        """Take a retry from the budget, False if there is none left."""
+        with self._lock:
+            self._refill(0.0)
+            if self._balance < 1.0:
+                return False
+            self._balance -= 1.0
+            return True
+
+
+# Retry budget shared by all models of the process
+retry_budget = RetryBudget()
+
+
+class _stop(stop_base):
+    """Stop after max_retries attempts, at the deadline or without budget."""
+
+    def __init__(self, max_retries: int, deadline: Optional[float]):
+        self.max_retries = max_retries
+        self.deadline = deadline
+
+    def __call__(self, retry_state: RetryCallState) -> bool:
+        if retry_state.attempt_number >= self.max_retries:
+            return True
+        if self.deadline is not None:
+            error = retry_state.outcome.exception()
+            delay = getattr(error, "retry_after", None) or 0.0
+            if retry_state.seconds_since_start + delay >= self.deadline:
+                return True
+        if not retry_budget.withdraw():
+            logger.warning("Retry budget exhausted, not retrying.")
+            return True
+        return False
+
+
+class _wait(wait_base):
+    """Wait as long as the proxy asks for, else exponentially with full jitter."""
+
+    def __init__(self, max_seconds: float, deadline: Optional[float]):
+        self.max_seconds = max_seconds
+        self.deadline = deadline
+
+    def __call__(self, retry_state: RetryCallState) -> float:
+        error = retry_state.outcome.exception()
+        delay = getattr(error, "retry_after", None)
+        if delay is None:
+            # full jitter keeps the clients that failed together from retrying together
+            delay = random.uniform(
+                0, min(self.max_seconds, 2 ** retry_state.attempt_number)
+            )
+        if self.deadline is not None:
+            delay = min(delay, max(0.0, self.deadline - retry_state.seconds_since_start))
+        return delay
+
+
+def _deposit(retry_state: RetryCallState) -> None:
+    if retry_state.attempt_number == 1:
+        retry_budget.deposit()
+
+
+def create_retry_decorator(
+    max_retries: int = 1,
+    run_manager: Optional[
+        Union[AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun]
+    ] = None,
+    deadline: Optional[float] = None,
+    error_types: Sequence[Type[BaseException]] = RETRYABLE_ERRORS,
+    max_seconds: float = 10.0,
+    total_timeout: Optional[float] = None,
+) -> Callable[[Any], Any]:
+    """Create a retry decorator for the calls to the proxy.
+
+    Args:
+        max_retries: Maximum number of attempts.
+        run_manager: Callback manager notified of every retry.
+        deadline: Seconds after the first attempt after which no retry starts.
+        error_types: Errors to retry.
+        max_seconds: Maximum wait between attempts without a Retry-After header.
+        total_timeout: Seconds the call may take in total, no retry starts or
+            waits beyond it.
+    """
+    if total_timeout is not None:
+        deadline = total_timeout if deadline is None else min(deadline, total_timeout)
+    _logging = before_sleep_log(logger, logging.WARNING)
+
+    def _before_sleep(retry_state: RetryCallState) -> None:
+        _logging(retry_state)
+        if run_manager:
+            if isinstance(run_manager, AsyncCallbackManagerForLLMRun):
+                coro = run_manager.on_retry(retry_state)
+                try:
+                    loop = asyncio.get_event_loop()
+                    if loop.is_running():
+                        loop.create_task(coro)
+                    else:
+                        asyncio.run(coro)
+                except Exception as e:
+                    logger.warning(f"Error in on_retry: {e}")
+            else:
+                run_manager.on_retry(retry_state)
+
+    return retry(
+        reraise=True,
+        stop=_stop(max_retries, deadline),
+        wait=_wait(max_seconds, deadline),
+        retry=retry_if_exception_type(tuple(error_types)),
+        before=_deposit,
+        before_sleep=_before_sleep,
+    )
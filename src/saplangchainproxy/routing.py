@@ -0,0 +1,412 @@
+"""Load balancing and failover over several SAP AI proxy endpoints."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Literal, Optional, Sequence, Set
+
+from saplangchainproxy.retry import RetryBudget
+from saplangchainproxy.sapwrapper import (
+    APIConnectionError,
+    APIError,
+    AuthenticationError,
+    RateLimitError,
+    ServiceUnavailableError,
+    Timeout,
+    _SAPClient,
+)
+
+logger = logging.getLogger(__name__)
+
+# Latencies of recent requests the hedging delay is taken from
+HEDGE_WINDOW = 200
+# Requests to measure before the first hedge
+HEDGE_MIN_SAMPLES = 20
+
+# Errors of one endpoint which another endpoint may not have
+FAILOVER_ERRORS = (
+    APIConnectionError,
+    APIError,
+    AuthenticationError,
+    RateLimitError,
+    ServiceUnavailableError,
+    Timeout,
+)
+
+# Errors which count against the health of the endpoint, an exceeded quota does not
+UNHEALTHY_ERRORS = (
+    APIConnectionError,
+    APIError,
+    AuthenticationError,
+    ServiceUnavailableError,
+    Timeout,
+)
+
+
+def _expired(kwargs: Any) -> bool:
+    """Whether the deadline of the call has passed, no endpoint is tried after it."""
+    deadline = kwargs.get("deadline")
+    return deadline is not None and time.monotonic() >= deadline
+
+
+class CircuitBreaker:
+    """Stops sending requests to an endpoint after consecutive failures.
+
+    After failure_threshold consecutive failures the circuit opens for
+    reset_timeout seconds. Then a single probe request is let through: its
+    success closes the circuit, its failure opens it again. With failure_threshold
+    None the circuit never opens.
+    """
+
+    def __init__(self, failure_threshold: Optional[int] = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """closed, open or half_open."""
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return "open"
+            return "half_open"
+
+    def available(self) -> bool:
+        """Whether a request may be sent, without taking the probe."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            return not self._probing
+
+    def allow(self) -> bool:
+        """Whether a request may be sent, a half-open circuit allows one probe."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        if self.failure_threshold is None:
+            return
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warning(
+                        "Opening the circuit after %d failures.", self._failures
+                    )
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def record_release(self) -> None:
+        """Release the probe after a request which tells nothing about the health."""
+        with self._lock:
+            self._probing = False
+
+
+class Endpoint:
+    """Proxy endpoint with its client, load and health."""
+
+    def __init__(self, client: _SAPClient, breaker: CircuitBreaker, ewma_alpha: float):
+        self.client = client
+        self.breaker = breaker
+        self.ewma_alpha = ewma_alpha
+        self.outstanding = 0
+        # exponentially weighted moving average of the latency in seconds
+        self.latency: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return (
+            f"Endpoint(api_url={self.client.api_url!r}, state={self.breaker.state!r}, "
+            f"outstanding={self.outstanding}, latency={self.latency})"
+        )
+
+    def begin(self) -> float:
+        with self._lock:
+            self.outstanding += 1
+        return time.monotonic()
+
+    def end(self, start: float, healthy: Optional[bool]) -> None:
+        """Record the end of a request, healthy None if it tells nothing."""
+        with self._lock:
+            self.outstanding -= 1
+            if healthy:
+                latency = time.monotonic() - start
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.ewma_alpha * (latency - self.latency)
+        if healthy is None:
+            self.breaker.record_release()
+        elif healthy:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+
+class Router:
+    """Client balancing the requests over the clients of several endpoints.
+
+    Requests go to the endpoint with the least outstanding requests or, with the
+    ewma strategy, the lowest latency average weighted by its outstanding
+    requests. Requests failing on one endpoint fail over to the next healthy one,
+    endpoints failing repeatedly are skipped by their circuit breaker until a
+    probe request succeeds again.
+
+    With hedge_percentile set, a non-streaming request which has not answered
+    within that percentile of the recent latencies is sent once more, to another
+    endpoint if there is one. The first response wins, the other request is
+    cancelled. Like retries, hedges are taken from a budget which grows by
+    hedge_budget with every request, so hedging adds at most that share of
+    requests. A hedged synchronous request runs on a thread of its own, as does
+    its hedge. They cannot be interrupted, the slower one finishes in the
+    background and its response is dropped.
+
+    With circuit_breaker False endpoints are never skipped, e.g. when there is a
+    single endpoint which is only wrapped for hedging.
+
+    Example:
+        .. code-block:: python
+
+            from saplangchainproxy.chat import SAPChatOpenAI
+
+            chat = SAPChatOpenAI(endpoints=[
+                {"api_url": "https://eu10.../api/v1", "client_id": "...",
+                 "client_secret": "...", "token_url": "https://.../oauth/token"},
+                {"api_url": "https://us10.../api/v1", "client_id": "...",
+                 "client_secret": "...", "token_url": "https://.../oauth/token"},
+            ], load_balancing="ewma")
+    """
+
+    def __init__(
+        self,
+        clients: Sequence[_SAPClient],
+        strategy: Literal["least_outstanding", "ewma"] = "least_outstanding",
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        ewma_alpha: float = 0.3,
+        hedge_percentile: Optional[float] = None,
+        hedge_budget: float = 0.1,
+        circuit_breaker: bool = True,
+    ):
+        if not clients:
+            raise ValueError("At least one endpoint is needed.")
+        if strategy not in ("least_outstanding", "ewma"):
+            raise ValueError(f"Unknown load balancing strategy {strategy}.")
+        if hedge_percentile is not None and not 0 < hedge_percentile <= 100:
+            raise ValueError("hedge_percentile must be between 0 and 100.")
+        self.strategy = strategy
+        self.hedge_percentile = hedge_percentile
+        self._hedges = RetryBudget(ratio=hedge_budget, min_per_second=0.0)
+        self._latencies: Deque[float] = deque(maxlen=HEDGE_WINDOW)
+        self._lock = threading.Lock()
+        self.endpoints = [
+            Endpoint(
+                client,
+                CircuitBreaker(failure_threshold if circuit_breaker else None, reset_timeout),
+                ewma_alpha,
+            )
+            for client in clients
+        ]
+
+    def __repr__(self) -> str:
+        return f"Router(strategy={self.strategy!r}, endpoints={self.endpoints!r})"
+
+    @property
+    def api_url(self) -> str:
+        return self.endpoints[0].client.api_url
+
+    def _load(self, endpoint: Endpoint) -> float:
+        if self.strategy == "ewma":
+            # endpoints without a measurement yet are tried first
+            return (endpoint.latency or 0.0) * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def _pick(self, tried: Set[int]) -> Optional[Endpoint]:
+        candidates = [
+            e for e in self.endpoints if id(e) not in tried and e.breaker.available()
+        ]
+        # ties are broken randomly to spread the load
+        random.shuffle(candidates)
+        for endpoint in sorted(candidates, key=self._load):
+            if endpoint.breaker.allow():
+                return endpoint
+        return None
+
+    def _healthy(self, error: BaseException) -> Optional[bool]:
+        if isinstance(error, UNHEALTHY_ERRORS):
+            return False
+        return None
+
+    def _hedge_delay(self, kwargs: Any) -> Optional[float]:
+        """Seconds after which to hedge the request, None to not hedge it."""
+        if self.hedge_percentile is None or kwargs.get("stream"):
+            return None
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        index = int(len(latencies) * self.hedge_percentile / 100)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def _record_latency(self, kwargs: Any, start: float) -> None:
+        if self.hedge_percentile is not None and not kwargs.get("stream"):
+            with self._lock:
+                self._latencies.append(time.monotonic() - start)
+
+    def _try(self, tried: Set[int], endpoint: Endpoint) -> None:
+        # a hedge on another thread takes a snapshot of the set meanwhile
+        with self._lock:
+            tried.add(id(endpoint))
+
+    def _hedge_tried(self, tried: Set[int]) -> Set[int]:
+        """Endpoints the hedge avoids, the one of the request if there are others."""
+        with self._lock:
+            tried = set(tried)
+        return tried if len(tried) < len(self.endpoints) else set()
+
+    def _create(self, kwargs: Any, tried: Set[int]) -> Any:
+        lastError: Optional[BaseException] = None
+        while True:
+            endpoint = self._pick(tried)
+            if endpoint is None:
+                break
+            self._try(tried, endpoint)
+            start = endpoint.begin()
+            try:
+                response = endpoint.client.create(**kwargs)
+            except FAILOVER_ERRORS as e:
+                endpoint.end(start, self._healthy(e))
+                if _expired(kwargs):
+                    raise
+                logger.warning("Request to %s failed, failing over: %s", endpoint.client.api_url, e)
+                lastError = e
+                continue
+            except BaseException:
+                endpoint.end(start, None)
+                raise
+            endpoint.end(start, True)
+            self._record_latency(kwargs, start)
+            return response
+        if lastError is not None:
+            raise lastError
+        raise ServiceUnavailableError("No healthy endpoint is available.")
+
+    async def _acreate(self, kwargs: Any, tried: Set[int]) -> Any:
+        lastError: Optional[BaseException] = None
+        while True:
+            endpoint = self._pick(tried)
+            if endpoint is None:
+                break
+            self._try(tried, endpoint)
+            start = endpoint.begin()
+            try:
+                response = await endpoint.client.acreate(**kwargs)
+            except FAILOVER_ERRORS as e:
+                endpoint.end(start, self._healthy(e))
+                if _expired(kwargs):
+                    raise
+                logger.warning("Request to %s failed, failing over: %s", endpoint.client.api_url, e)
+                lastError = e
+                continue
+            except BaseException:
+                endpoint.end(start, None)
+                raise
+            endpoint.end(start, True)
+            self._record_latency(kwargs, start)
+            return response
+        if lastError is not None:
+            raise lastError
+        raise ServiceUnavailableError("No healthy endpoint is available.")
+
+    def _start(self, kwargs: Any, tried: Set[int], results: queue.Queue) -> None:
+        """Send the request on a thread of its own, its outcome goes to results."""
+
+        def run() -> None:
+            try:
+                results.put((True, self._create(kwargs, tried)))
+            except BaseException as e:
+                results.put((False, e))
+
+        threading.Thread(target=run, name="sap-hedge", daemon=True).start()
+
+    def create(self, **kwargs: Any) -> Any:
+        delay = self._hedge_delay(kwargs)
+        if delay is None:
+            return self._create(kwargs, set())
+        self._hedges.deposit()
+        tried: Set[int] = set()
+        results: queue.Queue = queue.Queue()
+        self._start(kwargs, tried, results)
+        attempts = 1
+        try:
+            outcome = results.get(timeout=delay)
+        except queue.Empty:
+            if self._hedges.withdraw():
+                logger.debug("No response after %.3f seconds, hedging the request.", delay)
+                self._start(kwargs, self._hedge_tried(tried), results)
+                attempts += 1
+            outcome = results.get()
+        error: Optional[BaseException] = None
+        while True:
+            succeeded, value = outcome
+            if succeeded:
+                return value
+            error = error or value
+            attempts -= 1
+            if not attempts:
+                raise error
+            outcome = results.get()
+
+    async def acreate(self, **kwargs: Any) -> Any:
+        delay = self._hedge_delay(kwargs)
+        if delay is None:
+            return await self._acreate(kwargs, set())
+        self._hedges.deposit()
+        tried: Set[int] = set()
+        tasks = [asyncio.ensure_future(self._acreate(kwargs, tried))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._hedges.withdraw():
+                return await tasks[0]
+            logger.debug("No response after %.3f seconds, hedging the request.", delay)
+            tasks.append(
+                asyncio.ensure_future(self._acreate(kwargs, self._hedge_tried(tried)))
+            )
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
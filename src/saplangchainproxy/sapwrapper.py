@@ -21,160 +21,1027 @@
 # Embeddings:           POST <url>/api/v1/embeddings
 
 
-from datetime import datetime
-from datetime import timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, FrozenSet, Iterator, List, Mapping, NamedTuple, Optional, Tuple, Union
+import asyncio
+import concurrent.futures
+import email.utils
+import logging
+import threading
+import time
+import weakref
 
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
 import requests
 import json
 
-# OAuth2 token
-token = {
-            "sapopenai": {
-                "envParams": {
-                    "token": "OPENAI_TOKENURL",
-                    "id": "OPENAI_CLIENTID",
-                    "sec": "OPENAI_CLIENTSECRET"
-                },
-                "token": {}
-                }
-        }
+from saplangchainproxy import codec
+from saplangchainproxy.cache import ResponseCache, canonical_hash
+from saplangchainproxy.ratelimit import RateLimiter, estimate_tokens, get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+class SAPProxyError(Exception):
+    """Error of a request to the SAP AI proxy.
+
+    Carries the HTTP status code and headers of the response, if there was one,
+    and the seconds to wait before retrying given by the Retry-After header.
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None,
+                 headers: Optional[Mapping[str, str]] = None, body: Optional[str] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = dict(headers or {})
+        self.body = body
+        self.retry_after = _parse_retry_after(self.headers)
+
+
+class APIError(SAPProxyError):
+    """Unexpected error of the proxy, e.g. an internal server error."""
+
+
+class APIConnectionError(SAPProxyError):
+    """The proxy could not be reached."""
+
+
+class Timeout(SAPProxyError):
+    """The request timed out."""
+
+
+class RateLimitError(SAPProxyError):
+    """The quota of the deployment is exceeded (429)."""
+
+
+class ServiceUnavailableError(SAPProxyError):
+    """The proxy or the deployment is overloaded or down (502, 503, 504)."""
+
+
+class AuthenticationError(SAPProxyError):
+    """The token was rejected (401, 403)."""
+
+
+class InvalidRequestError(SAPProxyError):
+    """The request was rejected, e.g. unknown deployment or input too large."""
+
+
+def _parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Get the seconds to wait from the retry-after-ms or Retry-After header."""
+    lowerHeaders = {k.lower(): v for k, v in headers.items()}
+    try:
+        if "retry-after-ms" in lowerHeaders:
+            return max(0.0, float(lowerHeaders["retry-after-ms"]) / 1000)
+        value = lowerHeaders.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # HTTP date
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _error_for_status(status: int, headers: Mapping[str, str], body: str) -> SAPProxyError:
+    """Map the HTTP status of a failed response to the typed error."""
+    try:
+        message = json.loads(body)["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        message = body[:500]
+    message = f"{status}: {message}"
+    if status == 429:
+        errorType = RateLimitError
+    elif status in (502, 503, 504):
+        errorType = ServiceUnavailableError
+    elif status == 408:
+        errorType = Timeout
+    elif status in (401, 403):
+        errorType = AuthenticationError
+    elif 400 <= status < 500:
+        errorType = InvalidRequestError
+    else:
+        errorType = APIError
+    return errorType(message, status_code=status, headers=headers, body=body)
+
+
+# OAuth2 tokens, refreshed this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 60
+TOKEN_REFRESH_MARGIN = 300
+# Seconds to wait for the token endpoint
+TOKEN_TIMEOUT = 30.0
+
+# Timeouts of a request without request_timeout
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 600.0
+
+# Parameters of the calls which configure the client and are never sent to the proxy
+CLIENT_PARAMS = frozenset(["request_timeout", "stream_timeout", "deadline"])
+
+
+class _Timeouts(NamedTuple):
+    """Timeouts of one call to the proxy.
+
+    connect and read bound connecting and every read from the socket, stream the
+    wait between two chunks of a streamed response. deadline is the time.monotonic()
+    by which the whole call, including retries, must be done.
+    """
+
+    connect: Optional[float]
+    read: Optional[float]
+    stream: Optional[float]
+    deadline: Optional[float]
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left until the deadline, raises Timeout once it has passed."""
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise Timeout("Deadline of the request exceeded")
+        return remaining
+
+    def socket(self, stream: bool) -> Tuple[Optional[float], Optional[float]]:
+        """Connect and read timeouts of the socket, cut to the deadline."""
+        remaining = self.remaining()
+        read = self.stream if stream else self.read
+        if remaining is None:
+            return self.connect, read
+        return _shortest(self.connect, remaining), _shortest(read, remaining)
+
+
+def _shortest(timeout: Optional[float], remaining: float) -> float:
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def _timeouts(kwargs: Mapping[str, Any]) -> _Timeouts:
+    """Timeouts of the call from request_timeout, a number or a (connect, read)
+    tuple, stream_timeout and the deadline."""
+    requestTimeout: Union[None, float, Tuple[float, float]] = kwargs.get("request_timeout")
+    if requestTimeout is None:
+        connect, read = DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+    elif isinstance(requestTimeout, (tuple, list)):
+        connect, read = requestTimeout
+    else:
+        connect = read = requestTimeout
+    stream = kwargs.get("stream_timeout")
+    return _Timeouts(connect, read, read if stream is None else stream, kwargs.get("deadline"))
+
+
+class TokenManager:
+    """OAuth2 client credentials token for one token url and client id.
+
+    Only one fetch runs at a time, concurrent callers wait for it instead of
+    fetching themselves. When the token gets close to its expiry it is refreshed
+    in a background thread and the still valid token is served in the meantime,
+    so requests only wait for the token endpoint when there is no valid token.
+    """
+
+    def __init__(self, token_url: str, client_id: str, client_secret: str):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self._oauth = OAuth2Session(client=BackendApplicationClient(client_id=client_id))
+        self._token: Dict[str, Any] = {}
+        self._refresh_margin = TOKEN_REFRESH_MARGIN
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    def _remaining(self) -> float:
+        """Seconds until the current token expires."""
+        if not self._token:
+            return float("-inf")
+        return self._token["expires_at"] - time.time()
+
+    def _header(self) -> str:
+        currentToken = self._token
+        return f"{currentToken['token_type']} {currentToken['access_token']}"
+
+    def _fetch(self, timeout: Optional[float] = None) -> None:
+        try:
+            newToken = self._oauth.fetch_token(token_url=self.token_url, client_id=self.client_id,
+                                               client_secret=self.client_secret,
+                                               timeout=TOKEN_TIMEOUT if timeout is None else min(TOKEN_TIMEOUT, timeout))
+        except requests.Timeout as e:
+            raise Timeout(f"Fetching the token timed out: {e}") from e
+        lifetime = newToken["expires_at"] - time.time()
+        # short lived tokens are refreshed after half of their lifetime
+        self._refresh_margin = min(TOKEN_REFRESH_MARGIN, max(lifetime / 2, TOKEN_EXPIRY_MARGIN))
+        self._token = newToken
+
+    def _refresh(self) -> None:
+        try:
+            with self._lock:
+                if self._remaining() > self._refresh_margin:
+                    return
+                self._fetch()
+        except Exception as e:
+            logger.warning(f"Background refresh of the token failed: {e}")
+        finally:
+            self._refreshing = False
+
+    def _refresh_in_background(self) -> None:
+        with self._refresh_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, name="sapwrapper-token-refresh", daemon=True).start()
+
+    def get(self, timeout: Optional[float] = None) -> str:
+        """Return the authorization header value, fetching a token if there is no valid one.
+
+        Raises Timeout when no token is there within timeout seconds.
+        """
+        remaining = self._remaining()
+        if remaining <= TOKEN_EXPIRY_MARGIN:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            if not self._lock.acquire(timeout=-1 if timeout is None else timeout):
+                raise Timeout("Timed out waiting for the token")
+            try:
+                if self._remaining() <= TOKEN_EXPIRY_MARGIN:
+                    self._fetch(None if deadline is None else max(deadline - time.monotonic(), 0.001))
+            finally:
+                self._lock.release()
+        elif remaining <= self._refresh_margin:
+            self._refresh_in_background()
+        return self._header()
+
+    async def aget(self, timeout: Optional[float] = None) -> str:
+        """Return the authorization header value without blocking the event loop."""
+        if self._remaining() > TOKEN_EXPIRY_MARGIN:
+            return self.get()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get, timeout)
+
+
+_token_managers: Dict[Tuple[str, str], TokenManager] = {}
+_token_managers_lock = threading.Lock()
+
+
+def get_token_manager(token_url: str, client_id: str, client_secret: str) -> TokenManager:
+    """Return the shared token manager for the token url and client id."""
+    key = (token_url, client_id)
+    manager = _token_managers.get(key)
+    if manager is None or manager.client_secret != client_secret:
+        with _token_managers_lock:
+            manager = _token_managers.get(key)
+            if manager is None or manager.client_secret != client_secret:
+                manager = TokenManager(token_url, client_id, client_secret)
+                _token_managers[key] = manager
+    return manager
+
+
+# Shared keep-alive HTTP sessions, one per upstream url and pool configuration
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+_sessions: Dict[Tuple[str, int, int], requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url: str, pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+                pool_maxsize: int = DEFAULT_POOL_MAXSIZE) -> requests.Session:
+    """Return the shared pooled session for the upstream url.
+
+    Sessions keep their connections alive, so consecutive calls to the AI proxy
+    reuse the TCP/TLS connection instead of doing a new handshake per call.
+    """
+    key = (url, pool_connections, pool_maxsize)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({"Connection": "keep-alive"})
+                _sessions[key] = session
+    return session
+
+
+# End of stream marker of the server-sent events
+_DONE = object()
+
+
+def _parse_event(line: bytes) -> Any:
+    """Parse a server-sent events line, returns None for lines without data and
+    _DONE for the end of stream marker."""
+    line = line.strip()
+    if not line.startswith(b"data:"):
+        return None
+    data = line[5:].strip()
+    if data == b"[DONE]":
+        return _DONE
+    return codec.loads(data)
+
+
+def _iter_events(response: requests.Response, deadline: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    """Yield the events of a streamed response as they arrive on the socket.
+
+    The read timeout of the socket bounds the wait for every chunk.
+    """
+    try:
+        # without a chunk size the lines are read as the data arrives, not in 512 byte reads
+        for line in response.iter_lines(chunk_size=None):
+            event = _parse_event(line)
+            if event is _DONE:
+                break
+            if event is not None:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise Timeout("Deadline of the request exceeded while streaming")
+                yield event
+    except requests.ConnectionError as e:
+        # requests wraps the read timeouts of a streamed body
+        if e.args and isinstance(e.args[0], ReadTimeoutError):
+            raise Timeout(f"No chunk of the stream within the timeout: {e}") from e
+        raise APIConnectionError(str(e)) from e
+    except requests.exceptions.ChunkedEncodingError as e:
+        raise APIConnectionError(f"The stream was cut off: {e}") from e
+    except requests.RequestException as e:
+        raise APIConnectionError(str(e)) from e
+    finally:
+        response.close()
+
+
+def _import_aiohttp() -> Any:
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError(
+            "Could not import aiohttp python package. "
+            "This is needed in order to use the async api (acreate). "
+            "Please install it with `pip install aiohttp`."
+        )
+    return aiohttp
+
+
+# Async sessions are bound to the event loop they were created in
+DEFAULT_ASYNC_POOL_MAXSIZE = 100
+_async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, int], Any]]" = weakref.WeakKeyDictionary()
+
+
+_async_session_closers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncIterator[None]]" = weakref.WeakKeyDictionary()
+
+
+async def _close_on_shutdown(sessions: Dict[Tuple[str, int], Any]) -> AsyncIterator[None]:
+    """Close the sessions of the event loop when it shuts down its async generators,
+    as asyncio.run does before it closes the loop."""
+    try:
+        yield
+    finally:
+        for session in list(sessions.values()):
+            await session.close()
+
+
+def get_async_session(url: str, pool_maxsize: int = DEFAULT_ASYNC_POOL_MAXSIZE) -> Any:
+    """Return the shared aiohttp session for the upstream url in the running event loop.
+
+    Connections are kept alive and limited to pool_maxsize concurrent connections
+    per upstream host, further requests wait for a free connection. The sessions
+    are closed when asyncio.run shuts the event loop down.
+    """
+    aiohttp = _import_aiohttp()
+    loop = asyncio.get_running_loop()
+    sessions = _async_sessions.get(loop)
+    if sessions is None:
+        sessions = _async_sessions[loop] = {}
+        closer = _async_session_closers[loop] = _close_on_shutdown(sessions)
+        # once started, the loop closes the generator when it shuts down
+        loop.create_task(closer.__anext__())
+    key = (url, pool_maxsize)
+    session = sessions.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=pool_maxsize)
+        session = aiohttp.ClientSession(connector=connector)
+        sessions[key] = session
+    return session
+
+
+async def aclose_sessions() -> None:
+    """Close the async sessions of the running event loop, e.g. on application shutdown.
+
+    asyncio.run closes them on its own, other loops have to call this before they close.
+    """
+    sessions = _async_sessions.pop(asyncio.get_running_loop(), {})
+    for session in sessions.values():
+        await session.close()
+
+
+async def _aiter_events(response: Any) -> AsyncIterator[Dict[str, Any]]:
+    """Yield the events of a streamed aiohttp response as they arrive on the socket."""
+    aiohttp = _import_aiohttp()
+    try:
+        async for line in response.content:
+            event = _parse_event(line)
+            if event is _DONE:
+                break
+            if event is not None:
+                yield event
+    except asyncio.TimeoutError as e:
+        raise Timeout(str(e) or "No chunk of the stream within the timeout") from e
+    except aiohttp.ClientError as e:
+        raise APIConnectionError(str(e)) from e
+    finally:
+        response.release()
+
+
+class _FanOut:
+    """Replays the events of one stream to every subscriber.
+
+    The events are buffered, so late subscribers get the whole stream. Any
+    subscriber pulls the next event from the upstream response. When every
+    subscriber stops reading early, the upstream response is closed.
+    """
+
+    def __init__(self, events: Iterator[Dict[str, Any]], on_done: Callable[[], None]):
+        self._events = events
+        self._on_done = on_done
+        self._buffer: List[Dict[str, Any]] = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._subscribers = 0
+        self._lock = threading.Lock()
+
+    def _next(self, position: int) -> Any:
+        with self._lock:
+            if position < len(self._buffer):
+                return self._buffer[position]
+            if not self._done:
+                try:
+                    self._buffer.append(next(self._events))
+                    return self._buffer[position]
+                except StopIteration:
+                    pass
+                except Exception as e:
+                    self._error = e
+                self._done = True
+                self._on_done()
+            if self._error is not None:
+                raise self._error
+            return _DONE
+
+    def _unsubscribe(self) -> None:
+        with self._lock:
+            self._subscribers -= 1
+            if self._subscribers or self._done:
+                return
+            self._done = True
+            self._error = APIConnectionError("The shared stream was closed by all its readers")
+            self._on_done()
+        close = getattr(self._events, "close", None)
+        if close is not None:
+            close()
+
+    def subscribe(self) -> Iterator[Dict[str, Any]]:
+        with self._lock:
+            self._subscribers += 1
+        return _Subscription(self)
+
+
+class _Subscription:
+    """Events of a fanned out stream for one subscriber, closed once it stops reading."""
+
+    def __init__(self, fanOut: _FanOut):
+        self._fanOut = fanOut
+        self._position = 0
+        self._closed = False
+
+    def __iter__(self) -> "_Subscription":
+        return self
+
+    def __next__(self) -> Dict[str, Any]:
+        if self._closed:
+            raise StopIteration
+        try:
+            event = self._fanOut._next(self._position)
+        except BaseException:
+            self.close()
+            raise
+        if event is _DONE:
+            self.close()
+            raise StopIteration
+        self._position += 1
+        return event
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._fanOut._unsubscribe()
+
+    def __del__(self) -> None:
+        self.close()
+
+
+async def _aclose_events(events: AsyncIterator[Dict[str, Any]]) -> None:
+    aclose = getattr(events, "aclose", None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except RuntimeError:
+        # still running in the subscriber being cancelled, which closes it
+        pass
+
+
+class _AsyncFanOut:
+    """Replays the events of one async stream to every subscriber of its event loop."""
+
+    def __init__(self, events: AsyncIterator[Dict[str, Any]], on_done: Callable[[], None]):
+        self._events = events
+        self._on_done = on_done
+        self._buffer: List[Dict[str, Any]] = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._subscribers = 0
+        self._loop = asyncio.get_running_loop()
+        self._lock = asyncio.Lock()
+
+    async def _next(self, position: int) -> Any:
+        async with self._lock:
+            if position < len(self._buffer):
+                return self._buffer[position]
+            if not self._done:
+                try:
+                    self._buffer.append(await self._events.__anext__())
+                    return self._buffer[position]
+                except StopAsyncIteration:
+                    pass
+                except Exception as e:
+                    self._error = e
+                self._done = True
+                self._on_done()
+            if self._error is not None:
+                raise self._error
+            return _DONE
+
+    def _unsubscribe(self) -> None:
+        self._subscribers -= 1
+        if self._subscribers or self._done:
+            return
+        self._done = True
+        self._error = APIConnectionError("The shared stream was closed by all its readers")
+        self._on_done()
+        if not self._loop.is_closed():
+            self._loop.create_task(_aclose_events(self._events))
+
+    def subscribe(self) -> AsyncIterator[Dict[str, Any]]:
+        self._subscribers += 1
+        return _AsyncSubscription(self)
+
+
+class _AsyncSubscription:
+    """Events of a fanned out async stream for one subscriber."""
+
+    def __init__(self, fanOut: _AsyncFanOut):
+        self._fanOut = fanOut
+        self._position = 0
+        self._closed = False
+
+    def __aiter__(self) -> "_AsyncSubscription":
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            event = await self._fanOut._next(self._position)
+        except BaseException:
+            self.close()
+            raise
+        if event is _DONE:
+            self.close()
+            raise StopAsyncIteration
+        self._position += 1
+        return event
+
+    async def aclose(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._fanOut._unsubscribe()
+
+    def __del__(self) -> None:
+        self.close()
+
+
+def _retrieve(future: "asyncio.Future[Any]") -> None:
+    # marks the exception as retrieved when no other caller waited for it
+    if not future.cancelled():
+        future.exception()
+
+
+class _AsyncCall:
+    """Shared call of identical async requests and the number of callers waiting for it."""
 
-class Completion:
     def __init__(self):
-        Completion.openai_api_client_id = ""
-        Completion.openai_api_client_secret = ""
-        Completion.openai_api_url = ""
-        Completion.openai_api_tokenurl = ""
-
-    def getToken(service: str) -> str:
-        global token
-        # -------------- Env. Variables --------------->>>
-        client = BackendApplicationClient(client_id=Completion.openai_api_client_id)
-        # create an OAuth2 session
-        oauth = OAuth2Session(client=client)
-        if token[service]['token'] == {}:
-            token[service]['token'] = oauth.fetch_token(token_url=Completion.openai_api_tokenurl, client_id=Completion.openai_api_client_id, client_secret=Completion.openai_api_client_secret)    
-        elif datetime.fromtimestamp(token[service]['token']['expires_at']) - datetime.now() < timedelta(seconds=60):
-            token[service]['token'] = oauth.fetch_token(token_url=Completion.openai_api_tokenurl, client_id=Completion.openai_api_client_id, client_secret=Completion.openai_api_client_secret)  
-        return f"{token[service]['token']['token_type']} {token[service]['token']['access_token']}"
-    
-    def create(**kwargs):
-        Completion.openai_api_client_id = kwargs['openai_api_client_id']
-        Completion.openai_api_client_secret = kwargs['openai_api_client_secret']
-        Completion.openai_api_tokenurl = kwargs['openai_api_tokenurl']
-        Completion.openai_api_url = kwargs['openai_api_url']
-        openAiUrl = Completion.openai_api_url + '/completions'
+        self.task: Optional["asyncio.Task[Any]"] = None
+        self.waiters = 0
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": Completion.getToken("sapopenai")
-        }
+
+class _Coalescer:
+    """Shares one call to the proxy among identical requests in flight.
+
+    Later callers with the same key wait for the result of the first one, which
+    is shared and must not be modified. Streams stay in flight until they are
+    read to the end or all callers stop reading, and are fanned out to every
+    caller. An async call runs in a task of its own, a cancelled caller only
+    stops waiting for it and the call is cancelled once no caller waits.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, concurrent.futures.Future] = {}
+        self._async_calls: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, _AsyncCall]]" = weakref.WeakKeyDictionary()
+
+    def _forget(self, calls: Dict[str, Any], key: str, future: Any) -> None:
+        with self._lock:
+            if calls.get(key) is future:
+                del calls[key]
+
+    def call(self, key: str, send: Callable[[], Any], stream: bool = False) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            result = future.result()
+            return result.subscribe() if stream else result
+        try:
+            result = send()
+            if stream:
+                result = _FanOut(result, lambda: self._forget(self._calls, key, future))
+        except BaseException as e:
+            self._forget(self._calls, key, future)
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        if not stream:
+            self._forget(self._calls, key, future)
+        return result.subscribe() if stream else result
+
+    async def _arun(self, calls: Dict[str, _AsyncCall], key: str, call: _AsyncCall,
+                    send: Callable[[], Awaitable[Any]], stream: bool) -> Any:
+        try:
+            result = await send()
+        except BaseException:
+            self._forget(calls, key, call)
+            raise
+        if stream:
+            return _AsyncFanOut(result, lambda: self._forget(calls, key, call))
+        self._forget(calls, key, call)
+        return result
+
+    async def acall(self, key: str, send: Callable[[], Awaitable[Any]], stream: bool = False) -> Any:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            calls = self._async_calls.setdefault(loop, {})
+        call = calls.get(key)
+        if call is None:
+            call = calls[key] = _AsyncCall()
+            call.task = loop.create_task(self._arun(calls, key, call, send, stream))
+            call.task.add_done_callback(_retrieve)
+        call.waiters += 1
+        try:
+            # a cancelled caller must not cancel the shared call of the others
+            result = await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            call.waiters -= 1
+            if not call.waiters:
+                self._forget(calls, key, call)
+                if not call.task.done():
+                    call.task.cancel()
+                elif stream and not call.task.cancelled() and call.task.exception() is None:
+                    # nobody reads the stream which came in meanwhile
+                    call.task.result().subscribe().close()
+            raise
+        call.waiters -= 1
+        return result.subscribe() if stream else result
+
+
+# Identical requests in flight of all clients which coalesce requests
+_coalescer = _Coalescer()
+
+
+def _is_cacheable(response: Any) -> bool:
+    """Only successful completions are cached."""
+    return isinstance(response, dict) and "choices" in response and "error" not in response
+
+
+def _events_to_response(events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Assemble the events of a streamed response into the full response."""
+    choices: Dict[int, Dict[str, Any]] = {}
+    for event in events:
+        for choice in event.get("choices", []):
+            index = choice.get("index", 0)
+            if "delta" in choice:
+                assembled = choices.setdefault(index, {
+                    "index": index,
+                    "message": {"role": "assistant", "content": ""},
+                    "finish_reason": None,
+                })
+                delta = choice["delta"]
+                message = assembled["message"]
+                if delta.get("role"):
+                    message["role"] = delta["role"]
+                message["content"] += delta.get("content") or ""
+                if delta.get("function_call"):
+                    functionCall = message.setdefault("function_call", {"name": "", "arguments": ""})
+                    for key in ("name", "arguments"):
+                        functionCall[key] += delta["function_call"].get(key) or ""
+            else:
+                assembled = choices.setdefault(index, {
+                    "index": index, "text": "", "finish_reason": None, "logprobs": None,
+                })
+                assembled["text"] += choice.get("text") or ""
+            if choice.get("finish_reason") is not None:
+                assembled["finish_reason"] = choice["finish_reason"]
+    # streamed responses carry no usage
+    return {"choices": [choices[i] for i in sorted(choices)], "usage": {}}
+
+
+def _response_events(response: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Split the cached response into the events of a streamed response."""
+    events = []
+    for choice in response["choices"]:
+        index = choice.get("index", 0)
+        if "message" in choice:
+            events.append({"choices": [{"index": index, "delta": choice["message"], "finish_reason": None}]})
+            events.append({"choices": [{"index": index, "delta": {}, "finish_reason": choice.get("finish_reason")}]})
+        else:
+            events.append({"choices": [{
+                "index": index,
+                "text": choice["text"],
+                "finish_reason": choice.get("finish_reason"),
+                "logprobs": choice.get("logprobs"),
+            }]})
+    return events
+
+
+def _record_events(events: Iterator[Dict[str, Any]], cache: ResponseCache, key: str) -> Iterator[Dict[str, Any]]:
+    """Pass the events through and cache the response once the stream is complete."""
+    received = []
+    for event in events:
+        received.append(event)
+        yield event
+    response = _events_to_response(received)
+    if response["choices"]:
+        cache.set(key, response)
+
+
+async def _arecord_events(events: AsyncIterator[Dict[str, Any]], cache: ResponseCache, key: str) -> AsyncIterator[Dict[str, Any]]:
+    received = []
+    async for event in events:
+        received.append(event)
+        yield event
+    response = _events_to_response(received)
+    if response["choices"]:
+        await cache.aset(key, response)
+
+
+async def _areplay_events(events: List[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    for event in events:
+        yield event
+
+
+class _SAPClient:
+    """Client for one SAP AI proxy endpoint.
+
+    The client is immutable, it holds the endpoint, the credentials, the connection
+    pool and the token source. Models with different tenants or urls therefore
+    each own their client and can send requests in parallel.
+    """
+
+    path = ""
+    # Parameter holding the model name which is mapped to the SAP deployment_id
+    deploymentParam = "engine"
+    # Parameters of the models that are not sent to the proxy
+    skipParams: FrozenSet[str] = frozenset(["request_timeout"])
+
+    def __init__(self, api_url: str, client_id: str, client_secret: str, token_url: str,
+                 pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+                 async_pool_maxsize: int = DEFAULT_ASYNC_POOL_MAXSIZE,
+                 response_cache: Optional[ResponseCache] = None,
+                 coalesce_requests: bool = False,
+                 requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None):
+        init = super().__setattr__
+        init("api_url", api_url)
+        init("url", api_url + self.path)
+        init("client_id", client_id)
+        init("token_url", token_url)
+        init("pool_connections", pool_connections)
+        init("pool_maxsize", pool_maxsize)
+        init("async_pool_maxsize", async_pool_maxsize)
+        init("token_manager", get_token_manager(token_url, client_id, client_secret))
+        init("session", get_session(api_url, pool_connections, pool_maxsize))
+        init("response_cache", response_cache)
+        init("coalesce_requests", coalesce_requests)
+        init("requests_per_minute", requests_per_minute)
+        init("tokens_per_minute", tokens_per_minute)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable, create a new client instead.")
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(api_url={self.api_url!r}, client_id={self.client_id!r})"
+
+    def deployment_id(self, model: str) -> str:
+        """Map the model name to the SAP deployment_id."""
+        return model
+
+    def _payload(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
         completionData = {}
         for key in kwargs:
-            if key in ["request_timeout", "api_type", "api_version", "openai_api_client_id",
-                       "openai_api_client_secret", "openai_api_tokenurl", "openai_api_url"]:
+            if key in self.skipParams or key in CLIENT_PARAMS:
                 continue
-            if key == "engine": # Needs to be mapped to deployment_id for SAP
-                engine = kwargs[key]
-                if engine == "":
-                    engine = "text-davinci-003"                    
-                completionData['deployment_id'] = engine
+            if key == self.deploymentParam: # Needs to be mapped to deployment_id for SAP
+                completionData['deployment_id'] = self.deployment_id(kwargs[key])
             else:
                 completionData[key] = kwargs[key]
-        jCompletionData = json.dumps(completionData)
-        response = requests.post(openAiUrl, headers=headers, data=jCompletionData)
-        openAiAnswer = response.json()
-        return openAiAnswer
+        return completionData
 
-class Embedding:
-    def __init__(self):
-        Completion.openai_api_client_id = ""
-        Completion.openai_api_client_secret = ""
-        Completion.openai_api_url = ""
-        Completion.openai_api_tokenurl = ""
-
-    def getToken(service: str) -> str:
-        global token
-        client = BackendApplicationClient(client_id=Completion.openai_api_client_id)
-        # create an OAuth2 session
-        oauth = OAuth2Session(client=client)
-        if token[service]['token'] == {}:
-            token[service]['token'] = oauth.fetch_token(token_url=Completion.openai_api_tokenurl, client_id=Completion.openai_api_client_id, client_secret=Completion.openai_api_client_secret)    
-        elif datetime.fromtimestamp(token[service]['token']['expires_at']) - datetime.now() < timedelta(seconds=60):
-            token[service]['token'] = oauth.fetch_token(token_url=Completion.openai_api_tokenurl, client_id=Completion.openai_api_client_id, client_secret=Completion.openai_api_client_secret)  
-        return f"{token[service]['token']['token_type']} {token[service]['token']['access_token']}"
-    
-    def create(**kwargs):
-        Completion.openai_api_client_id = kwargs['api_client_id']
-        Completion.openai_api_client_secret = kwargs['api_client_secret']
-        Completion.openai_api_tokenurl = kwargs['api_token_url']
-        Completion.openai_api_url = kwargs['api_url']
-        openAiUrl = Completion.openai_api_url + '/embeddings'
+    def _rate_limiter(self, payload: Dict[str, Any]) -> Optional[RateLimiter]:
+        if self.requests_per_minute is None and self.tokens_per_minute is None:
+            return None
+        return get_rate_limiter(self.api_url, payload.get("deployment_id", ""),
+                                self.requests_per_minute, self.tokens_per_minute)
+
+    def _cost(self, kwargs: Dict[str, Any], payload: Dict[str, Any]) -> int:
+        """Estimated tokens of the request, only needed for a tokens per minute budget."""
+        if self.tokens_per_minute is None:
+            return 0
+        return estimate_tokens(kwargs, payload.get("deployment_id", ""))
+
+    def _send(self, payload: Dict[str, Any], cost: int = 0, timeouts: Optional[_Timeouts] = None) -> Any:
+        timeouts = timeouts or _timeouts({})
+        limiter = self._rate_limiter(payload)
+        if limiter is not None and not limiter.acquire(cost, timeouts.remaining()):
+            raise Timeout("Deadline of the request exceeded waiting for the rate limit")
+        jCompletionData = codec.dumps(payload)
         headers = {
             "Content-Type": "application/json",
-            "Authorization": Completion.getToken("sapopenai")
+            "Authorization": self.token_manager.get(timeouts.remaining())
         }
-        completionData = {}
-        for key in kwargs:
-            if key == "request_timeout":
-                continue
-            if key == "engine": # Needs to be mapped to deployment_id for SAP
-                engine = kwargs[key]
-                if engine == "" or engine == "text-embedding-ada-002":
-                    engine = "text-embedding-ada-002-v2"                 
-                completionData['deployment_id'] = engine
-            else:
-                completionData[key] = kwargs[key]
-        jCompletionData = json.dumps(completionData)
-        response = requests.post(openAiUrl, headers=headers, data=jCompletionData)
-        openAiAnswer = response.json()
-        return openAiAnswer
-    
-class ChatCompletion:
-    def __init__(self):
-        Completion.openai_api_client_id = ""
-        Completion.openai_api_client_secret = ""
-        Completion.openai_api_url = ""
-        Completion.openai_api_tokenurl = ""
-
-    def getToken(service: str) -> str:
-        global token
-
-        client = BackendApplicationClient(client_id=Completion.openai_api_client_id)
-        # create an OAuth2 session
-        oauth = OAuth2Session(client=client)
-        if token[service]['token'] == {}:
-            token[service]['token'] = oauth.fetch_token(token_url=Completion.openai_api_tokenurl, client_id=Completion.openai_api_client_id, client_secret=Completion.openai_api_client_secret)    
-        elif datetime.fromtimestamp(token[service]['token']['expires_at']) - datetime.now() < timedelta(seconds=60):
-            token[service]['token'] = oauth.fetch_token(token_url=Completion.openai_api_tokenurl, client_id=Completion.openai_api_client_id, client_secret=Completion.openai_api_client_secret)  
-        return f"{token[service]['token']['token_type']} {token[service]['token']['access_token']}"
-    
-    def create(**kwargs):
-        Completion.openai_api_client_id = kwargs['openai_api_client_id']
-        Completion.openai_api_client_secret = kwargs['openai_api_client_secret']
-        Completion.openai_api_tokenurl = kwargs['openai_api_tokenurl']
-        Completion.openai_api_url = kwargs['openai_api_url']
-        openAiUrl = Completion.openai_api_url + '/completions'
+        stream = bool(payload.get("stream"))
+        try:
+            # a streamed request is sent right away, the events are read lazily
+            response = self.session.post(self.url, headers=headers, data=jCompletionData, stream=stream,
+                                         timeout=timeouts.socket(stream))
+        except requests.Timeout as e:
+            raise Timeout(str(e)) from e
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            # the connection dropped before or while the body was read
+            raise APIConnectionError(str(e)) from e
+        if response.status_code >= 400:
+            error = _error_for_status(response.status_code, response.headers, response.text)
+            response.close()
+            raise error
+        if stream:
+            return _iter_events(response, timeouts.deadline)
+        return codec.loads(response.content)
+
+    async def _asend(self, payload: Dict[str, Any], cost: int = 0, timeouts: Optional[_Timeouts] = None) -> Any:
+        timeouts = timeouts or _timeouts({})
+        limiter = self._rate_limiter(payload)
+        if limiter is not None and not await limiter.aacquire(cost, timeouts.remaining()):
+            raise Timeout("Deadline of the request exceeded waiting for the rate limit")
+        jCompletionData = codec.dumps(payload)
         headers = {
             "Content-Type": "application/json",
-            "Authorization": Completion.getToken("sapopenai")
+            "Authorization": await self.token_manager.aget(timeouts.remaining())
         }
-        completionData = {}
-        for key in kwargs:
-            if key in ["request_timeout", "api_key", "api_base", "organization", "max_tokens", "openai_api_client_id", "openai_api_client_secret", "openai_api_tokenurl", "openai_api_url"] :
-                continue
-            if key == "model": # Needs to be mapped to deployment_id for SAP
-                engine = kwargs[key]
-                if engine == "gpt-3.5-turbo":
-                    engine = "gpt-35-turbo"
-                if engine == "":
-                    engine = "gpt-35-turbo"                    
-                completionData['deployment_id'] = engine
-            else:
-                completionData[key] = kwargs[key]
-        jCompletionData = json.dumps(completionData)
-        response = requests.post(openAiUrl, headers=headers, data=jCompletionData)
-        openAiAnswer = response.json()
-        return openAiAnswer
\ No newline at end of file
+        aiohttp = _import_aiohttp()
+        session = get_async_session(self.api_url, self.async_pool_maxsize)
+        stream = bool(payload.get("stream"))
+        connect, read = timeouts.socket(stream)
+        timeout = aiohttp.ClientTimeout(total=timeouts.remaining(), sock_connect=connect, sock_read=read)
+        try:
+            response = await session.post(self.url, headers=headers, data=jCompletionData, timeout=timeout)
+        except asyncio.TimeoutError as e:
+            raise Timeout(str(e) or "Request timed out") from e
+        except aiohttp.ClientConnectionError as e:
+            raise APIConnectionError(str(e)) from e
+        if response.status >= 400:
+            try:
+                error = _error_for_status(response.status, response.headers, await response.text())
+            finally:
+                response.release()
+            raise error
+        if stream:
+            return _aiter_events(response)
+        try:
+            body = await response.read()
+        except asyncio.TimeoutError as e:
+            raise Timeout(str(e) or "Reading the response timed out") from e
+        except aiohttp.ClientError as e:
+            raise APIConnectionError(str(e)) from e
+        finally:
+            response.release()
+        return await codec.aloads(body)
+
+    def _key(self, payload: Dict[str, Any]) -> str:
+        # the tenant is part of the key, responses are not shared between tenants
+        return canonical_hash({"url": self.url, "client_id": self.client_id, "payload": payload})
+
+    def _coalesced_send(self, payload: Dict[str, Any], cost: int, timeouts: _Timeouts) -> Any:
+        if not self.coalesce_requests:
+            return self._send(payload, cost, timeouts)
+        return _coalescer.call(self._key(payload), lambda: self._send(payload, cost, timeouts), bool(payload.get("stream")))
+
+    async def _coalesced_asend(self, payload: Dict[str, Any], cost: int, timeouts: _Timeouts) -> Any:
+        if not self.coalesce_requests:
+            return await self._asend(payload, cost, timeouts)
+        return await _coalescer.acall(self._key(payload), lambda: self._asend(payload, cost, timeouts), bool(payload.get("stream")))
+
+    def _revalidate(self, key: str, payload: Dict[str, Any], cost: int, timeouts: _Timeouts) -> None:
+        unstreamed = {k: v for k, v in payload.items() if k != "stream"}
+
+        def fetch() -> Optional[Any]:
+            # the background fetch is not bound to the deadline of the caller
+            response = self._send(unstreamed, cost, timeouts._replace(deadline=None))
+            return response if _is_cacheable(response) else None
+
+        self.response_cache.revalidate(key, fetch)
+
+    def _records(self, payload: Dict[str, Any]) -> bool:
+        # logprobs are not assembled from streamed responses
+        return not (payload.get("stream") and payload.get("logprobs") is not None)
+
+    def create(self, **kwargs: Any) -> Any:
+        payload = self._payload(kwargs)
+        cost = self._cost(kwargs, payload)
+        timeouts = _timeouts(kwargs)
+        cache = self.response_cache
+        if cache is None:
+            return self._coalesced_send(payload, cost, timeouts)
+        key = cache.key(self.url, self.client_id, payload)
+        cached = cache.get(key)
+        if cached is not None:
+            response, fresh = cached
+            if not fresh:
+                self._revalidate(key, payload, cost, timeouts)
+            return iter(_response_events(response)) if payload.get("stream") else response
+        response = self._coalesced_send(payload, cost, timeouts)
+        if payload.get("stream"):
+            return _record_events(response, cache, key) if self._records(payload) else response
+        if _is_cacheable(response):
+            cache.set(key, response)
+        return response
+
+    async def acreate(self, **kwargs: Any) -> Any:
+        payload = self._payload(kwargs)
+        cost = self._cost(kwargs, payload)
+        timeouts = _timeouts(kwargs)
+        cache = self.response_cache
+        if cache is None:
+            return await self._coalesced_asend(payload, cost, timeouts)
+        key = cache.key(self.url, self.client_id, payload)
+        cached = await cache.aget(key)
+        if cached is not None:
+            response, fresh = cached
+            if not fresh:
+                self._revalidate(key, payload, cost, timeouts)
+            return _areplay_events(_response_events(response)) if payload.get("stream") else response
+        response = await self._coalesced_asend(payload, cost, timeouts)
+        if payload.get("stream"):
+            return _arecord_events(response, cache, key) if self._records(payload) else response
+        if _is_cacheable(response):
+            await cache.aset(key, response)
+        return response
+
+
+class Completion(_SAPClient):
+    path = '/completions'
+    skipParams = frozenset(["request_timeout", "api_type", "api_version"])
+
+    def deployment_id(self, model: str) -> str:
+        return model or "text-davinci-003"
+
+
+class Embedding(_SAPClient):
+    path = '/embeddings'
+
+    def deployment_id(self, model: str) -> str:
+        if model == "" or model == "text-embedding-ada-002":
+            return "text-embedding-ada-002-v2"
+        return model
+
+
+class ChatCompletion(_SAPClient):
+    path = '/completions'
+    deploymentParam = "model"
+    skipParams = frozenset(["request_timeout", "api_key", "api_base", "organization", "max_tokens"])
+
+    def deployment_id(self, model: str) -> str:
+        if model == "gpt-3.5-turbo" or model == "":
+            return "gpt-35-turbo"
+        return model
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from saplangchainproxy import batching
+
+
+class TestMicroBatcher(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+
+    def _process(self, items):
+        self.batches.append(list(items))
+        if "fail" in items:
+            raise ValueError("failed")
+        return [item.upper() for item in items]
+
+    def _run_threads(self, batcher, items):
+        results = {}
+
+        def run(item):
+            try:
+                results[item] = batcher.submit(item)
+            except ValueError as e:
+                results[item] = e
+
+        threads = [threading.Thread(target=run, args=(item,)) for item in items]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_a_batch(self):
+        batcher = batching.MicroBatcher(self._process, max_size=100, max_wait=0.1)
+        items = [f"q{i}" for i in range(10)]
+        results = self._run_threads(batcher, items)
+        self.assertEqual(results, {item: item.upper() for item in items})
+        self.assertEqual(len(self.batches), 1)
+
+    def test_full_batch_is_sent_right_away(self):
+        batcher = batching.MicroBatcher(self._process, max_size=5, max_wait=10)
+        start = time.monotonic()
+        self._run_threads(batcher, [f"q{i}" for i in range(10)])
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(sorted(len(batch) for batch in self.batches), [5, 5])
+
+    def test_error_reaches_every_caller(self):
+        batcher = batching.MicroBatcher(self._process, max_size=2, max_wait=1)
+        results = self._run_threads(batcher, ["a", "fail"])
+        self.assertIsInstance(results["a"], ValueError)
+        self.assertIsInstance(results["fail"], ValueError)
+
+
+class TestAsyncMicroBatcher(unittest.TestCase):
+    def test_batches_tasks(self):
+        batches = []
+
+        async def process(items):
+            batches.append(list(items))
+            await asyncio.sleep(0)
+            return [item * 2 for item in items]
+
+        batcher = batching.AsyncMicroBatcher(process, max_size=4, max_wait=0.01)
+
+        async def main():
+            return await asyncio.gather(*[batcher.submit(i) for i in range(6)])
+
+        self.assertEqual(asyncio.run(main()), [0, 2, 4, 6, 8, 10])
+        self.assertEqual(batches, [[0, 1, 2, 3], [4, 5]])
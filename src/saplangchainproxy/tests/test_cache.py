@@ -0,0 +1,167 @@
+import os
+import tempfile
+import time
+import unittest
+
+from langchain.embeddings.base import Embeddings
+from langchain.schema.messages import HumanMessage
+
+from saplangchainproxy import sapwrapper
+from saplangchainproxy.cache import ResponseCache, SemanticCache, SQLiteEmbeddingCache
+from saplangchainproxy.chat import SAPChatOpenAI
+
+
+class TestSQLiteEmbeddingCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_roundtrip_and_stats(self):
+        cache = SQLiteEmbeddingCache(self.path)
+        key = cache.key("text-embedding-ada-002-v2", "text-embedding-ada-002", "hello")
+        self.assertEqual(cache.get_many([key]), {})
+        cache.set_many({key: [0.1, 0.2, 0.3]})
+        self.assertEqual(cache.get_many([key]), {key: [0.1, 0.2, 0.3]})
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "entries": 1})
+        # the database is shared with other instances, e.g. in other processes
+        self.assertEqual(SQLiteEmbeddingCache(self.path).stats()["entries"], 1)
+
+    def test_key_depends_on_deployment_and_normalized_text(self):
+        key = SQLiteEmbeddingCache.key
+        self.assertEqual(key("d", "m", "café\r\n"), key("d", "m", "café\n"))
+        self.assertNotEqual(key("d", "m", "text"), key("other", "m", "text"))
+
+    def test_evicts_least_recently_used(self):
+        cache = SQLiteEmbeddingCache(self.path, max_entries=2)
+        cache.set_many({"a": [1.0]})
+        time.sleep(0.01)
+        cache.set_many({"b": [2.0]})
+        time.sleep(0.01)
+        cache.get_many(["a"])
+        time.sleep(0.01)
+        cache.set_many({"c": [3.0]})
+        self.assertEqual(sorted(cache.get_many(["a", "b", "c"])), ["a", "c"])
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "responses.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_key_ignores_stream_and_order(self):
+        key = ResponseCache.key
+        self.assertEqual(
+            key("u", "c", {"deployment_id": "gpt-4", "temperature": 0, "stream": True}),
+            key("u", "c", {"temperature": 0, "deployment_id": "gpt-4"}),
+        )
+        self.assertNotEqual(
+            key("u", "c", {"deployment_id": "gpt-4", "temperature": 0}),
+            key("u", "c", {"deployment_id": "gpt-4", "temperature": 1}),
+        )
+
+    def test_key_depends_on_tenant(self):
+        payload = {"deployment_id": "gpt-4", "prompt": "hi"}
+        self.assertNotEqual(
+            ResponseCache.key("u", "tenant-a", payload),
+            ResponseCache.key("u", "tenant-b", payload),
+        )
+
+    def test_ttl_and_stale_while_revalidate(self):
+        cache = ResponseCache(ttl=0.2, stale_while_revalidate=0.3)
+        cache.set("k", {"choices": []})
+        self.assertEqual(cache.get("k"), ({"choices": []}, True))
+        time.sleep(0.25)
+        self.assertEqual(cache.get("k"), ({"choices": []}, False))
+        cache.revalidate("k", lambda: {"choices": [1]})
+        time.sleep(0.05)
+        self.assertEqual(cache.get("k"), ({"choices": [1]}, True))
+        time.sleep(0.6)
+        self.assertIsNone(cache.get("k"))
+        self.assertEqual(
+            cache.stats(), {"hits": 2, "stale_hits": 1, "misses": 1, "entries": 1}
+        )
+
+    def test_lru_and_disk_tier(self):
+        cache = ResponseCache(max_entries=1, path=self.path)
+        cache.set("a", {"n": 1})
+        cache.set("b", {"n": 2})
+        self.assertEqual(cache.stats()["entries"], 1)
+        # evicted from memory, found on disk and by other instances
+        self.assertEqual(cache.get("a"), ({"n": 1}, True))
+        self.assertEqual(ResponseCache(path=self.path).get("b"), ({"n": 2}, True))
+
+
+class _LetterEmbeddings(Embeddings):
+    """Counts the letters, so texts with the same letters are identical."""
+
+    def embed_query(self, text):
+        vector = [0.0] * 26
+        for char in text.lower():
+            if "a" <= char <= "z":
+                vector[ord(char) - ord("a")] += 1
+        return vector
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+class TestSemanticCache(unittest.TestCase):
+    def test_similar_question_in_scope(self):
+        cache = SemanticCache(_LetterEmbeddings(), threshold=0.99)
+        response, vector = cache.lookup("s", "What is the capital of France?")
+        self.assertIsNone(response)
+        cache.update("s", vector, {"choices": ["Paris"]})
+        self.assertEqual(cache.lookup("s", "what is the capital of france")[0], {"choices": ["Paris"]})
+        self.assertIsNone(cache.lookup("other", "what is the capital of france")[0])
+        self.assertIsNone(cache.lookup("s", "zebra")[0])
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 3, "entries": 1, "hit_rate": 0.25})
+
+    def test_evicts_least_recently_used(self):
+        cache = SemanticCache(_LetterEmbeddings(), threshold=0.99, max_entries=2)
+        for text in ["abc", "xyz"]:
+            cache.update("s", cache.lookup("s", text)[1], text)
+        cache.lookup("s", "abc")
+        cache.update("s", cache.lookup("s", "klm")[1], "klm")
+        self.assertEqual(cache.lookup("s", "abc")[0], "abc")
+        self.assertIsNone(cache.lookup("s", "xyz")[0])
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_zero_embedding_is_a_miss(self):
+        cache = SemanticCache(_LetterEmbeddings(), threshold=0.99)
+        cache.update("s", cache.lookup("s", "abc")[1], "abc")
+        response, vector = cache.lookup("s", "123")
+        self.assertIsNone(response)
+        self.assertIsNone(vector)
+        cache.update("s", vector, "123")
+        self.assertEqual(cache.stats()["entries"], 1)
+
+    def test_chat_skips_failing_cache(self):
+        class FailingEmbeddings(_LetterEmbeddings):
+            def embed_query(self, text):
+                raise sapwrapper.Timeout("embedding deployment timed out")
+
+        class FakeClient:
+            def create(self, **kwargs):
+                return {"choices": [{"message": {"role": "assistant", "content": "Paris"}}], "usage": {}}
+
+        chat = SAPChatOpenAI(
+            openai_api_client_id="client",
+            openai_api_url="https://proxy/api/v1",
+            openai_api_tokenurl="https://token",
+            semantic_cache=SemanticCache(FailingEmbeddings()),
+        )
+        chat.client = FakeClient()
+        with self.assertLogs("saplangchainproxy.chat.openai", "WARNING"):
+            self.assertEqual(chat([HumanMessage(content="Capital of France?")]).content, "Paris")
+
+    def test_scope_depends_on_params_and_context(self):
+        scope = SemanticCache.scope
+        messages = [{"role": "system", "content": "Be brief."}]
+        self.assertEqual(scope({"a": 1, "b": 2}, messages), scope({"b": 2, "a": 1}, messages))
+        self.assertNotEqual(scope({"a": 1}, messages), scope({"a": 1}, []))
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import threading
+import unittest
+
+from saplangchainproxy import codec
+
+
+class TestCodec(unittest.TestCase):
+    def tearDown(self):
+        codec.set_codec(codec.ORJSON_CODEC or codec.JSON_CODEC)
+
+    def test_round_trip(self):
+        payload = {"deployment_id": "gpt-4", "messages": [{"role": "user", "content": "Grüße"}], "n": 1}
+        for c in filter(None, [codec.JSON_CODEC, codec.ORJSON_CODEC]):
+            data = c.dumps(payload)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(c.loads(data), payload)
+            self.assertEqual(c.loads(data.decode("utf-8")), payload)
+            with self.assertRaises(ValueError):
+                c.loads(b"{")
+
+    @unittest.skipIf(codec.ORJSON_CODEC is None, "orjson is not installed")
+    def test_orjson_like_json(self):
+        payload = {"logit_bias": {50256: -100}, "input": [[1, 2, 3]]}
+        self.assertEqual(
+            codec.JSON_CODEC.loads(codec.ORJSON_CODEC.dumps(payload)),
+            codec.JSON_CODEC.loads(codec.JSON_CODEC.dumps(payload)),
+        )
+
+    def test_set_codec(self):
+        calls = []
+        codec.set_codec(codec.Codec("counting", codec.JSON_CODEC.dumps, lambda data: calls.append(data) or {}))
+        self.assertEqual(codec.loads(b"{}"), {})
+        self.assertEqual(calls, [b"{}"])
+
+    def test_loads_in_pieces(self):
+        documents = [
+            {"data": [{"embedding": [0.1, -2e-3], "index": 0}, {"embedding": [], "index": 1}], "model": "ada"},
+            {"a": [], "b": {"c": ["]", "}", "\\\"["]}, "d": None, "e\\\"": [[1, [2]], "x"]},
+            {},
+        ]
+        for document in documents:
+            for indent in (None, 2):
+                data = json.dumps(document, indent=indent).encode("utf-8")
+                self.assertEqual(codec._loads_in_pieces(data, json.loads), document)
+        self.assertEqual(codec._loads_in_pieces(b"[1, 2]", json.loads), [1, 2])
+        for invalid in [b'{"a": [1, 2', b'{"a": [1,]}', b'{"a": 1} {}', b'{"a": "b}']:
+            with self.assertRaises(ValueError):
+                codec._loads_in_pieces(invalid, json.loads)
+
+    def test_large_responses_are_decoded_off_the_loop(self):
+        threads = []
+
+        def loads(data):
+            threads.append(threading.current_thread())
+            return codec.JSON_CODEC.loads(data)
+
+        codec.set_codec(codec.Codec("recording", codec.JSON_CODEC.dumps, loads))
+        large = codec.dumps({"data": [0.5] * codec.ASYNC_DECODE_MIN_BYTES})
+
+        async def main():
+            await codec.aloads(b"{}")
+            return await codec.aloads(large)
+
+        self.assertEqual(len(asyncio.run(main())["data"]), codec.ASYNC_DECODE_MIN_BYTES)
+        self.assertIs(threads[0], threading.current_thread())
+        self.assertIsNot(threads[1], threading.current_thread())
@@ -0,0 +1,103 @@
+import unittest
+
+from langchain.schema.messages import HumanMessage
+
+from saplangchainproxy import deployments
+from saplangchainproxy.chat import SAPChatOpenAI
+from saplangchainproxy.llm import SAPAzureOpenAI
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        usage = {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+        if "messages" in kwargs:
+            choices = [{"message": {"role": "assistant", "content": "ok"}}]
+        else:
+            choices = [{"text": "ok", "finish_reason": "stop", "logprobs": None}] * len(kwargs["prompt"])
+        return {"choices": choices, "usage": usage}
+
+
+CREDENTIALS = dict(
+    openai_api_client_id="client",
+    openai_api_url="https://proxy/api/v1",
+    openai_api_tokenurl="https://token",
+)
+
+
+class TestDeployments(unittest.TestCase):
+    def test_context_size(self):
+        self.assertEqual(deployments.context_size("gpt-35-turbo"), 4096)
+        self.assertEqual(deployments.context_size("gpt-4-32k"), 32768)
+        self.assertEqual(deployments.context_size("alephalpha"), 2048)
+        self.assertEqual(deployments.context_size("curie:ft-personal-2023-08-01"), 2049)
+        with self.assertRaises(ValueError):
+            deployments.context_size("unknown")
+
+    def test_pick_by_context(self):
+        candidates = ["gpt-4-32k", "gpt-4"]
+        short = {"prompt": "hello", "max_tokens": 256}
+        self.assertEqual(deployments.pick_deployment(short, candidates), "gpt-4")
+        long = {"prompt": "hello " * 9000, "max_tokens": 256}
+        self.assertEqual(deployments.pick_deployment(long, candidates), "gpt-4-32k")
+        # max_tokens counts towards the context
+        self.assertEqual(
+            deployments.pick_deployment({"prompt": "hello", "max_tokens": 8192}, candidates),
+            "gpt-4-32k",
+        )
+
+    def test_largest_prompt_counts(self):
+        request = {"prompt": ["hi", "hello " * 9000], "max_tokens": 16}
+        self.assertEqual(
+            deployments.pick_deployment(request, ["gpt-4", "gpt-4-32k"]), "gpt-4-32k"
+        )
+
+    def test_preference(self):
+        request = {"messages": [{"role": "user", "content": "hi"}]}
+        candidates = ["gpt-4", "gcp-text-bison-001", "alephalpha"]
+        self.assertEqual(deployments.pick_deployment(request, candidates), "gcp-text-bison-001")
+        self.assertEqual(
+            deployments.pick_deployment(request, ["gpt-4", "alephalpha", "gptj-full"], "latency"),
+            "alephalpha",
+        )
+
+    def test_nothing_fits(self):
+        request = {"prompt": "hello " * 40000}
+        self.assertEqual(
+            deployments.pick_deployment(request, ["gpt-4", "gpt-4-32k"]), "gpt-4-32k"
+        )
+
+
+class TestContextRouting(unittest.TestCase):
+    def test_llm_max_tokens_for_sap_deployment(self):
+        llm = SAPAzureOpenAI(deployment_name="gpt-4-32k", max_tokens=-1, **CREDENTIALS)
+        llm.client = FakeClient()
+        llm.generate(["hello"])
+        self.assertEqual(
+            llm.client.calls[0]["max_tokens"], 32768 - llm.get_num_tokens("hello")
+        )
+
+    def test_llm(self):
+        llm = SAPAzureOpenAI(
+            deployment_name="gpt-4", context_routing=["gpt-4", "gpt-4-32k"], **CREDENTIALS
+        )
+        llm.client = FakeClient()
+        llm.generate(["hello", "hello " * 9000])
+        self.assertEqual(llm.client.calls[0]["engine"], "gpt-4-32k")
+        llm.generate(["hello"])
+        self.assertEqual(llm.client.calls[1]["engine"], "gpt-4")
+
+    def test_chat(self):
+        chat = SAPChatOpenAI(context_routing=["gpt-35-turbo", "gpt-35-turbo-16k"], **CREDENTIALS)
+        chat.client = FakeClient()
+        chat([HumanMessage(content="hello " * 5000)])
+        self.assertEqual(chat.client.calls[0]["model"], "gpt-35-turbo-16k")
+        chat([HumanMessage(content="hello")])
+        self.assertEqual(chat.client.calls[1]["model"], "gpt-35-turbo")
+
+    def test_unknown_deployment(self):
+        with self.assertRaises(ValueError):
+            SAPChatOpenAI(context_routing=["gpt-4", "my-model"], **CREDENTIALS)
@@ -0,0 +1,224 @@
+import asyncio
+import itertools
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from saplangchainproxy import codec, sapwrapper
+from saplangchainproxy.embeddings import SAPOpenAIEmbeddings
+from saplangchainproxy.embeddings.openai import _average_chunk_embeddings, _pack_batches
+
+
+class TestAverageChunkEmbeddings(unittest.TestCase):
+    def test_matches_weighted_average(self):
+        rng = np.random.default_rng(0)
+        indices = [0, 0, 0, 2, 3, 3]
+        num_tokens = [8, 8, 3, 5, 8, 1]
+        chunks = rng.standard_normal((len(indices), 4))
+        expected = []
+        for i in [0, 2, 3]:
+            rows = [j for j, index in enumerate(indices) if index == i]
+            average = np.average(chunks[rows], axis=0, weights=np.take(num_tokens, rows))
+            expected.append(average / np.linalg.norm(average))
+
+        embeddings, empty_rows = _average_chunk_embeddings(
+            5, indices, num_tokens, chunks.copy()
+        )
+        np.testing.assert_allclose(embeddings[[0, 2, 3]], expected)
+        self.assertEqual(empty_rows.tolist(), [False, True, False, False, True])
+        self.assertFalse(embeddings[[1, 4]].any())
+
+    def test_without_chunks(self):
+        embeddings, empty_rows = _average_chunk_embeddings(
+            2, [], [], np.empty((0, 3))
+        )
+        self.assertEqual(embeddings.shape, (2, 3))
+        self.assertTrue(empty_rows.all())
+
+
+class TestPackBatches(unittest.TestCase):
+    def test_by_count(self):
+        self.assertEqual(_pack_batches([[1]] * 5, 2), [(0, 2), (2, 4), (4, 5)])
+
+    def test_token_budget(self):
+        tokens = [[1] * 6, [1] * 3, [1] * 3, [1] * 10, [1]]
+        self.assertEqual(
+            _pack_batches(tokens, 100, max_tokens=6), [(0, 1), (1, 3), (3, 4), (4, 5)]
+        )
+
+    def test_byte_budget(self):
+        # [[10,11],[10,11],[10,11]] takes 25 bytes
+        tokens = [[10, 11]] * 4
+        self.assertEqual(_pack_batches(tokens, 100, max_bytes=25), [(0, 3), (3, 4)])
+        self.assertEqual(_pack_batches(tokens, 100, max_bytes=24), [(0, 2), (2, 4)])
+        tokens = [[1, 22, 333]] * 5 + [[7]]
+        for start, end in _pack_batches(tokens, 100, max_bytes=34):
+            batch = tokens[start:end]
+            # the budget is filled as far as the JSON of the next chunk allows
+            self.assertLessEqual(len(codec.dumps(batch)), 34)
+            if end < len(tokens):
+                self.assertGreater(len(codec.dumps(tokens[start : end + 1])), 34)
+
+
+class FakeEmbedding:
+    api_url = "https://proxy/api/v1"
+
+    def __init__(self, max_inputs):
+        self.max_inputs = max_inputs
+        self.sizes = []
+
+    def create(self, **kwargs):
+        self.sizes.append(len(kwargs["input"]))
+        if len(kwargs["input"]) > self.max_inputs:
+            raise sapwrapper.InvalidRequestError("413: too large", 413)
+        return {"data": [{"embedding": [float(len(chunk)), 1.0]} for chunk in kwargs["input"]]}
+
+
+class TestSplitBatches(unittest.TestCase):
+    def _embeddings(self, max_inputs):
+        embeddings = SAPOpenAIEmbeddings(
+            openai_api_client_id="client",
+            openai_api_url="https://proxy/api/v1",
+            openai_api_tokenurl="https://token",
+            max_retries=1,
+        )
+        embeddings.client = FakeEmbedding(max_inputs)
+        return embeddings
+
+    def test_rejected_batch_is_split(self):
+        embeddings = self._embeddings(max_inputs=2)
+        result = embeddings.embed_documents(["a", "b b", "c c c", "d", "e e"])
+        self.assertEqual(len(result), 5)
+        self.assertEqual(embeddings.client.sizes, [5, 2, 3, 1, 2])
+
+    def test_array_chunk_size(self):
+        embeddings = self._embeddings(max_inputs=100)
+        result = embeddings.embed_documents_array(["a", "b", "c", "d", "e"], chunk_size=2)
+        self.assertEqual(result.shape, (5, 2))
+        self.assertEqual(embeddings.client.sizes, [2, 2, 1])
+
+    def test_other_errors_are_raised(self):
+        embeddings = self._embeddings(max_inputs=0)
+        with self.assertRaises(sapwrapper.InvalidRequestError):
+            embeddings.embed_documents(["a"])
+
+
+class ReversedEmbedding:
+    """Answers the batches in the reverse order of the requests."""
+
+    api_url = "https://proxy/api/v1"
+
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.started = itertools.count()
+        self.finished = []
+        self.lock = threading.Lock()
+
+    def _response(self, kwargs):
+        with self.lock:
+            self.finished.append(kwargs["input"][0])
+        return {"data": [{"embedding": [float(sum(chunk)), float(len(chunk)), 1.0]} for chunk in kwargs["input"]]}
+
+    def create(self, **kwargs):
+        time.sleep(self.delay * (8 - next(self.started)))
+        return self._response(kwargs)
+
+    async def acreate(self, **kwargs):
+        await asyncio.sleep(self.delay * (8 - next(self.started)))
+        return self._response(kwargs)
+
+
+class TestParallelBatches(unittest.TestCase):
+    TEXTS = ["one two three four five", "six", "seven eight nine", "ten eleven"]
+
+    def _embeddings(self, max_concurrency, delay=0.02):
+        embeddings = SAPOpenAIEmbeddings(
+            openai_api_client_id="client",
+            openai_api_url="https://proxy/api/v1",
+            openai_api_tokenurl="https://token",
+            # texts are split into chunks of two tokens, one chunk per batch
+            embedding_ctx_length=2,
+            chunk_size=1,
+            max_concurrency=max_concurrency,
+        )
+        embeddings.client = ReversedEmbedding(delay)
+        return embeddings
+
+    def _expected(self):
+        return self._embeddings(max_concurrency=1, delay=0).embed_documents(self.TEXTS)
+
+    def _assert_out_of_order(self, client):
+        chunks = self._embeddings(1, delay=0)._tokenize(self.TEXTS)[0]
+        # texts were split into several chunks, which finished out of order
+        self.assertGreater(len(chunks), len(self.TEXTS))
+        self.assertEqual(sorted(client.finished), sorted(chunks))
+        self.assertNotEqual(client.finished, chunks)
+
+    def test_threads(self):
+        embeddings = self._embeddings(max_concurrency=8)
+        result = embeddings.embed_documents(self.TEXTS)
+        np.testing.assert_allclose(result, self._expected(), rtol=1e-6)
+        self._assert_out_of_order(embeddings.client)
+
+    def test_array(self):
+        embeddings = self._embeddings(max_concurrency=8)
+        result = embeddings.embed_documents_array(self.TEXTS)
+        np.testing.assert_allclose(result, self._expected(), rtol=1e-6)
+
+    def test_async(self):
+        embeddings = self._embeddings(max_concurrency=8)
+        result = asyncio.run(embeddings.aembed_documents(self.TEXTS))
+        np.testing.assert_allclose(result, self._expected(), rtol=1e-6)
+        self._assert_out_of_order(embeddings.client)
+
+
+class EmptyEmbedding:
+    """Embeds the empty text, waits for release before it answers."""
+
+    def __init__(self, api_url, release=None):
+        self.api_url = api_url
+        self.release = release
+        self.inputs = []
+
+    def create(self, **kwargs):
+        self.inputs.append(kwargs["input"])
+        if self.release is not None:
+            self.release.wait(5)
+        return {"data": [{"embedding": [3.0, 4.0]}]}
+
+
+class TestEmptyEmbedding(unittest.TestCase):
+    def _embeddings(self, client, deployment="text-embedding-ada-002"):
+        embeddings = SAPOpenAIEmbeddings(
+            openai_api_client_id="client",
+            openai_api_url=client.api_url,
+            openai_api_tokenurl="https://token",
+            deployment=deployment,
+        )
+        embeddings.client = client
+        return embeddings
+
+    def test_fetched_once(self):
+        client = EmptyEmbedding("https://empty-once/api/v1")
+        embeddings = self._embeddings(client)
+        self.assertEqual(embeddings.embed_documents([""]), [[0.6, 0.8]])
+        self.assertEqual(embeddings.embed_documents(["", ""]), [[0.6, 0.8]] * 2)
+        self.assertEqual(self._embeddings(EmptyEmbedding(client.api_url)).embed_documents([""]), [[0.6, 0.8]])
+        self.assertEqual(client.inputs, [""])
+
+    def test_slow_deployment_does_not_block_others(self):
+        release = threading.Event()
+        slow = self._embeddings(EmptyEmbedding("https://empty-slow/api/v1", release))
+        thread = threading.Thread(target=slow.embed_documents, args=([""],))
+        thread.start()
+        try:
+            time.sleep(0.05)
+            start = time.monotonic()
+            fast = self._embeddings(EmptyEmbedding("https://empty-fast/api/v1"))
+            self.assertEqual(fast.embed_documents([""]), [[0.6, 0.8]])
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            release.set()
+            thread.join()
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from saplangchainproxy import sapwrapper
+from saplangchainproxy.llm import SAPAzureOpenAI
+from saplangchainproxy.llm.openai import _apportion, _split_token_usage
+
+
+class FakeCompletion:
+    def __init__(self):
+        self.prompts = []
+
+    def _response(self, kwargs):
+        self.prompts.append(list(kwargs["prompt"]))
+        choices = [
+            {"text": f"re {prompt}", "finish_reason": "stop", "logprobs": None}
+            for prompt in kwargs["prompt"]
+            for _ in range(kwargs["n"])
+        ]
+        tokens = 2 * len(kwargs["prompt"])
+        usage = {"prompt_tokens": tokens, "completion_tokens": tokens, "total_tokens": 2 * tokens}
+        return {"choices": choices, "usage": usage}
+
+    def create(self, **kwargs):
+        time.sleep(0.05)
+        return self._response(kwargs)
+
+    async def acreate(self, **kwargs):
+        await asyncio.sleep(0.05)
+        return self._response(kwargs)
+
+
+class TestTokenUsage(unittest.TestCase):
+    def test_apportion_adds_up(self):
+        self.assertEqual(_apportion(10, [1, 1, 1]), [4, 3, 3])
+        self.assertEqual(_apportion(7, [0, 0]), [4, 3])
+        self.assertEqual(sum(_apportion(1001, [3, 5, 7, 11])), 1001)
+
+    def test_split(self):
+        usages = _split_token_usage(
+            {"prompt_tokens": 30, "completion_tokens": 8, "total_tokens": 38}, [1, 2], [1, 1]
+        )
+        self.assertEqual(usages, [
+            {"prompt_tokens": 10, "completion_tokens": 4, "total_tokens": 14},
+            {"prompt_tokens": 20, "completion_tokens": 4, "total_tokens": 24},
+        ])
+
+
+class OutOfOrderCompletion(FakeCompletion):
+    """Answers later batches first and rate limits the first attempt of batch "c"."""
+
+    def __init__(self):
+        super().__init__()
+        self.limited = False
+
+    def create(self, **kwargs):
+        if kwargs["prompt"][0] == "c" and not self.limited:
+            self.limited = True
+            raise sapwrapper.RateLimitError("busy", 429, {"Retry-After": "0"})
+        time.sleep(0.1 if kwargs["prompt"][0] == "a" else 0.01)
+        return self._response(kwargs)
+
+
+class RetryRecorder(BaseCallbackHandler):
+    def __init__(self):
+        self.retries = 0
+
+    def on_retry(self, retry_state, **kwargs):
+        self.retries += 1
+
+
+class TestConcurrentSubPrompts(unittest.TestCase):
+    def test_order_usage_and_retries(self):
+        llm = SAPAzureOpenAI(
+            deployment_name="text-davinci-003",
+            openai_api_client_id="client",
+            openai_api_url="https://proxy/api/v1",
+            openai_api_tokenurl="https://token",
+            batch_size=2,
+            max_concurrency=3,
+            max_retries=2,
+        )
+        llm.client = OutOfOrderCompletion()
+        recorder = RetryRecorder()
+        prompts = ["a", "b", "c", "d", "e"]
+        result = llm.generate(prompts, callbacks=[recorder])
+        # the batch of "a" answers last
+        self.assertEqual(llm.client.prompts[-1], ["a", "b"])
+        self.assertEqual([g[0].text for g in result.generations], [f"re {p}" for p in prompts])
+        self.assertEqual(
+            result.llm_output["token_usage"],
+            {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+        )
+        self.assertEqual(recorder.retries, 1)
+
+
+class TestMergeRequests(unittest.TestCase):
+    def _llm(self, **kwargs):
+        llm = SAPAzureOpenAI(
+            deployment_name="text-davinci-003",
+            openai_api_client_id="client",
+            openai_api_url="https://proxy/api/v1",
+            openai_api_tokenurl="https://token",
+            merge_requests=True,
+            merge_wait=0.05,
+            **kwargs,
+        )
+        llm.client = FakeCompletion()
+        return llm
+
+    def test_concurrent_calls_share_a_request(self):
+        llm = self._llm(n=2)
+        results = {}
+
+        def run(prompt):
+            results[prompt] = llm.generate([prompt])
+
+        threads = [threading.Thread(target=run, args=(f"p{i}",)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(llm.client.prompts), 1)
+        self.assertEqual(sorted(llm.client.prompts[0]), [f"p{i}" for i in range(5)])
+        for prompt, result in results.items():
+            self.assertEqual([g.text for g in result.generations[0]], [f"re {prompt}"] * 2)
+        usages = [r.llm_output["token_usage"] for r in results.values()]
+        self.assertEqual(sum(u["prompt_tokens"] for u in usages), 10)
+        self.assertEqual(sum(u["total_tokens"] for u in usages), 20)
+
+    def test_split_by_n_of_the_call(self):
+        llm = self._llm(tiktoken_model_name="gpt-3.5-turbo")
+        params = {**llm._invocation_params, "n": 3}
+        calls = [(params, ["a"]), (params, ["b", "c"])]
+        response = llm.client._response({"prompt": ["a", "b", "c"], "n": 3})
+        (first, _), (second, _) = llm._split_merged(calls, response)
+        self.assertEqual([c["text"] for c in first], ["re a"] * 3)
+        self.assertEqual([c["text"] for c in second], ["re b"] * 3 + ["re c"] * 3)
+
+    def test_batch_size_and_params(self):
+        llm = self._llm(batch_size=2)
+
+        async def main():
+            return await asyncio.gather(
+                llm.agenerate(["a"]),
+                llm.agenerate(["b"]),
+                llm.agenerate(["c"]),
+                llm.agenerate(["d"], stop=["\n"]),
+            )
+
+        results = asyncio.run(main())
+        self.assertEqual(
+            sorted(llm.client.prompts), [["a", "b"], ["c"], ["d"]]
+        )
+        self.assertEqual(results[3].generations[0][0].text, "re d")
@@ -0,0 +1,61 @@
+import asyncio
+import time
+import unittest
+
+from saplangchainproxy import ratelimit
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_requests_queue_after_burst(self):
+        limiter = ratelimit.RateLimiter(requests_per_minute=600)
+        limiter._requests._level = 1
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertAlmostEqual(time.monotonic() - start, 0.2, delta=0.05)
+
+    def test_tokens_async(self):
+        limiter = ratelimit.RateLimiter(tokens_per_minute=6000)
+        limiter._tokens._level = 0
+
+        async def main():
+            await asyncio.gather(*[limiter.aacquire(5) for _ in range(4)])
+
+        start = time.monotonic()
+        asyncio.run(main())
+        # 20 tokens at 100 tokens per second
+        self.assertAlmostEqual(time.monotonic() - start, 0.2, delta=0.05)
+
+    def test_shared_per_deployment(self):
+        limiter = ratelimit.get_rate_limiter("https://proxy", "gpt-4", 10, None)
+        self.assertIs(limiter, ratelimit.get_rate_limiter("https://proxy", "gpt-4", 10, None))
+        self.assertIsNot(limiter, ratelimit.get_rate_limiter("https://proxy", "gpt-4-32k", 10, None))
+
+    def test_models_with_different_budgets(self):
+        requests = ratelimit.get_rate_limiter("https://proxy", "gpt-35-turbo", 600, None)
+        tokens = ratelimit.get_rate_limiter("https://proxy", "gpt-35-turbo", None, 6000)
+        self.assertIsNot(requests, tokens)
+        requests._requests._level = 0
+        tokens._tokens._level = 0
+        start = time.monotonic()
+        # alternating models neither reset nor drop the budget of the other
+        for _ in range(2):
+            requests.acquire()
+            self.assertIs(tokens, ratelimit.get_rate_limiter("https://proxy", "gpt-35-turbo", None, 6000))
+            tokens.acquire(10)
+            self.assertIs(requests, ratelimit.get_rate_limiter("https://proxy", "gpt-35-turbo", 600, None))
+        # each request waits 0.1s for its turn, the tokens refill meanwhile
+        self.assertAlmostEqual(time.monotonic() - start, 0.2, delta=0.05)
+
+
+class TestEstimateTokens(unittest.TestCase):
+    def test_adds_max_tokens_per_completion(self):
+        prompt = ratelimit.estimate_tokens({"prompt": ["a", "b"]}, "text-davinci-003")
+        with_completions = ratelimit.estimate_tokens(
+            {"prompt": ["a", "b"], "max_tokens": 10, "n": 2}, "text-davinci-003"
+        )
+        self.assertEqual(with_completions - prompt, 40)
+
+    def test_token_arrays(self):
+        tokens = ratelimit.estimate_tokens({"input": [[1, 2, 3], [4]]}, "text-embedding-ada-002-v2")
+        self.assertEqual(tokens, 4)
@@ -0,0 +1,78 @@
+import time
+import unittest
+
+from saplangchainproxy import retry, sapwrapper
+
+
+class TestErrors(unittest.TestCase):
+    def test_status_codes(self):
+        body = '{"error": {"message": "slow down"}}'
+        error = sapwrapper._error_for_status(429, {"Retry-After": "7"}, body)
+        self.assertIsInstance(error, sapwrapper.RateLimitError)
+        self.assertEqual(str(error), "429: slow down")
+        self.assertEqual(error.retry_after, 7.0)
+        self.assertIsInstance(sapwrapper._error_for_status(503, {}, ""), sapwrapper.ServiceUnavailableError)
+        self.assertIsInstance(sapwrapper._error_for_status(401, {}, ""), sapwrapper.AuthenticationError)
+        self.assertIsInstance(sapwrapper._error_for_status(413, {}, ""), sapwrapper.InvalidRequestError)
+        self.assertIsInstance(sapwrapper._error_for_status(500, {}, ""), sapwrapper.APIError)
+
+    def test_retry_after_ms(self):
+        self.assertEqual(sapwrapper._parse_retry_after({"retry-after-ms": "250"}), 0.25)
+        self.assertIsNone(sapwrapper._parse_retry_after({}))
+
+
+class TestRetry(unittest.TestCase):
+    def setUp(self):
+        self.budget = retry.retry_budget
+        retry.retry_budget = retry.RetryBudget()
+
+    def tearDown(self):
+        retry.retry_budget = self.budget
+
+    def _failing(self, errors):
+        self.attempts = 0
+
+        def call():
+            self.attempts += 1
+            if self.attempts <= len(errors):
+                raise errors[self.attempts - 1]
+            return "ok"
+
+        return call
+
+    def test_honors_retry_after(self):
+        decorator = retry.create_retry_decorator(max_retries=3)
+        error = sapwrapper.RateLimitError("busy", 429, {"Retry-After": "0.1"})
+        start = time.monotonic()
+        self.assertEqual(decorator(self._failing([error, error]))(), "ok")
+        self.assertAlmostEqual(time.monotonic() - start, 0.2, delta=0.05)
+
+    def test_does_not_retry_invalid_requests(self):
+        decorator = retry.create_retry_decorator(max_retries=3)
+        call = decorator(self._failing([sapwrapper.InvalidRequestError("bad", 400)]))
+        with self.assertRaises(sapwrapper.InvalidRequestError):
+            call()
+        self.assertEqual(self.attempts, 1)
+
+    def test_deadline(self):
+        decorator = retry.create_retry_decorator(max_retries=5, deadline=0.5)
+        error = sapwrapper.ServiceUnavailableError("down", 503, {"Retry-After": "1"})
+        with self.assertRaises(sapwrapper.ServiceUnavailableError):
+            decorator(self._failing([error] * 5))()
+        self.assertEqual(self.attempts, 1)
+
+    def test_budget(self):
+        retry.retry_budget = retry.RetryBudget(ratio=0, min_per_second=0, max_balance=1)
+        decorator = retry.create_retry_decorator(max_retries=5)
+        error = sapwrapper.RateLimitError("busy", 429, {"Retry-After": "0"})
+        with self.assertRaises(sapwrapper.RateLimitError):
+            decorator(self._failing([error] * 5))()
+        # one retry from the budget
+        self.assertEqual(self.attempts, 2)
+
+    def test_total_timeout(self):
+        decorator = retry.create_retry_decorator(max_retries=5, deadline=10, total_timeout=0.5)
+        error = sapwrapper.Timeout("slow", headers={"Retry-After": "1"})
+        with self.assertRaises(sapwrapper.Timeout):
+            decorator(self._failing([error] * 5))()
+        self.assertEqual(self.attempts, 1)
@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from saplangchainproxy import routing, sapwrapper
+
+
+class FakeClient:
+    def __init__(self, api_url, errors=()):
+        self.api_url = api_url
+        self.errors = list(errors)
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.api_url
+
+    async def acreate(self, **kwargs):
+        return self.create(**kwargs)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_and_probes(self):
+        breaker = routing.CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+        time.sleep(0.15)
+        self.assertEqual(breaker.state, "half_open")
+        self.assertTrue(breaker.allow())
+        # only one probe at a time
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+
+
+class TestRouter(unittest.TestCase):
+    def test_fails_over(self):
+        down = FakeClient("down", [sapwrapper.ServiceUnavailableError("down", 503)] * 10)
+        up = FakeClient("up")
+        router = routing.Router([down, up], failure_threshold=2)
+        # tried first while its circuit is closed
+        router.endpoints[1].outstanding = 1
+        results = [router.create() for _ in range(6)]
+        self.assertEqual(results, ["up"] * 6)
+        # skipped once its circuit is open
+        self.assertEqual(down.calls, 2)
+
+    def test_does_not_fail_over_invalid_requests(self):
+        bad = FakeClient("bad", [sapwrapper.InvalidRequestError("bad", 400)])
+        router = routing.Router([bad, FakeClient("up")])
+        router.endpoints[1].outstanding = 1
+        with self.assertRaises(sapwrapper.InvalidRequestError):
+            router.create()
+        self.assertEqual(router.endpoints[0].breaker.state, "closed")
+
+    def test_rate_limits_fail_over_without_opening(self):
+        limited = FakeClient("limited", [sapwrapper.RateLimitError("busy", 429)] * 3)
+        router = routing.Router([limited, FakeClient("up")], failure_threshold=1)
+        router.endpoints[1].outstanding = 1
+        self.assertEqual(router.create(), "up")
+        self.assertEqual(router.endpoints[0].breaker.state, "closed")
+
+    def test_all_down(self):
+        error = sapwrapper.APIConnectionError("refused")
+        router = routing.Router([FakeClient("a", [error]), FakeClient("b", [error])])
+        with self.assertRaises(sapwrapper.APIConnectionError):
+            router.create()
+
+    def test_least_outstanding(self):
+        router = routing.Router([FakeClient("a"), FakeClient("b")])
+        router.endpoints[0].outstanding = 3
+        self.assertEqual(router.create(), "b")
+
+    def test_ewma(self):
+        router = routing.Router([FakeClient("a"), FakeClient("b")], strategy="ewma")
+        router.endpoints[0].latency = 0.5
+        router.endpoints[1].latency = 0.1
+        router.endpoints[1].outstanding = 2
+        # 0.1 * 3 beats 0.5 * 1
+        self.assertEqual(router.create(), "b")
+        router.endpoints[1].latency = 0.1
+        router.endpoints[1].outstanding = 5
+        self.assertEqual(router.create(), "a")
+
+    def test_async(self):
+        down = FakeClient("down", [sapwrapper.Timeout("slow")])
+        router = routing.Router([down, FakeClient("up")])
+        router.endpoints[1].outstanding = 1
+        self.assertEqual(asyncio.run(router.acreate()), "up")
+        self.assertEqual(down.calls, 1)
+
+
+class SlowClient(FakeClient):
+    def __init__(self, api_url, delay):
+        super().__init__(api_url)
+        self.delay = delay
+
+    def create(self, **kwargs):
+        time.sleep(self.delay)
+        return super().create(**kwargs)
+
+    async def acreate(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return self.api_url
+
+
+class TestHedging(unittest.TestCase):
+    def _router(self, budget=1.0):
+        slow, fast = SlowClient("slow", 0.5), FakeClient("fast")
+        router = routing.Router([slow, fast], hedge_percentile=90, hedge_budget=budget)
+        router._latencies.extend([0.05] * routing.HEDGE_MIN_SAMPLES)
+        # the request goes to the slow endpoint first
+        router.endpoints[1].outstanding = 1
+        return router, slow, fast
+
+    def test_hedges_slow_request(self):
+        router, slow, fast = self._router()
+        start = time.monotonic()
+        self.assertEqual(router.create(), "fast")
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual((slow.calls, fast.calls), (0, 1))
+
+    def test_async_cancels_loser(self):
+        router, slow, fast = self._router()
+
+        async def main():
+            result = await router.acreate()
+            await asyncio.sleep(0)
+            return result
+
+        self.assertEqual(asyncio.run(main()), "fast")
+        self.assertEqual(router.endpoints[0].outstanding, 0)
+
+    def test_budget(self):
+        router, slow, fast = self._router(budget=0)
+        router._hedges._balance = 0
+        self.assertEqual(router.create(), "slow")
+        self.assertEqual(fast.calls, 0)
+
+    def test_not_streaming(self):
+        router, slow, fast = self._router()
+        self.assertEqual(router.create(stream=True), "slow")
+        self.assertEqual(fast.calls, 0)
+
+    def test_many_concurrent_requests(self):
+        # more concurrent hedged requests than any pool would hold, none queues
+        router = routing.Router([SlowClient("slow", 0.2)], hedge_percentile=90, hedge_budget=0)
+        router._latencies.extend([1.0] * routing.HEDGE_MIN_SAMPLES)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(router.create())) for _ in range(200)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["slow"] * 200)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_single_endpoint_without_breaker(self):
+        error = sapwrapper.APIConnectionError("refused")
+        client = FakeClient("only", [error] * 10)
+        router = routing.Router([client], hedge_percentile=90, circuit_breaker=False)
+        for _ in range(10):
+            with self.assertRaises(sapwrapper.APIConnectionError):
+                router.create()
+        self.assertEqual(router.create(), "only")
+        self.assertEqual(router.endpoints[0].breaker.state, "closed")
@@ -0,0 +1,460 @@
+import asyncio
+import http.server
+import json
+import threading
+import time
+import unittest
+
+import requests
+
+from saplangchainproxy import sapwrapper
+
+
+class _StreamedResponse:
+    def __init__(self, lines):
+        self.lines = lines
+        self.closed = False
+
+    def iter_lines(self, chunk_size=512):
+        self.chunk_size = chunk_size
+        yield from self.lines
+
+    def close(self):
+        self.closed = True
+
+
+class TestServerSentEvents(unittest.TestCase):
+    def test_iter_events(self):
+        response = _StreamedResponse([
+            b'data: {"choices": [{"text": "Hello"}]}',
+            b'',
+            b': keep-alive',
+            b'data: {"choices": [{"text": " world"}]}',
+            b'data: [DONE]',
+            b'data: {"choices": [{"text": "ignored"}]}',
+        ])
+        events = sapwrapper._iter_events(response)
+        self.assertEqual([e["choices"][0]["text"] for e in events], ["Hello", " world"])
+        self.assertTrue(response.closed)
+        # events are not held back until 512 bytes arrived
+        self.assertIsNone(response.chunk_size)
+
+    def test_iter_events_is_lazy(self):
+        response = _StreamedResponse([b'data: {"n": 1}', b'data: {"n": 2}'])
+        events = sapwrapper._iter_events(response)
+        self.assertEqual(next(events), {"n": 1})
+        self.assertFalse(response.closed)
+
+
+class TestCachedEvents(unittest.TestCase):
+    def test_chat_events_roundtrip(self):
+        events = [
+            {"choices": [{"index": 0, "delta": {"role": "assistant", "content": "Hel"}, "finish_reason": None}]},
+            {"choices": [{"index": 0, "delta": {"content": "lo"}, "finish_reason": None}]},
+            {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]},
+        ]
+        response = sapwrapper._events_to_response(events)
+        self.assertEqual(response["choices"], [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "Hello"},
+            "finish_reason": "stop",
+        }])
+        replayed = sapwrapper._events_to_response(sapwrapper._response_events(response))
+        self.assertEqual(replayed, response)
+
+    def test_completion_events(self):
+        events = [
+            {"choices": [{"index": 0, "text": "a", "finish_reason": None, "logprobs": None}]},
+            {"choices": [{"index": 1, "text": "b", "finish_reason": "stop", "logprobs": None}]},
+        ]
+        response = sapwrapper._events_to_response(events)
+        self.assertEqual([c["text"] for c in response["choices"]], ["a", "b"])
+        self.assertEqual(sapwrapper._response_events(response), [
+            {"choices": [c]} for c in response["choices"]
+        ])
+
+
+class TestCoalescer(unittest.TestCase):
+    def _send(self, result, stream=False):
+        self.calls = 0
+
+        def send():
+            self.calls += 1
+            time.sleep(0.1)
+            return iter(result) if stream else result
+
+        return send
+
+    def _run_threads(self, target, count=10):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(target())) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_calls_share_one_request(self):
+        coalescer = sapwrapper._Coalescer()
+        send = self._send({"choices": []})
+        results = self._run_threads(lambda: coalescer.call("key", send))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{"choices": []}] * 10)
+        coalescer.call("key", send)
+        self.assertEqual(self.calls, 2)
+
+    def test_stream_fan_out(self):
+        coalescer = sapwrapper._Coalescer()
+        send = self._send([{"n": 1}, {"n": 2}], stream=True)
+        results = self._run_threads(lambda: list(coalescer.call("key", send, stream=True)))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [[{"n": 1}, {"n": 2}]] * 10)
+
+    def test_async_calls_and_errors(self):
+        coalescer = sapwrapper._Coalescer()
+        calls = []
+
+        async def send():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            raise ValueError("failed")
+
+        async def main():
+            return await asyncio.gather(
+                *[coalescer.acall("key", send) for _ in range(10)], return_exceptions=True
+            )
+
+        results = asyncio.run(main())
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+
+    def test_cancelled_leader_does_not_cancel_followers(self):
+        coalescer = sapwrapper._Coalescer()
+        calls = []
+
+        async def send():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return {"choices": []}
+
+        async def main():
+            leader = asyncio.ensure_future(coalescer.acall("key", send))
+            await asyncio.sleep(0)
+            followers = [asyncio.ensure_future(coalescer.acall("key", send)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            results = await asyncio.gather(*followers)
+            return leader.cancelled(), results
+
+        cancelled, results = asyncio.run(main())
+        self.assertTrue(cancelled)
+        self.assertEqual(results, [{"choices": []}] * 2)
+        self.assertEqual(len(calls), 1)
+
+    def test_abandoned_stream_is_closed(self):
+        coalescer = sapwrapper._Coalescer()
+        closed = []
+
+        def send():
+            self.calls += 1
+
+            def events():
+                try:
+                    yield {"n": 1}
+                    yield {"n": 2}
+                finally:
+                    closed.append(1)
+
+            return events()
+
+        self.calls = 0
+        events = coalescer.call("key", send, stream=True)
+        self.assertEqual(next(events), {"n": 1})
+        del events
+        self.assertEqual(closed, [1])
+        # the next identical request goes to the proxy instead of the old stream
+        self.assertEqual(list(coalescer.call("key", send, stream=True)), [{"n": 1}, {"n": 2}])
+        self.assertEqual(self.calls, 2)
+
+    def test_abandoned_async_stream_is_closed(self):
+        coalescer = sapwrapper._Coalescer()
+        calls, closed = [], []
+
+        async def send():
+            calls.append(1)
+
+            async def events():
+                try:
+                    yield {"n": 1}
+                    yield {"n": 2}
+                finally:
+                    closed.append(1)
+
+            return events()
+
+        async def main():
+            async for event in await coalescer.acall("key", send, stream=True):
+                break
+            await asyncio.sleep(0)
+            return [event async for event in await coalescer.acall("key", send, stream=True)]
+
+        self.assertEqual(asyncio.run(main()), [{"n": 1}, {"n": 2}])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(closed, [1, 1])
+
+
+class _CountingOAuth:
+    def __init__(self, expires_in=3600):
+        self.calls = 0
+        self.expires_in = expires_in
+
+    def fetch_token(self, **kwargs):
+        self.calls += 1
+        time.sleep(0.05)
+        return {"token_type": "Bearer", "access_token": f"t{self.calls}",
+                "expires_at": time.time() + self.expires_in}
+
+
+class TestTimeouts(unittest.TestCase):
+    def test_connect_read_and_stream(self):
+        timeouts = sapwrapper._timeouts({"request_timeout": (1, 5), "stream_timeout": 2})
+        self.assertEqual(timeouts.socket(stream=False), (1, 5))
+        self.assertEqual(timeouts.socket(stream=True), (1, 2))
+        self.assertEqual(sapwrapper._timeouts({"request_timeout": 3}).socket(stream=True), (3, 3))
+
+    def test_deadline(self):
+        timeouts = sapwrapper._timeouts({"deadline": time.monotonic() + 0.5})
+        connect, read = timeouts.socket(stream=False)
+        self.assertLessEqual(read, 0.5)
+        with self.assertRaises(sapwrapper.Timeout):
+            sapwrapper._timeouts({"deadline": time.monotonic() - 1}).socket(stream=False)
+
+    def test_deadline_bounds_rate_limit_wait(self):
+        chat = sapwrapper.ChatCompletion(api_url="https://deadline/api/v1", client_id="client",
+                                         client_secret="secret", token_url="https://token",
+                                         requests_per_minute=20)
+        limiter = chat._rate_limiter({"deployment_id": "gpt-35-turbo"})
+        limiter._requests._level = 0
+        start = time.monotonic()
+        with self.assertRaises(sapwrapper.Timeout):
+            chat.create(model="gpt-35-turbo", messages=[], deadline=time.monotonic() + 0.5)
+        with self.assertRaises(sapwrapper.Timeout):
+            asyncio.run(chat.acreate(model="gpt-35-turbo", messages=[], deadline=time.monotonic() + 0.5))
+        self.assertLess(time.monotonic() - start, 0.1)
+        # the budget is left to the requests that are sent
+        self.assertGreaterEqual(limiter._requests._level, 0)
+
+    def test_stream_idle_timeout(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                # one chunk, then the stream stalls
+                self.wfile.write(b'10\r\ndata: {"n": 1}\n\n\r\n')
+                self.wfile.flush()
+                time.sleep(1)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            response = requests.get(f"http://127.0.0.1:{server.server_port}", stream=True, timeout=(1, 0.2))
+            events = sapwrapper._iter_events(response)
+            self.assertEqual(next(events), {"n": 1})
+            with self.assertRaises(sapwrapper.Timeout):
+                next(events)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class _DroppingHandler(http.server.BaseHTTPRequestHandler):
+    """Sends the first chunk of the body, then drops the connection."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.wfile.write(b'10\r\ndata: {"n": 1}\n\n\r\n')
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDroppedConnection(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _DroppingHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = sapwrapper.Completion(
+            api_url=f"http://127.0.0.1:{self.server.server_port}",
+            client_id="dropping-client", client_secret="secret", token_url="https://dropping-token",
+        )
+        self.client.token_manager._oauth = _CountingOAuth()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_response(self):
+        with self.assertRaises(sapwrapper.APIConnectionError):
+            self.client.create(engine="", prompt="hello")
+
+    def test_stream(self):
+        events = self.client.create(engine="", prompt="hello", stream=True)
+        self.assertEqual(next(events), {"n": 1})
+        with self.assertRaises(sapwrapper.APIConnectionError):
+            next(events)
+
+
+class TestTokenManager(unittest.TestCase):
+    def _manager(self, expires_in=3600):
+        manager = sapwrapper.TokenManager("https://token", "client", "secret")
+        manager._oauth = _CountingOAuth(expires_in)
+        return manager
+
+    def test_single_flight(self):
+        manager = self._manager()
+        threads = [threading.Thread(target=manager.get) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(manager._oauth.calls, 1)
+        self.assertEqual(manager.get(), "Bearer t1")
+
+    def test_background_refresh_serves_valid_token(self):
+        manager = self._manager()
+        manager.get()
+        manager._token["expires_at"] = time.time() + 120
+        self.assertEqual(manager.get(), "Bearer t1")
+        time.sleep(0.2)
+        self.assertEqual(manager._oauth.calls, 2)
+        self.assertEqual(manager.get(), "Bearer t2")
+
+    def test_timeout_waiting_for_token(self):
+        manager = self._manager()
+        manager._lock.acquire()
+        try:
+            with self.assertRaises(sapwrapper.Timeout):
+                manager.get(timeout=0.05)
+        finally:
+            manager._lock.release()
+
+    def test_shared_per_token_url_and_client(self):
+        first = sapwrapper.get_token_manager("https://token", "a", "secret")
+        self.assertIs(first, sapwrapper.get_token_manager("https://token", "a", "secret"))
+        self.assertIsNot(first, sapwrapper.get_token_manager("https://token", "b", "secret"))
+
+
+class TestClient(unittest.TestCase):
+    def _client(self, cls):
+        return cls(api_url="https://proxy/api/v1", client_id="client",
+                   client_secret="secret", token_url="https://token")
+
+    def test_payload_maps_deployment_id(self):
+        chat = self._client(sapwrapper.ChatCompletion)
+        payload = chat._payload({"model": "gpt-3.5-turbo", "messages": [], "request_timeout": 5,
+                                 "stream_timeout": 1, "deadline": 1.0})
+        self.assertEqual(payload, {"deployment_id": "gpt-35-turbo", "messages": []})
+        embedding = self._client(sapwrapper.Embedding)
+        payload = embedding._payload({"engine": "text-embedding-ada-002", "input": ["a"]})
+        self.assertEqual(payload["deployment_id"], "text-embedding-ada-002-v2")
+        self.assertEqual(embedding.url, "https://proxy/api/v1/embeddings")
+
+    def test_client_is_immutable(self):
+        completion = self._client(sapwrapper.Completion)
+        with self.assertRaises(AttributeError):
+            completion.api_url = "https://other"
+
+
+class _ProxyHandler(http.server.BaseHTTPRequestHandler):
+    """Answers completions like the proxy, prompts starting with an error code fail."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = payload["prompt"]
+        if prompt in ("429", "503"):
+            body = b'{"error": "failed"}'
+            self.send_response(int(prompt))
+            self.send_header("Retry-After", "7")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif payload.get("stream"):
+            body = b"".join(
+                b'data: {"choices": [{"text": "%s"}]}\n\n' % word.encode() for word in prompt.split()
+            ) + b"data: [DONE]\n\n"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            body = json.dumps({"choices": [{"text": prompt}], "deployment_id": payload["deployment_id"]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _ProxyHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = sapwrapper.Completion(
+            api_url=f"http://127.0.0.1:{self.server.server_port}",
+            client_id="async-client", client_secret="secret", token_url="https://async-token",
+        )
+        self.client.token_manager._oauth = _CountingOAuth()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_acreate(self):
+        response = asyncio.run(self.client.acreate(engine="", prompt="hello"))
+        self.assertEqual(response, {"choices": [{"text": "hello"}], "deployment_id": "text-davinci-003"})
+
+    def test_acreate_stream(self):
+        async def main():
+            events = await self.client.acreate(engine="", prompt="hello sparkling water", stream=True)
+            return [event["choices"][0]["text"] async for event in events]
+
+        self.assertEqual(asyncio.run(main()), ["hello", "sparkling", "water"])
+
+    def test_error_status(self):
+        with self.assertRaises(sapwrapper.RateLimitError) as context:
+            asyncio.run(self.client.acreate(engine="", prompt="429"))
+        self.assertEqual((context.exception.status_code, context.exception.retry_after), (429, 7.0))
+        with self.assertRaises(sapwrapper.ServiceUnavailableError):
+            asyncio.run(self.client.acreate(engine="", prompt="503"))
+
+    def test_sessions_closed_with_the_loop(self):
+        async def main():
+            session = sapwrapper.get_async_session(self.client.api_url)
+            self.assertIs(session, sapwrapper.get_async_session(self.client.api_url))
+            await self.client.acreate(engine="", prompt="hello")
+            return session
+
+        session = asyncio.run(main())
+        self.assertTrue(session.closed)
+        self.assertIsNot(asyncio.run(main()), session)
@@ -0,0 +1,29 @@
+import unittest
+
+from saplangchainproxy import tokenizer
+
+
+class TestTokenizer(unittest.TestCase):
+    def test_sap_deployment_ids(self):
+        self.assertEqual(tokenizer.get_encoding_model("gpt-35-turbo")[0], "gpt-3.5-turbo")
+        self.assertIs(
+            tokenizer.get_encoding("text-embedding-ada-002-v2"),
+            tokenizer.get_encoding("text-embedding-ada-002"),
+        )
+
+    def test_unknown_model_warns_once(self):
+        with self.assertLogs("saplangchainproxy.tokenizer", "WARNING") as logs:
+            model, encoding = tokenizer.get_encoding_model("bloom-7b1")
+            tokenizer.get_encoding_model("bloom-7b1")
+        self.assertEqual(model, tokenizer.FALLBACK_ENCODING)
+        self.assertEqual(encoding.name, tokenizer.FALLBACK_ENCODING)
+        self.assertEqual(len(logs.records), 1)
+
+    def test_encode_batch_matches_encode(self):
+        encoding = tokenizer.get_encoding("gpt-35-turbo")
+        for count in [1, tokenizer.BATCH_ENCODE_MIN_TEXTS * 2]:
+            texts = [f"text number {i}" for i in range(count)]
+            self.assertEqual(
+                tokenizer.encode_batch(encoding, texts),
+                [encoding.encode(text) for text in texts],
+            )
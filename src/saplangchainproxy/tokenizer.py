@@ -0,0 +1,95 @@
+"""Process-wide tiktoken encodings for the SAP AI proxy deployments."""
+from __future__ import annotations
+
+import logging
+from functools import lru_cache
+from typing import (
+    TYPE_CHECKING,
+    AbstractSet,
+    Any,
+    Collection,
+    List,
+    Literal,
+    Tuple,
+    Union,
+)
+
+if TYPE_CHECKING:
+    import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# SAP deployment ids mapped to the model names known to tiktoken
+SAP_DEPLOYMENT_MODELS = {
+    "gpt-35-turbo": "gpt-3.5-turbo",
+    "gpt-4-32k": "gpt-4",
+    "text-embedding-ada-002-v2": "text-embedding-ada-002",
+}
+
+# Encoding for the models unknown to tiktoken, e.g. alephalpha or bloom-7b1
+FALLBACK_ENCODING = "cl100k_base"
+
+# Below this number of texts a thread pool costs more than it saves
+BATCH_ENCODE_MIN_TEXTS = 16
+
+
+def _import_tiktoken() -> Any:
+    try:
+        import tiktoken
+    except ImportError:
+        raise ImportError(
+            "Could not import tiktoken python package. "
+            "This is needed in order to count and split tokens. "
+            "Please install it with `pip install tiktoken`."
+        )
+    return tiktoken
+
+
+def tiktoken_model_name(model: str) -> str:
+    """Map the SAP deployment id to the model name known to tiktoken."""
+    return SAP_DEPLOYMENT_MODELS.get(model, model)
+
+
+@lru_cache(maxsize=None)
+def get_encoding_model(model: str) -> Tuple[str, tiktoken.Encoding]:
+    """Get the tiktoken model name and encoding of the model or deployment id.
+
+    The result is cached for the lifetime of the process. Models unknown to
+    tiktoken fall back to the cl100k_base encoding, which is logged once.
+    """
+    tiktoken_ = _import_tiktoken()
+    model = tiktoken_model_name(model)
+    try:
+        return model, tiktoken_.encoding_for_model(model)
+    except KeyError:
+        logger.warning(
+            "Model %s not found. Using %s encoding.", model, FALLBACK_ENCODING
+        )
+        return FALLBACK_ENCODING, tiktoken_.get_encoding(FALLBACK_ENCODING)
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Get the cached tiktoken encoding of the model or deployment id."""
+    return get_encoding_model(model)[1]
+
+
+def encode_batch(
+    encoding: tiktoken.Encoding,
+    texts: List[str],
+    *,
+    allowed_special: Union[Literal["all"], AbstractSet[str]] = set(),
+    disallowed_special: Union[Literal["all"], Collection[str]] = "all",
+) -> List[List[int]]:
+    """Encode the texts, using the tiktoken thread pool for bulk inputs."""
+    if len(texts) < BATCH_ENCODE_MIN_TEXTS:
+        return [
+            encoding.encode(
+                text,
+                allowed_special=allowed_special,
+                disallowed_special=disallowed_special,
+            )
+            for text in texts
+        ]
+    return encoding.encode_batch(
+        texts, allowed_special=allowed_special, disallowed_special=disallowed_special
+    )